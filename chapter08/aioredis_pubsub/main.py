@@ -1,6 +1,5 @@
 from fastapi import FastAPI, Request
 import asyncio
-import async_timeout
 import aioredis
 from aioredis.client import Redis
 
@@ -15,23 +14,32 @@ class MessageEvent(BaseModel):
     message: dict
 
 
-async def reader(channel: aioredis.client.PubSub):
-    print("当前初始化？")
+# 订阅的频道
+CHANNELS = ("channel:1", "channel:2")
+
+
+async def reader(redis: Redis, channel: aioredis.client.PubSub):
+    # 有消息到达时才会被唤醒，不需要每隔一段时间轮询一次
+    retry_delay = 0.5
     while True:
+        if channel is None:
+            channel = redis.pubsub(ignore_subscribe_messages=True)
+            app.state.pubsub = channel
         try:
-            async with async_timeout.timeout(1):
-                # 执行接收订阅消息
-                message = await channel.get_message(ignore_subscribe_messages=True)
-                print("jiesh？ssssssssss", message)
-                if message is not None:
-                    pass
-                    message_event = MessageEvent.parse_raw(
-                        message["data"].decode("utf-8")
-                    )
-                    print("订阅接收到消息为：", message_event)
-                await asyncio.sleep(0.01)
-        except asyncio.TimeoutError:
-            pass
+            # 开始订阅相关频道，连接断开后重新订阅
+            await channel.subscribe(*CHANNELS)
+            retry_delay = 0.5
+            async for message in channel.listen():
+                message_event = MessageEvent.parse_raw(message["data"])
+                print("订阅接收到消息为：", message_event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            print(f"订阅消息异常：{ex}，{retry_delay}秒后重新订阅")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 30)
+            await channel.close()
+            channel = None
 
 
 @app.on_event("startup")
@@ -39,12 +47,12 @@ async def startup_event():
     # 创建Redis对象
     redis: Redis = aioredis.from_url("redis://localhost")
     # 创建消息发布定义对象获取到发布订阅对象
-    pubsub = redis.pubsub()
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
     # 把当前的对象添加到全局APP上下中
     app.state.redis = redis
     app.state.pubsub = pubsub
     # 开始订阅相关频道
-    await pubsub.subscribe("channel:1", "channel:2")
+    await pubsub.subscribe(*CHANNELS)
     # 消息模型的创建
     event = MessageEvent(
         username="xiaozhongtongxue", message={"msg": "在startup_event发布的事件消息"}
@@ -52,7 +60,7 @@ async def startup_event():
     # 消息发布0发布到channel:1频道上
     await redis.publish(channel="channel:1", message=event.json())
     # 执行消息订阅循环监听
-    asyncio.create_task(reader(pubsub))
+    app.state.reader = asyncio.create_task(reader(redis, pubsub))
     # future = asyncio.create_task(reader(pubsub))
     # 不能加这个等待结果返回，因为里面是一个while 循环，等待返回就会一直阻塞
     # await future
@@ -61,10 +69,12 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     pass
-    # 解除相关频道订阅
-    app.state.pubsub.unsubscribe("channel:1", "channel:2")
+    # 停止订阅，解除相关频道订阅
+    app.state.reader.cancel()
+    await asyncio.gather(app.state.reader, return_exceptions=True)
+    await app.state.pubsub.close()
     # 关闭redis连接
-    app.state.redis.close()
+    await app.state.redis.close()
 
 
 @app.get("/index")
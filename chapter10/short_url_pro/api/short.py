@@ -1,28 +1,84 @@
-from fastapi import APIRouter, Depends, BackgroundTasks
-from fastapi.responses import RedirectResponse, PlainTextResponse
+import typing
 
-from dependencies import get_db_session
-from db.database import AsyncSession
-from servies.short import ShortServeries
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from servies.redirect import short_redirect_engine
+from servies.visits import visit_counter
 
 router_short = APIRouter(tags=["短链访问"])
 
+NOT_FOUND_BODY = "没有对应短链信息记录".encode("utf-8")
+NOT_FOUND_HEADERS = [
+    (b"content-type", b"text/plain; charset=utf-8"),
+    (b"content-length", str(len(NOT_FOUND_BODY)).encode("latin-1")),
+]
+
+
+def is_short_tag(short_tag: str) -> bool:
+    return 0 < len(short_tag) <= 20 and short_tag.isascii() and short_tag.isalnum()
+
+
+class ShortRedirectMiddleware:
+    """
+    短链跳转的快速通道，纯ASGI实现，不经过路由匹配、依赖注入和请求参数解析，
+    进程内缓存命中时直接返回307跳转；其他请求原样交给应用处理
+    """
+
+    def __init__(self, app: ASGIApp, fastapi_app: FastAPI) -> None:
+        self.app = app
+        self.fastapi_app = fastapi_app
+        # 和短链标签格式相同的其他路由，如 /docs
+        self._reserved: typing.Optional[typing.FrozenSet[str]] = None
+
+    def reserved(self) -> typing.FrozenSet[str]:
+        if self._reserved is None:
+            self._reserved = frozenset(
+                route.path[1:]
+                for route in self.fastapi_app.routes
+                if route.path.count("/") == 1 and "{" not in route.path
+            )
+        return self._reserved
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+        short_tag = scope["path"][1:]
+        if not is_short_tag(short_tag) or short_tag in self.reserved():
+            await self.app(scope, receive, send)
+            return
+        hit, location = short_redirect_engine.get_local(short_tag)
+        if not hit:
+            location = await short_redirect_engine.get_location(short_tag)
+        if location is None:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 404,
+                    "headers": NOT_FOUND_HEADERS,
+                }
+            )
+            await send({"type": "http.response.body", "body": NOT_FOUND_BODY})
+            return
+        client = scope.get("client")
+        visit_counter.record(short_tag, client[0] if client else None)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 307,
+                "headers": [(b"location", location), (b"content-length", b"0")],
+            }
+        )
+        await send({"type": "http.response.body", "body": b""})
+
 
 @router_short.get("/{short_tag}")
-async def short_redirect(
-    *,
-    short_tag: str,
-    db_session: AsyncSession = Depends(get_db_session),
-    taks: BackgroundTasks
-):
-    data = await ShortServeries.get_short_url(db_session, short_tag)
-    if not data:
-        return PlainTextResponse("没有对应短链信息记录")
-    data.visits_count = data.visits_count + 1
-    taks.add_task(
-        ShortServeries.update_short_url,
-        db_session,
-        short_url_id=data.id,
-        visits_count=data.visits_count,
-    )
-    return RedirectResponse(url=data.long_url)
+async def short_redirect(*, short_tag: str, request: Request):
+    # 一般由 ShortRedirectMiddleware 处理，这里保留给接口文档和未启用中间件时使用
+    location = await short_redirect_engine.get_location(short_tag)
+    if location is None:
+        return PlainTextResponse("没有对应短链信息记录", status_code=404)
+    visit_counter.record(short_tag, request.client.host if request.client else None)
+    return Response(status_code=307, headers={"location": location.decode("latin-1")})
@@ -3,14 +3,18 @@ from dependencies import get_db_session
 from db.database import AsyncSession
 from servies.user import UserServeries
 from servies.short import ShortServeries
+from servies.redirect import short_redirect_engine
 from starlette.status import HTTP_401_UNAUTHORIZED
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datetime import timedelta, datetime
 from utils.passlib_hepler import PasslibHelper
 from utils.auth_helper import AuthToeknHelper
-from utils.random_helper import generate_short_url
+from servies.short_import import import_short_urls, short_tag_allocator
+from config.config import get_settings
 from schemas import SingleShortUrlCreate
 from fastapi import File, UploadFile
+from fastapi.responses import StreamingResponse
+import json
 
 router_uesr = APIRouter(prefix="/api/v1", tags=["用户创建短链管理"])
 # 注意需要请求的是完整的路径
@@ -60,13 +64,14 @@ async def creat_single(
     payload = AuthToeknHelper.token_decode(token=token)
     # 定义认证异常信息
     username = payload.get("username")
-    creatinfo.short_tag = generate_short_url()
+    creatinfo.short_tag = await short_tag_allocator.allocate()
     creatinfo.short_url = f"{creatinfo.short_url}{creatinfo.short_tag}"
     creatinfo.created_by = username
     creatinfo.msg_context = (
         f"{creatinfo.msg_context},了解详情请点击 {creatinfo.short_url} ！"
     )
     result = await ShortServeries.create_short_url(db_session, **creatinfo.dict())
+    await short_redirect_engine.prime(result.short_tag, result.long_url)
     return {"code": 200, "msg": "创建短链成功", "data": {"short_url": result.short_url}}
 
 
@@ -74,28 +79,25 @@ async def creat_single(
 async def creat_batch(
     *,
     file: UploadFile = File(...),
+    progress: bool = False,
     token: str = Depends(oauth2_scheme),
-    db_session: AsyncSession = Depends(get_db_session),
 ):
     payload = AuthToeknHelper.token_decode(token=token)
     # 定义认证异常信息
     username = payload.get("username")
-    contents = await file.read()
-    shorl_msg = contents.decode(encoding="utf-8").split("\n")
+    # 按行流式读取上传的文件，分块写入
+    importer = import_short_urls(
+        file, username, chunk_size=get_settings().SHORT_IMPORT_CHUNK_SIZE
+    )
+    if progress:
+        # 每写入一块返回一行进度信息
+        async def stream_progress():
+            async for item in importer:
+                yield json.dumps(item, ensure_ascii=False) + "\n"
 
-    def make_short_url(item):
-        split_item = item.split("#")
-        short_tag = generate_short_url()
-        short_url = f"http://127.0.0.1:8000/{short_tag}"
-        return SingleShortUrlCreate(
-            long_url=f"{split_item[2]}{split_item[0]}",
-            short_tag=short_tag,
-            short_url=short_url,
-            created_by=username,
-            msg_context=f"{split_item[1].replace('chanename', split_item[0]).replace('url', 'short_url')}",
-        )
+        return StreamingResponse(stream_progress(), media_type="application/x-ndjson")
 
-    result = await ShortServeries.create_batch_short_url(
-        db_session, [make_short_url(item) for item in shorl_msg]
-    )
-    return {"code": 200, "msg": "批量创建短链成功", "data": None}
+    result = None
+    async for result in importer:
+        pass
+    return {"code": 200, "msg": "批量创建短链成功", "data": result}
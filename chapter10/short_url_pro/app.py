@@ -9,12 +9,15 @@ app = FastAPI(title="fastapi集成短链实战案例")
 async def startup_event():
     pass
     from db.database import async_engine, Base
-    from models.model import User, ShortUrl
+    from models.model import User, ShortUrl, ShortUrlDailyVisits, ShortTagSequence
 
     async def init_create_table():
         async with async_engine.begin() as conn:
             # await conn.run_sync(Base.metadata.drop_all)
             await conn.run_sync(Base.metadata.create_all)
+            # 已经存在的表不会自动创建新增的索引
+            for index in ShortUrl.__table__.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
 
     await init_create_table()
 
@@ -30,6 +33,20 @@ from api.user import router_uesr
 app.include_router(router_short)
 app.include_router(router_uesr)
 
+# 短链跳转的缓存和快速通道
+from config.config import get_settings
+from servies.redirect import short_redirect_engine
+from api.short import ShortRedirectMiddleware
+
+# 访问统计需要在跳转缓存之前注册，关闭时先写入最后的访问次数再关闭redis
+from servies.visits import visit_counter
+
+visit_counter.init_app(
+    app, get_settings(), get_redis=lambda: short_redirect_engine.redis
+)
+short_redirect_engine.init_app(app, get_settings())
+app.add_middleware(ShortRedirectMiddleware, fastapi_app=app)
+
 print("启动！")
 if __name__ == "__main__":
     import uvicorn
@@ -7,6 +7,26 @@ class Settings(BaseSettings):
     ASYNC_DATABASE_URI: str = "sqlite+aiosqlite:///short.db"
     # 定义TOEKN的签名信息值
     TOKEN_SIGN_SECRET: str = "ZcjT6Rcp1yIFQoS7"
+    # redis链接地址，例如：redis://127.0.0.1:6379/0，为空的时候只使用进程内缓存
+    REDIS_URL: str = ""
+    # 短链跳转：进程内缓存的最大短链数量
+    REDIRECT_LOCAL_MAXSIZE: int = 100000
+    # 短链跳转：进程内缓存的过期时间（秒）
+    REDIRECT_LOCAL_TTL: float = 300
+    # 短链跳转：不存在的短链标签的缓存时间（秒）
+    REDIRECT_NEGATIVE_TTL: float = 10
+    # 短链跳转：redis缓存的过期时间（秒）
+    REDIRECT_REDIS_TTL: float = 86400
+    # 短链跳转：redis key前缀
+    REDIRECT_KEY_PREFIX: str = "short:tag:"
+    # 访问统计：访问次数合并写入数据库的间隔（秒）
+    VISIT_FLUSH_INTERVAL: float = 1
+    # 访问统计：是否按天汇总写入 short_url_daily_visits 表
+    VISIT_DAILY_ROLLUP: bool = True
+    # 访问统计：按天统计独立访客的redis key前缀
+    VISIT_UV_KEY_PREFIX: str = "short:uv:"
+    # 批量导入短链时每次写入数据库的行数
+    SHORT_IMPORT_CHUNK_SIZE: int = 1000
 
 
 @lru_cache()
@@ -1,5 +1,5 @@
 from db.database import Base
-from sqlalchemy import Column, String, DateTime, func, Integer  # Integer
+from sqlalchemy import Column, String, DateTime, Date, func, Integer, BigInteger, Index  # Integer
 
 
 class User(Base):
@@ -18,7 +18,7 @@ class ShortUrl(Base):
     # 指定本类映射到users表
     __tablename__ = "short_url"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    # 短链标签
+    # 短链标签，跳转时按短链标签查询，需要唯一索引
     short_tag = Column(String(20), nullable=False)
     # 短连接地址
     short_url = Column(String(20))
@@ -32,3 +32,27 @@ class ShortUrl(Base):
     created_by = Column(String(20))
     # 短信内容
     msg_context = Column(String, nullable=False)
+
+    __table_args__ = (Index("ux_short_url_short_tag", "short_tag", unique=True),)
+
+
+class ShortUrlDailyVisits(Base):
+    # 短链按天汇总的访问统计
+    __tablename__ = "short_url_daily_visits"
+    # 短链标签
+    short_tag = Column(String(20), primary_key=True)
+    # 统计日期
+    day = Column(Date, primary_key=True)
+    # 当天访问次数
+    visits = Column(Integer, nullable=False, default=0)
+    # 当天独立访客数（按IP估算），启用redis时才会统计
+    uniques = Column(Integer, nullable=True)
+
+
+class ShortTagSequence(Base):
+    # 生成短链标签的序列号，按块预留，多个worker之间不会重复
+    __tablename__ = "short_tag_sequence"
+    # 序列名称
+    name = Column(String(20), primary_key=True)
+    # 下一个可以分配的序列号
+    next_value = Column(BigInteger, nullable=False, default=1)
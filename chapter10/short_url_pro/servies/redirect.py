@@ -0,0 +1,166 @@
+"""
+短链跳转的缓存
+
+短链群发后的访问集中在少量短链上，每次跳转都查询数据库扛不住，这里：
+1：进程内LRU缓存短链标签对应的跳转地址（已经编码好的Location响应头），命中时不需要任何IO
+2：配置了REDIS_URL时多个worker共享redis缓存，进程内缓存未命中时先查redis再查数据库
+3：不存在的短链标签也缓存一小段时间（负缓存），扫描随机标签的请求不会打到数据库
+4：同一个短链同时未命中时只查询一次数据库，其他请求等待查询结果
+"""
+import asyncio
+import time
+import typing
+from collections import OrderedDict
+from urllib.parse import quote
+
+from fastapi import FastAPI
+
+from db.database import SessionLocal
+from servies.short import ShortServeries
+
+# 和 RedirectResponse 一致的编码方式
+LOCATION_SAFE_CHARS = ":/%#?=@[]!$&'()*+,;"
+# redis中表示短链不存在的值
+NEGATIVE_VALUE = b""
+
+
+def encode_location(long_url: str) -> bytes:
+    return quote(long_url, safe=LOCATION_SAFE_CHARS).encode("latin-1")
+
+
+class ShortRedirectEngine:
+    pass
+
+    def __init__(self, app: FastAPI = None):
+        self.maxsize = 100000
+        self.local_ttl = 300.0
+        self.negative_ttl = 10.0
+        self.redis_ttl = 86400
+        self.key_prefix = "short:tag:"
+        self.redis_url = ""
+        self.redis = None
+        # {短链标签: (Location响应头，不存在时为None, 过期时间)}
+        self._local: "OrderedDict[str, typing.Tuple[typing.Optional[bytes], float]]" = (
+            OrderedDict()
+        )
+        # 正在加载的短链标签
+        self._loading: typing.Dict[str, asyncio.Future] = {}
+        # 统计信息
+        self.stats = {"hits": 0, "misses": 0, "redis_hits": 0, "db_loads": 0}
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None)
+
+    def init_app(self, app: FastAPI, redirectconf):
+        self.app = app
+        if redirectconf is not None:
+            self.maxsize = redirectconf.REDIRECT_LOCAL_MAXSIZE
+            self.local_ttl = redirectconf.REDIRECT_LOCAL_TTL
+            self.negative_ttl = redirectconf.REDIRECT_NEGATIVE_TTL
+            self.redis_ttl = int(redirectconf.REDIRECT_REDIS_TTL)
+            self.key_prefix = redirectconf.REDIRECT_KEY_PREFIX
+            self.redis_url = redirectconf.REDIS_URL
+
+        @app.on_event("startup")
+        async def startup_event():
+            if self.redis_url:
+                # 只有配置了redis才需要安装aioredis
+                import aioredis
+
+                self.redis = aioredis.from_url(self.redis_url)
+
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            if self.redis is not None:
+                await self.redis.close()
+                self.redis = None
+
+    def get_local(self, short_tag: str) -> typing.Tuple[bool, typing.Optional[bytes]]:
+        """
+        只查询进程内缓存
+        :return: (是否命中, Location响应头，短链不存在时为None)
+        """
+        item = self._local.get(short_tag)
+        if item is None:
+            return False, None
+        if item[1] < time.monotonic():
+            self._local.pop(short_tag, None)
+            return False, None
+        self._local.move_to_end(short_tag)
+        self.stats["hits"] += 1
+        return True, item[0]
+
+    def _set_local(self, short_tag: str, location: typing.Optional[bytes]):
+        ttl = self.local_ttl if location is not None else self.negative_ttl
+        self._local[short_tag] = (location, time.monotonic() + ttl)
+        self._local.move_to_end(short_tag)
+        while len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
+
+    async def get_location(self, short_tag: str) -> typing.Optional[bytes]:
+        """查询短链的Location响应头，短链不存在时返回None"""
+        hit, location = self.get_local(short_tag)
+        if hit:
+            return location
+        future = self._loading.get(short_tag)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[short_tag] = future
+        try:
+            location = await self._load(short_tag)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            # 没有其他等待者时避免 "exception was never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(location)
+        finally:
+            self._loading.pop(short_tag, None)
+        return location
+
+    async def _load(self, short_tag: str) -> typing.Optional[bytes]:
+        self.stats["misses"] += 1
+        key = f"{self.key_prefix}{short_tag}"
+        if self.redis is not None:
+            value = await self.redis.get(key)
+            if value is not None:
+                self.stats["redis_hits"] += 1
+                location = value if value != NEGATIVE_VALUE else None
+                self._set_local(short_tag, location)
+                return location
+        self.stats["db_loads"] += 1
+        async with SessionLocal() as async_session:
+            long_url = await ShortServeries.get_long_url(async_session, short_tag)
+        location = encode_location(long_url) if long_url is not None else None
+        self._set_local(short_tag, location)
+        if self.redis is not None:
+            if location is not None:
+                await self.redis.set(key, location, ex=self.redis_ttl)
+            else:
+                await self.redis.set(
+                    key, NEGATIVE_VALUE, ex=max(int(self.negative_ttl), 1)
+                )
+        return location
+
+    async def prime(self, short_tag: str, long_url: str):
+        """新建短链后写入缓存，覆盖可能存在的负缓存"""
+        location = encode_location(long_url)
+        self._set_local(short_tag, location)
+        if self.redis is not None:
+            await self.redis.set(
+                f"{self.key_prefix}{short_tag}", location, ex=self.redis_ttl
+            )
+
+    async def forget(self, short_tag: str):
+        """短链修改或删除后清除缓存"""
+        self._local.pop(short_tag, None)
+        if self.redis is not None:
+            await self.redis.delete(f"{self.key_prefix}{short_tag}")
+
+
+short_redirect_engine = ShortRedirectEngine()
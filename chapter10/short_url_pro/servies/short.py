@@ -1,8 +1,10 @@
-from sqlalchemy import select, update, delete
+from datetime import date
+
+from sqlalchemy import select, update, delete, bindparam, text, Date
 from sqlalchemy.ext.asyncio import AsyncSession
-from models.model import ShortUrl
+from models.model import ShortUrl, ShortUrlDailyVisits
 from db.database import async_engine, Base
-from typing import List
+from typing import List, Mapping, Optional
 from schemas import SingleShortUrlCreate
 
 
@@ -21,6 +23,89 @@ class ShortServeries:
         )
         return result.scalars().first()
 
+    @staticmethod
+    async def get_long_url(
+        async_session: AsyncSession, short_tag: str
+    ) -> Optional[str]:
+        # 跳转只需要长链接地址，不需要加载整个ORM对象
+        result = await async_session.execute(
+            select(ShortUrl.long_url).where(ShortUrl.short_tag == short_tag)
+        )
+        return result.scalar()
+
+    @staticmethod
+    async def add_visits_count(
+        async_session: AsyncSession, visits: Mapping[str, int], chunk_size=500
+    ):
+        # 一条语句累加一批短链的访问次数，多个worker同时写入也不会丢失
+        # 这里不提交事务，和按天汇总在同一个事务里面提交，避免失败重试时重复累加；
+        # 语句以UPDATE开头（不用WITH），sqlite驱动才会在执行前开启事务
+        items = list(visits.items())
+        for offset in range(0, len(items), chunk_size):
+            chunk = items[offset : offset + chunk_size]
+            rows = ", ".join(
+                f"(:t{i}, CAST(:c{i} AS INTEGER))" for i in range(len(chunk))
+            )
+            params = {}
+            for i, (tag, count) in enumerate(chunk):
+                params[f"t{i}"] = tag
+                params[f"c{i}"] = count
+            await async_session.execute(
+                text(
+                    "UPDATE short_url "
+                    "SET visits_count = COALESCE(short_url.visits_count, 0) + v.column2 "
+                    f"FROM (VALUES {rows}) AS v WHERE short_url.short_tag = v.column1"
+                ),
+                params,
+            )
+
+    @staticmethod
+    async def add_daily_visits(
+        async_session: AsyncSession,
+        day: date,
+        visits: Mapping[str, int],
+        chunk_size=500,
+    ):
+        # 按天汇总的访问次数，不存在时插入，存在时累加（不提交事务，由调用方提交）
+        items = list(visits.items())
+        for offset in range(0, len(items), chunk_size):
+            chunk = items[offset : offset + chunk_size]
+            rows = ", ".join(f"(:t{i}, :day, :c{i})" for i in range(len(chunk)))
+            params = {"day": day}
+            for i, (tag, count) in enumerate(chunk):
+                params[f"t{i}"] = tag
+                params[f"c{i}"] = count
+            await async_session.execute(
+                text(
+                    "INSERT INTO short_url_daily_visits (short_tag, day, visits) "
+                    f"VALUES {rows} "
+                    "ON CONFLICT (short_tag, day) DO UPDATE "
+                    "SET visits = short_url_daily_visits.visits + excluded.visits"
+                ).bindparams(bindparam("day", type_=Date)),
+                params,
+            )
+
+    @staticmethod
+    async def set_daily_uniques(
+        async_session: AsyncSession, day: date, uniques: Mapping[str, int]
+    ):
+        response = (
+            update(ShortUrlDailyVisits)
+            .where(
+                ShortUrlDailyVisits.short_tag == bindparam("tag"),
+                ShortUrlDailyVisits.day == bindparam("stat_day"),
+            )
+            .values(uniques=bindparam("count"))
+        )
+        await async_session.execute(
+            response,
+            [
+                {"tag": tag, "stat_day": day, "count": count}
+                for tag, count in uniques.items()
+            ],
+        )
+        await async_session.commit()
+
     @staticmethod
     async def create_short_url(async_session: AsyncSession, **kwargs):
         new_short_url = ShortUrl(**kwargs)
@@ -0,0 +1,171 @@
+"""
+短链标签的分配和批量导入
+
+以前随机生成7位短链标签，没有检查是否重复；批量创建时一次读取整个上传文件、
+每行创建一个pydantic对象再一次性 add_all，百万行的短信群发文件会占满worker的内存。这里：
+1：短链标签由数据库中的序列号生成，每次按块预留一段序列号，多个worker之间不会重复；
+   序列号一一映射为8位的base62标签（见 utils.random_helper.sequence_short_tag），
+   和以前随机生成的7位标签也不会重复
+2：批量导入时按行流式读取上传的文件，每 chunk_size 行预留一块序列号，
+   用一条 insert 批量写入并提交，内存占用和文件大小无关
+3：每写入一块返回一次进度
+"""
+import asyncio
+import codecs
+import typing
+
+from fastapi import UploadFile
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from db.database import SessionLocal
+from models.model import ShortTagSequence, ShortUrl
+from utils.random_helper import sequence_short_tag
+
+# 返回的格式错误的行号数量上限
+MAX_ERROR_LINES = 100
+
+
+class ShortTagAllocator:
+    pass
+
+    def __init__(self, name="short_tag", block_size=1000):
+        self.name = name
+        self.block_size = block_size
+        # 当前进程已经预留还没有使用的序列号 [_next, _end)
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def reserve(self, count: int) -> int:
+        """
+        从数据库预留 count 个连续的序列号
+        :return: 第一个序列号
+        """
+        async with SessionLocal() as async_session:
+            for _ in range(2):
+                result = await async_session.execute(
+                    update(ShortTagSequence)
+                    .where(ShortTagSequence.name == self.name)
+                    .values(next_value=ShortTagSequence.next_value + count)
+                )
+                if result.rowcount:
+                    # 更新后这一行在提交前一直被锁定，读到的就是自己预留后的值
+                    next_value = (
+                        await async_session.execute(
+                            select(ShortTagSequence.next_value).where(
+                                ShortTagSequence.name == self.name
+                            )
+                        )
+                    ).scalar()
+                    await async_session.commit()
+                    return next_value - count
+                # 第一次使用时初始化序列
+                try:
+                    async_session.add(
+                        ShortTagSequence(name=self.name, next_value=1 + count)
+                    )
+                    await async_session.commit()
+                    return 1
+                except IntegrityError:
+                    # 其他worker同时初始化了，重新预留
+                    await async_session.rollback()
+        raise RuntimeError("预留短链序列号失败")
+
+    async def allocate(self) -> str:
+        """分配一个短链标签"""
+        async with self._lock:
+            if self._next >= self._end:
+                self._next = await self.reserve(self.block_size)
+                self._end = self._next + self.block_size
+            sequence = self._next
+            self._next += 1
+        return sequence_short_tag(sequence)
+
+
+short_tag_allocator = ShortTagAllocator()
+
+
+async def iter_upload_lines(
+    upload: UploadFile, read_size=64 * 1024
+) -> typing.AsyncIterator[str]:
+    """按行读取上传的文件，每次只读取 read_size 字节"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    while True:
+        chunk = await upload.read(read_size)
+        if not chunk:
+            break
+        buffer += decoder.decode(chunk)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+def make_short_row(
+    split_item: typing.List[str], short_tag: str, username: str, short_url_prefix: str
+) -> typing.Dict:
+    """一行 名称#短信内容模板#长链接前缀 对应的短链记录"""
+    return {
+        "long_url": f"{split_item[2]}{split_item[0]}",
+        "short_tag": short_tag,
+        "short_url": f"{short_url_prefix}{short_tag}",
+        "created_by": username,
+        "msg_context": split_item[1]
+        .replace("chanename", split_item[0])
+        .replace("url", "short_url"),
+        "visits_count": 0,
+    }
+
+
+async def import_short_urls(
+    upload: UploadFile,
+    username: str,
+    short_url_prefix="http://127.0.0.1:8000/",
+    chunk_size=1000,
+) -> typing.AsyncIterator[typing.Dict]:
+    """
+    批量导入短链，每写入一块返回一次进度，最后一次返回的是汇总信息
+    """
+    progress = {"lines": 0, "created": 0, "skipped": 0, "error_lines": []}
+
+    async def write_chunk(items: typing.List[typing.List[str]]):
+        # 只为格式正确的行预留序列号
+        start = await short_tag_allocator.reserve(len(items))
+        rows = [
+            make_short_row(
+                split_item,
+                sequence_short_tag(start + offset),
+                username,
+                short_url_prefix,
+            )
+            for offset, split_item in enumerate(items)
+        ]
+        async with SessionLocal() as async_session:
+            await async_session.execute(insert(ShortUrl), rows)
+            await async_session.commit()
+        progress["created"] += len(rows)
+
+    chunk: typing.List[typing.List[str]] = []
+    async for line in iter_upload_lines(upload):
+        progress["lines"] += 1
+        if not line.strip():
+            continue
+        split_item = line.split("#")
+        if len(split_item) < 3:
+            progress["skipped"] += 1
+            if len(progress["error_lines"]) < MAX_ERROR_LINES:
+                progress["error_lines"].append(progress["lines"])
+            continue
+        chunk.append(split_item)
+        if len(chunk) >= chunk_size:
+            await write_chunk(chunk)
+            chunk = []
+            yield {**progress, "done": False}
+    if chunk:
+        await write_chunk(chunk)
+    yield {**progress, "done": True}
@@ -0,0 +1,137 @@
+"""
+短链访问次数的统计
+
+以前每次跳转都单独执行一次 UPDATE，并且是读出来加1再写回去，并发时会丢失访问次数。这里：
+1：访问次数先在进程内按短链累加，每隔 VISIT_FLUSH_INTERVAL 秒用一条
+   UPDATE ... FROM (VALUES ...) 在数据库中累加，每次点击不再需要写一次数据库
+2：启用 VISIT_DAILY_ROLLUP 时同时按天汇总写入 short_url_daily_visits 表
+3：启用redis时用 HyperLogLog 按天统计每个短链的独立访客（按IP），汇总时写入当天的独立访客数
+"""
+import asyncio
+import datetime
+import logging
+import typing
+from collections import Counter, defaultdict
+
+from fastapi import FastAPI
+
+from db.database import SessionLocal
+from servies.short import ShortServeries
+
+logger = logging.getLogger(__name__)
+
+
+class VisitCounter:
+    pass
+
+    def __init__(self, app: FastAPI = None):
+        self.get_redis: typing.Callable = lambda: None
+        self.flush_interval = 1.0
+        self.daily_rollup = True
+        self.uv_key_prefix = "short:uv:"
+        self.uv_ttl = 86400 * 2
+        # 还没有写入数据库的访问次数
+        self._visits: typing.Counter[str] = Counter()
+        # 还没有写入redis的访客 {短链标签: {访客IP}}
+        self._visitors: typing.Dict[str, typing.Set[str]] = defaultdict(set)
+        self._task: typing.Optional[asyncio.Task] = None
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None)
+
+    def init_app(self, app: FastAPI, visitconf, get_redis: typing.Callable = None):
+        """
+        :param app:
+        :param visitconf: 配置信息
+        :param get_redis: 可选，返回 aioredis.Redis 的函数，返回None时不统计独立访客
+        :return:
+        """
+        self.app = app
+        self.get_redis = get_redis or (lambda: None)
+        if visitconf is not None:
+            self.flush_interval = visitconf.VISIT_FLUSH_INTERVAL
+            self.daily_rollup = visitconf.VISIT_DAILY_ROLLUP
+            self.uv_key_prefix = visitconf.VISIT_UV_KEY_PREFIX
+
+        @app.on_event("startup")
+        async def startup_event():
+            self._task = asyncio.create_task(self._flush_loop())
+
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            if self._task is not None:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                self._task = None
+            # 最后一个周期的访问次数
+            await self.flush()
+
+    def record(self, short_tag: str, visitor: str = None):
+        self._visits[short_tag] += 1
+        if visitor is not None and self.get_redis() is not None:
+            self._visitors[short_tag].add(visitor)
+
+    def _merge_visitors(self, visitors: typing.Dict[str, typing.Set[str]]):
+        for tag, items in visitors.items():
+            self._visitors[tag].update(items)
+
+    async def flush(self):
+        if not self._visits and not self._visitors:
+            return
+        visits, self._visits = self._visits, Counter()
+        visitors, self._visitors = self._visitors, defaultdict(set)
+        day = datetime.date.today()
+        if visits:
+            try:
+                # 访问次数和按天汇总在同一个事务里面提交，失败时都没有写入，合并到下一次不会重复累加
+                async with SessionLocal() as async_session:
+                    await ShortServeries.add_visits_count(async_session, visits)
+                    if self.daily_rollup:
+                        await ShortServeries.add_daily_visits(
+                            async_session, day, visits
+                        )
+                    await async_session.commit()
+            except Exception:
+                # 写入失败的访问次数和访客合并到下一次
+                self._visits.update(visits)
+                self._merge_visitors(visitors)
+                raise
+        if visitors:
+            try:
+                await self._flush_visitors(day, visitors)
+            except Exception:
+                # PFADD重复添加同一个访客不影响统计，失败时合并到下一次
+                self._merge_visitors(visitors)
+                raise
+
+    async def _flush_visitors(self, day, visitors: typing.Dict[str, typing.Set[str]]):
+        redis = self.get_redis()
+        if redis is None:
+            return
+        keys = {tag: f"{self.uv_key_prefix}{day:%Y%m%d}:{tag}" for tag in visitors}
+        async with redis.pipeline(transaction=False) as pipe:
+            for tag, items in visitors.items():
+                pipe.pfadd(keys[tag], *items)
+                pipe.expire(keys[tag], self.uv_ttl)
+            await pipe.execute()
+        if not self.daily_rollup:
+            return
+        async with redis.pipeline(transaction=False) as pipe:
+            for tag in visitors:
+                pipe.pfcount(keys[tag])
+            counts = await pipe.execute()
+        async with SessionLocal() as async_session:
+            await ShortServeries.set_daily_uniques(
+                async_session, day, dict(zip(visitors, counts))
+            )
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("短链访问次数写入异常")
+
+
+visit_counter = VisitCounter()
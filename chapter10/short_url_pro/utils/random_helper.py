@@ -6,3 +6,28 @@ def generate_short_url(size=7) -> str:
     letters = string.ascii_letters + string.digits
     short_tag = "".join(random.choice(letters) for i in range(size))
     return short_tag
+
+
+BASE62_ALPHABET = string.digits + string.ascii_letters
+# 序列号生成的短链标签固定8位，和随机生成的7位短链标签不会重复
+SEQUENCE_TAG_SIZE = 8
+SEQUENCE_TAG_SPACE = 62**SEQUENCE_TAG_SIZE
+# 和 62**8 互质的乘数（约为 62**8 的黄金分割），序列号一一映射到整个标签空间，相邻的序列号生成的标签看起来没有规律
+SEQUENCE_TAG_MULTIPLIER = 134941606347813
+SEQUENCE_TAG_OFFSET = 104729
+
+
+def encode_base62(value: int, size: int) -> str:
+    chars = []
+    for _ in range(size):
+        value, index = divmod(value, 62)
+        chars.append(BASE62_ALPHABET[index])
+    return "".join(reversed(chars))
+
+
+def sequence_short_tag(sequence: int) -> str:
+    """序列号转换为短链标签，不同的序列号一定生成不同的标签"""
+    value = (
+        sequence * SEQUENCE_TAG_MULTIPLIER + SEQUENCE_TAG_OFFSET
+    ) % SEQUENCE_TAG_SPACE
+    return encode_base62(value, SEQUENCE_TAG_SIZE)
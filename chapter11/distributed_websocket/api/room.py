@@ -7,6 +7,7 @@ from starlette.responses import FileResponse
 from utils.auth_helper import AuthToeknHelper
 from fastapi import WebSocket, status
 from utils.room_connection_helper_distributed import RoomConnectionManager
+from utils.connection_registry import DEFAULT_ROOM
 from faker import Faker
 
 fake = Faker(locale="zh_CN")
@@ -27,6 +28,8 @@ class ChatRoomWebSocket(WebSocketEndpoint):
         # 每一个客户端请求进来的时候都会执行创建一次，归属当前会话请求
         # 用户登入授权的token
         self.curr_user: Optional[UserDistribute] = None
+        # 当前连接所在的房间
+        self.room_id: str = DEFAULT_ROOM
 
     async def curr_user_login_init(self, websocket: WebSocket):
         # 当前房间对象
@@ -53,9 +56,11 @@ class ChatRoomWebSocket(WebSocketEndpoint):
                     code=status.WS_1000_NORMAL_CLOSURE, websocket=websocket
                 )
 
-        if self.room.check_user_logic(self.curr_user):
+        if self.curr_user and self.room.check_user_logic(self.curr_user):
             # 由于收到不符合约定的数据而断开连接. 这是一个通用状态码,
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            # 已经拒绝的连接不能再加入房间，否则会替换掉用户当前正常的连接
+            self.curr_user = None
             # raise RuntimeError("当前用户已登过了！")
 
     async def check_user_in_logic(self):
@@ -66,33 +71,42 @@ class ChatRoomWebSocket(WebSocketEndpoint):
     async def on_connect(self, _websocket):
         # 初始化当前连接到服务端的用户信息
         self.room = _websocket.app.state.room_connection
+        self.room_id = _websocket.query_params.get("room") or DEFAULT_ROOM
         # 确认链接
         await _websocket.accept()
         # 初始化当前用户信息
         await self.curr_user_login_init(_websocket)
+        if self.curr_user is None:
+            return
         # 把用户加入到当前用户列表中，
         self.room.user_add_login_room(self.curr_user)
-        # 把客户端连接添加到列表中
-        self.room.websocket_add_login_room(self.curr_user, _websocket)
+        # 把客户端连接添加到房间中
+        self.room.websocket_add_login_room(self.curr_user, _websocket, self.room_id)
         # 添加连接
         # 广播用户加入聊天室的消息
-        await self.room.pubsub_room_user_login(self.curr_user)
+        await self.room.pubsub_room_user_login(self.curr_user, room=self.room_id)
+        # 只给当前连接发送完整的在线用户列表，其他用户只收到上线的消息
+        await self.room.send_online_snapshot(self.curr_user, room=self.room_id)
 
     async def close_clean_user_websocket(self, code, websocket):
         # 资源释放处理
         await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
-        if self.room:
+        if self.room and self.curr_user:
             self.room.user_out_logout_room(self.curr_user)
             # 删除连接
-            self.room.websocket_out_logout_room(self.curr_user, websocket=websocket)
+            self.room.websocket_out_logout_room(
+                self.curr_user, websocket=websocket, room=self.room_id
+            )
 
     async def clean_user_websocket(self, code, websocket):
         # 资源释放处理
         await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
-        if self.room:
+        if self.room and self.curr_user:
             self.room.user_out_logout_room(self.curr_user)
             # 删除连接
-            self.room.websocket_out_logout_room(self.curr_user, websocket=websocket)
+            self.room.websocket_out_logout_room(
+                self.curr_user, websocket=websocket, room=self.room_id
+            )
 
     async def on_receive(self, _websocket: WebSocket, msg: str):
         # 根据_websocket找到具体的用户
@@ -111,17 +125,26 @@ class ChatRoomWebSocket(WebSocketEndpoint):
             )
 
         # 广播消息
-        await self.room.pubsub_user_send_message(self.curr_user, message=msg)
+        await self.room.pubsub_user_send_message(
+            self.curr_user, message=msg, room=self.room_id
+        )
         # await self.room.broadcast_user_send_message(self.curr_user, msg)
 
     async def on_disconnect(self, _websocket: WebSocket, _close_code: int):
         pass
+        if self.curr_user is None:
+            return
         # 要及时删除已关闭的连接
+        if not self.room.websocket_out_logout_room(
+            self.curr_user, websocket=_websocket, room=self.room_id
+        ):
+            # 已经被新连接替换的旧连接，用户还在线，不能发布退出房间的消息
+            return
         self.room.user_out_logout_room(self.curr_user)
-        # 删除连接
-        self.room.websocket_out_logout_room(self.curr_user, websocket=_websocket)
 
-        await self.room.pubsub_room_user_logout(self.curr_user, message=None)
+        await self.room.pubsub_room_user_logout(
+            self.curr_user, message=None, room=self.room_id
+        )
 
         # # 广播某用户退出房间的消息
         # await self.room.broadcast_room_user_logout(self.curr_user)
@@ -32,6 +32,8 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     pass
+    # 停止订阅并关闭redis连接
+    await app.state.room_connection.close_pubsub()
 
 
 # 注册路由
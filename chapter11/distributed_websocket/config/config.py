@@ -7,6 +7,12 @@ class Settings(BaseSettings):
     ASYNC_DATABASE_URI: str = "sqlite+aiosqlite:///chat.db"
     # 定义TOEKN的签名信息值
     TOKEN_SIGN_SECRET: str = "ZcjT6Rcp1yIFQoS7"
+    # 每个WebSocket连接发送队列的最大消息数，超过时断开慢客户端
+    WS_SEND_QUEUE_SIZE: int = 256
+    # 单条消息发送的超时时间（秒），超时断开慢客户端
+    WS_SEND_TIMEOUT: float = 5
+    # 订阅频道时每批最多分发的消息数
+    WS_LISTEN_BATCH_SIZE: int = 500
 
 
 @lru_cache()
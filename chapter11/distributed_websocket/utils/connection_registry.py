@@ -0,0 +1,199 @@
+"""
+WebSocket连接的注册表和消息扇出
+
+以前所有连接存放在一个列表中（移除连接需要遍历），只有一个房间，广播时逐个
+await websocket.send_json，一个慢的客户端会卡住整个房间。这里：
+1：连接按 房间 -> 用户 建立索引，加入、离开都是O(1)，支持多个房间
+2：广播时每条消息只序列化一次，放入每个连接自己的发送队列后立即返回，
+   由每个连接各自的发送协程并发发送，广播耗时和最慢的客户端无关
+3：发送队列有上限，队列满了或者单次发送超时的慢客户端会被断开，不会无限占用内存
+"""
+import asyncio
+import json
+import logging
+import typing
+
+from fastapi import WebSocket, status
+
+from schemas import UserDistribute
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOM = "default"
+
+
+class ClientConnection:
+    """一个客户端连接和它的发送队列"""
+
+    __slots__ = ("registry", "room", "user", "websocket", "queue", "_task", "closed")
+
+    def __init__(
+        self,
+        registry: "ConnectionRegistry",
+        room: str,
+        user: UserDistribute,
+        websocket: WebSocket,
+    ):
+        self.registry = registry
+        self.room = room
+        self.user = user
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=registry.max_queue)
+        self.closed = False
+        self._task = asyncio.create_task(self._send_loop())
+
+    def enqueue(self, text: str) -> bool:
+        """放入发送队列，不会等待，队列满了返回False"""
+        if self.closed:
+            return True
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _send_loop(self):
+        loop = asyncio.get_running_loop()
+        sending = self.registry.sending
+        while True:
+            text = await self.queue.get()
+            # 发送超时由注册表统一检查，不需要每次发送都创建超时任务
+            sending[self] = loop.time()
+            try:
+                await self.websocket.send_text(text)
+            except Exception:
+                # 连接已经断开
+                self.close()
+                return
+            finally:
+                sending.pop(self, None)
+
+    def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        """停止发送并从注册表中移除，可以重复调用"""
+        if self.closed:
+            return
+        self.closed = True
+        self.registry.discard(self)
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        asyncio.create_task(self._close_websocket(code))
+
+    async def _close_websocket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class ConnectionRegistry:
+    """按 房间 -> 用户 索引的连接注册表"""
+
+    def __init__(self, max_queue: int = 256, send_timeout: float = 5.0):
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.rooms: typing.Dict[str, typing.Dict[str, ClientConnection]] = {}
+        # 正在发送消息的连接 {连接: 开始发送的时间}
+        self.sending: typing.Dict[ClientConnection, float] = {}
+        self._watchdog: typing.Optional[asyncio.Task] = None
+        # 统计信息
+        self.stats = {"broadcasts": 0, "enqueued": 0, "evicted": 0}
+
+    def add(
+        self, room: str, user: UserDistribute, websocket: WebSocket
+    ) -> ClientConnection:
+        old = self.get(room, user.phone_number)
+        if old is not None:
+            # 关闭旧连接时房间可能因为没有连接被删除，之后再获取房间
+            old.close()
+        connection = ClientConnection(self, room, user, websocket)
+        self.rooms.setdefault(room, {})[user.phone_number] = connection
+        if self._watchdog is None:
+            self._watchdog = asyncio.create_task(self._watch_send_timeout())
+        return connection
+
+    def remove(
+        self, room: str, user: UserDistribute, websocket: WebSocket = None
+    ) -> bool:
+        """
+        :return: 是否删除了用户当前的连接，旧连接（已被新连接替换）返回False
+        """
+        connection = self.get(room, user.phone_number)
+        # 同一个用户重新连接后，旧连接的断开不能删除新连接
+        if connection is None or (
+            websocket is not None and connection.websocket is not websocket
+        ):
+            return False
+        connection.close()
+        return True
+
+    def discard(self, connection: ClientConnection):
+        connections = self.rooms.get(connection.room)
+        if (
+            not connections
+            or connections.get(connection.user.phone_number) is not connection
+        ):
+            return
+        del connections[connection.user.phone_number]
+        if not connections:
+            del self.rooms[connection.room]
+
+    def get(self, room: str, phone_number: str) -> typing.Optional[ClientConnection]:
+        return self.rooms.get(room, {}).get(phone_number)
+
+    def users(self, room: str) -> typing.List[UserDistribute]:
+        return [
+            connection.user for connection in self.rooms.get(room, {}).values()
+        ]
+
+    def connection_count(self) -> int:
+        return sum(len(connections) for connections in self.rooms.values())
+
+    def send(self, room: str, phone_number: str, payload: typing.Dict) -> bool:
+        """只发送给房间内的某一个用户"""
+        connection = self.get(room, phone_number)
+        if connection is None:
+            return False
+        text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        if not connection.enqueue(text):
+            logger.warning("用户%s的发送队列已满，断开连接", phone_number)
+            self.stats["evicted"] += 1
+            connection.close(status.WS_1013_TRY_AGAIN_LATER)
+            return False
+        return True
+
+    def broadcast(self, room: str, payload: typing.Dict) -> int:
+        """
+        广播消息到房间内的所有连接，消息只序列化一次
+        :return: 放入发送队列的连接数量
+        """
+        connections = self.rooms.get(room)
+        if not connections:
+            return 0
+        text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        self.stats["broadcasts"] += 1
+        slow = []
+        for connection in connections.values():
+            if not connection.enqueue(text):
+                slow.append(connection)
+        for connection in slow:
+            # 发送队列满了的慢客户端直接断开
+            logger.warning("用户%s的发送队列已满，断开连接", connection.user.phone_number)
+            self.stats["evicted"] += 1
+            connection.close(status.WS_1013_TRY_AGAIN_LATER)
+        # 断开的慢客户端已经从 connections 中移除
+        sent = len(connections)
+        self.stats["enqueued"] += sent
+        return sent
+
+    async def _watch_send_timeout(self):
+        """断开单条消息发送超过 send_timeout 秒的慢客户端"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.send_timeout / 2)
+            now = loop.time()
+            for connection, start_time in list(self.sending.items()):
+                if now - start_time < self.send_timeout:
+                    continue
+                logger.warning("用户%s发送消息超时，断开连接", connection.user.phone_number)
+                self.stats["evicted"] += 1
+                connection.close(status.WS_1013_TRY_AGAIN_LATER)
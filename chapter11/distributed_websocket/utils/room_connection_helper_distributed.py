@@ -3,9 +3,10 @@ from schemas import UserDistribute
 import aioredis
 from aioredis import Redis
 from aioredis.client import PubSub
-import async_timeout
 import asyncio
 import datetime
+import json
+import logging
 
 # from faker import Faker
 from typing import List
@@ -13,14 +14,33 @@ from fastapi import WebSocket
 from pydantic import BaseModel
 from fastapi.concurrency import run_until_first_complete
 
+from config.config import get_settings
+from utils.connection_registry import ConnectionRegistry, DEFAULT_ROOM
+
 
 # fake = Faker(locale='zh_CN')
 
+logger = logging.getLogger(__name__)
+
+# 每个房间一个频道
+ROOM_CHANNEL_PREFIX = "chat:room:"
+# 每个房间的在线用户 {手机号: 用户名}
+ONLINE_KEY_PREFIX = "chat:online:"
+# 频道内的消息类型
+EVENT_USER_LOGIN = "chat：system_msg_user_login"
+EVENT_USER_LOGOUT = "chat：system_msg_user_logout"
+EVENT_USER_SEND_MSG = "chat：user_send_msg"
+# 发送给客户端的消息类型
+EVENT_TYPE_LOGIN = "system_msg_user_login"
+EVENT_TYPE_LOGOUT = "system_msg_user_logout"
+
 
 class MessageEvent(BaseModel):
     user: UserDistribute
     channel: str
     message: str = None
+    # 消息所属的房间
+    room: str = DEFAULT_ROOM
 
 
 class RoomConnectionManager:
@@ -29,12 +49,18 @@ class RoomConnectionManager:
     def __init__(self):
         # 仅仅存储是用户信息不保存对应WebSocket对象
         self._users_socket: Dict[str, UserDistribute] = {}
-        # 连接对象单独的划分存贮
-        self.active_connections: List[WebSocket] = []
-        # self.active_connections: Dict[str,WebSocket] = {}
+        # 连接对象单独的划分存贮，按 房间 -> 用户 索引，每个连接有自己的发送队列
+        settings = get_settings()
+        self.registry = ConnectionRegistry(
+            max_queue=settings.WS_SEND_QUEUE_SIZE,
+            send_timeout=settings.WS_SEND_TIMEOUT,
+        )
         # 当前服务启动的时候reids客户端对象
         self.redis: Optional[Redis] = None
         self.pubsub: Optional[PubSub] = None
+        self._listener: Optional[asyncio.Task] = None
+        # 每批最多分发的订阅消息数量
+        self.listen_batch_size = settings.WS_LISTEN_BATCH_SIZE
 
     async def register_pubsub(self):
         # 监听频道消息
@@ -43,193 +69,227 @@ class RoomConnectionManager:
                 "redis://localhost", encoding="utf-8", decode_responses=True
             )
         # 返回发布/订阅对象,使用pubsub才可以订阅频道并收听发布到的消息
-        self.pubsub = self.redis.pubsub()
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
 
     async def do_listacton(self):
-
-        await self.pubsub.subscribe(
-            "chat：system_room_update_userlist",
-            "chat：system_msg_user_login",
-            "chat：system_msg_user_logout",
-            "chat：user_send_msg",
-        )
-
-        async def reader(channel: aioredis.client.PubSub):
-            while True:
+        # 每个房间一个频道，用模式订阅所有房间的频道，新建的房间不需要单独订阅
+        self._listener = asyncio.create_task(self._listen_loop())
+
+    async def _listen_loop(self):
+        retry_delay = 0.5
+        resync = False
+        while True:
+            if self.pubsub is None:
+                # 连接断开后重新创建订阅对象，重新订阅
+                self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub = self.pubsub
+            try:
+                await pubsub.psubscribe(f"{ROOM_CHANNEL_PREFIX}*")
+                retry_delay = 0.5
+                if resync:
+                    # 断线期间可能错过了上下线的消息，重新发送本节点所有房间的在线列表
+                    for room in list(self.registry.rooms):
+                        await self.broadcast_system_room_update_userlist(room=room)
+                # 有消息时才会被唤醒，不需要轮询
+                async for message in pubsub.listen():
+                    batch = [message]
+                    # 一次取出已经到达的消息，批量分发
+                    while len(batch) < self.listen_batch_size:
+                        message = await pubsub.get_message(timeout=0)
+                        if message is None:
+                            break
+                        batch.append(message)
+                    self.dispatch_messages(batch)
+                    # 让连接的发送协程有机会执行
+                    await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("订阅聊天室消息异常，%s秒后重新订阅", retry_delay)
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+                resync = True
                 try:
-                    async with async_timeout.timeout(1):
-                        message = await channel.get_message(
-                            ignore_subscribe_messages=True
-                        )
-                        if message is not None:
-                            pass
-
-                            message_event: MessageEvent = MessageEvent.parse_raw(
-                                message["data"]
-                            )
-
-                            # 判断消息频道=====根据不同的频道
-                            if message_event.channel == "chat：system_msg_user_login":
-                                # 广播用户在线列表信息
-                                await self.broadcast_system_room_update_userlist()
-                                # 广播有用加入信息UserDistribute
-                                await self.broadcast_room_user_login(
-                                    curr_user=message_event.user
-                                )
-                            if message_event.channel == "chat：system_msg_user_logout":
-                                pass
-                                # await self.broadcast_user_send_message(self.curr_user, msg)
-                                # # 更新在线用户列表信息
-
-                                # # 广播某用户退出房间的消息
-                                await self.broadcast_room_user_logout(
-                                    leave_user=message_event.user
-                                )
-                                await self.broadcast_system_room_update_userlist()
-
-                            if message_event.channel == "chat：user_send_msg":
-                                pass
-                                await self.broadcast_user_send_message(
-                                    curr_user=message_event.user,
-                                    msg=message_event.message,
-                                )
-
-                        await asyncio.sleep(0.01)
-                except asyncio.TimeoutError:
+                    await pubsub.close()
+                except Exception:
                     pass
-
-        # await asyncio.create_task(reader(self.pubsub))
-        asyncio.create_task(reader(self.pubsub))
-
-    def close_pubsub(self):
+                self.pubsub = None
+
+    def dispatch_messages(self, messages: List[Dict]):
+        for message in messages:
+            room = message["channel"][len(ROOM_CHANNEL_PREFIX) :]
+            if room not in self.registry.rooms:
+                # 本节点没有这个房间的连接，不需要解析消息
+                continue
+            try:
+                event = json.loads(message["data"])
+                curr_user = UserDistribute(**event["user"])
+            except (ValueError, KeyError, TypeError):
+                logger.warning("忽略格式错误的聊天室消息：%s", message["data"])
+                continue
+            # 判断消息类型=====根据不同的类型广播
+            if event["channel"] == EVENT_USER_LOGIN:
+                # 只广播新加入的用户，客户端自己更新在线列表
+                self.registry.broadcast(
+                    room, self._user_payload(EVENT_TYPE_LOGIN, curr_user)
+                )
+            elif event["channel"] == EVENT_USER_LOGOUT:
+                self.registry.broadcast(
+                    room, self._user_payload(EVENT_TYPE_LOGOUT, curr_user)
+                )
+            elif event["channel"] == EVENT_USER_SEND_MSG:
+                self.registry.broadcast(
+                    room, self._send_message_payload(curr_user, event["message"])
+                )
+
+    async def close_pubsub(self):
         pass
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        if self.pubsub is not None:
+            await self.pubsub.close()
+            self.pubsub = None
         if self.redis:
-            self.redis.close()
+            await self.redis.close()
 
     def user_add_login_room(self, user: UserDistribute):
         # 添加当前连接到客户端用户到当前字典中
         if user.phone_number not in self._users_socket:
             self._users_socket[user.phone_number] = user
 
-    def websocket_add_login_room(self, user: UserDistribute, websocket: WebSocket):
-        # 添加当前连接到客户端用户到当前字典中
-        self.active_connections.append(websocket)
-        # self.active_connections[user.phone_number] = websocket
+    def websocket_add_login_room(
+        self, user: UserDistribute, websocket: WebSocket, room: str = DEFAULT_ROOM
+    ):
+        # 添加当前连接到房间中
+        self.registry.add(room, user, websocket)
 
     def user_out_logout_room(self, user: UserDistribute):
         # 在当前的字典从删除退出房间用户
         if user.phone_number in self._users_socket:
             del self._users_socket[user.phone_number]
 
-    def websocket_out_logout_room(self, user: UserDistribute, websocket: WebSocket):
-        # 添加当前连接到客户端用户到当前字典中
-        self.active_connections.remove(websocket)
-        # self.active_connections.pop(user.phone_number)
+    def websocket_out_logout_room(
+        self, user: UserDistribute, websocket: WebSocket, room: str = DEFAULT_ROOM
+    ) -> bool:
+        # 从房间中删除当前连接，返回False表示是已经被新连接替换的旧连接
+        return self.registry.remove(room, user, websocket)
 
     def check_user_logic(self, userlogin: UserDistribute):
         if userlogin.phone_number in self._users_socket:
             return True
         return False
 
-    # async def pubsub_system_room_update_userlist(self, user: UserDistribute, message: str):
-    #     if self.redis:
-    #         enevt = MessageEvent(user=user, message=message)
-    #         # 发布消息新增用户进入房间的消息
-    #         await self.redis.publish("chat：system_room_update_userlist", enevt.json())
+    async def _publish(self, room: str, enevt: MessageEvent, online_command=None):
+        # 发布到房间的频道，同时维护房间的在线用户（所有节点共享）
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if online_command is not None:
+                online_command(pipe, f"{ONLINE_KEY_PREFIX}{room}")
+            pipe.publish(f"{ROOM_CHANNEL_PREFIX}{room}", enevt.json())
+            await pipe.execute()
 
     async def pubsub_room_user_login(
-        self, user: UserDistribute, channel: str = "chat：system_msg_user_login"
+        self,
+        user: UserDistribute,
+        channel: str = EVENT_USER_LOGIN,
+        room: str = DEFAULT_ROOM,
     ):
         pass
         if self.redis:
-            enevt = MessageEvent(user=user, channel=channel, message=None)
-            # print("消息了吗？", enevt)
+            enevt = MessageEvent(user=user, channel=channel, message=None, room=room)
             # 发布消息新增用户进入房间的消息
-            await self.redis.publish(channel=channel, message=enevt.json())
+            await self._publish(
+                room,
+                enevt,
+                lambda pipe, key: pipe.hset(key, user.phone_number, user.username),
+            )
 
     async def pubsub_room_user_logout(
         self,
         user: UserDistribute,
-        channel: str = "chat：system_msg_user_logout",
+        channel: str = EVENT_USER_LOGOUT,
         message: str = None,
+        room: str = DEFAULT_ROOM,
     ):
         pass
         if self.redis:
-            enevt = MessageEvent(user=user, channel=channel, message=message)
-            # 发布消息新增用户进入房间的消息
-            await self.redis.publish(channel=channel, message=enevt.json())
+            enevt = MessageEvent(
+                user=user, channel=channel, message=message, room=room
+            )
+            # 发布消息用户退出房间的消息
+            await self._publish(
+                room, enevt, lambda pipe, key: pipe.hdel(key, user.phone_number)
+            )
 
     async def pubsub_user_send_message(
         self,
         user: UserDistribute,
-        channel: str = "chat：user_send_msg",
+        channel: str = EVENT_USER_SEND_MSG,
         message: str = None,
+        room: str = DEFAULT_ROOM,
     ):
         if self.redis:
             enevt = MessageEvent(
-                user=user, channel="chat：user_send_msg", message=message
-            )
-            # 发布消息新增用户进入房间的消息
-            await self.redis.publish(channel=channel, message=enevt.json())
-
-    async def broadcast_system_room_update_userlist(self):
-        # 循环调用用户里面的连接对象发送广播
-        user_online_list = [
-            f"{user.username}({user.phone_number})"
-            for userid, user in self._users_socket.items()
-        ]
-        # for key,websocket in self.active_connections.items():
-        for websocket in self.active_connections:
-            await websocket.send_json(
-                {
-                    "type": "system_room_update_userlist",
-                    "data": {"users_list": user_online_list},
-                }
+                user=user, channel=EVENT_USER_SEND_MSG, message=message, room=room
             )
+            # 发布用户发送的消息
+            await self._publish(room, enevt)
+
+    async def online_user_list(self, room: str = DEFAULT_ROOM) -> List[str]:
+        users = await self.redis.hgetall(f"{ONLINE_KEY_PREFIX}{room}")
+        return [f"{username}({phone_number})" for phone_number, username in users.items()]
+
+    async def send_online_snapshot(self, user: UserDistribute, room: str = DEFAULT_ROOM):
+        # 只给新加入的连接发送完整的在线列表，其他连接只接收上下线的变化
+        self.registry.send(
+            room,
+            user.phone_number,
+            {
+                "type": "system_room_update_userlist",
+                "data": {"users_list": await self.online_user_list(room)},
+            },
+        )
 
-    async def broadcast_room_user_login(self, curr_user: UserDistribute):
-        # 循环调用用户里面的连接对象发送广播
-        for websocket in self.active_connections:
-            # 广播当前登入的用户的信息
-            await websocket.send_json(
-                {
-                    "type": "system_msg_user_login",
-                    "data": {
-                        "phone_number": self._users_socket[
-                            curr_user.phone_number
-                        ].phone_number,
-                        "username": self._users_socket[curr_user.phone_number].username,
-                    },
-                }
-            )
+    async def broadcast_system_room_update_userlist(self, room: str = DEFAULT_ROOM):
+        # 消息只序列化一次，放入房间内每个连接的发送队列，不等待发送完成
+        self.registry.broadcast(
+            room,
+            {
+                "type": "system_room_update_userlist",
+                "data": {"users_list": await self.online_user_list(room)},
+            },
+        )
 
-    async def broadcast_room_user_logout(self, leave_user):
-        for websocket in self.active_connections:
-            await websocket.send_json(
-                {
-                    "type": "system_msg_user_logout",
-                    "data": {
-                        "phone_number": leave_user.phone_number,
-                        "username": leave_user.username,
-                    },
-                }
-            )
+    @staticmethod
+    def _user_payload(event_type: str, user: UserDistribute) -> Dict:
+        return {
+            "type": event_type,
+            "data": {"phone_number": user.phone_number, "username": user.username},
+        }
+
+    @staticmethod
+    def _send_message_payload(curr_user: UserDistribute, msg: str) -> Dict:
+        return {
+            "type": "user_send_msg",
+            "data": {
+                "phone_number": curr_user.phone_number,
+                "username": curr_user.username,
+                "msg": f"{curr_user.username}说：{msg}",
+                "datetime": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            },
+        }
+
+    async def broadcast_room_user_login(
+        self, curr_user: UserDistribute, room: str = DEFAULT_ROOM
+    ):
+        # 广播当前登入的用户的信息，用户可能是在其他节点登入的
+        self.registry.broadcast(room, self._user_payload(EVENT_TYPE_LOGIN, curr_user))
 
-    async def broadcast_user_send_message(self, curr_user: UserDistribute, msg: str):
-        # 提取是否属于我自己的发言信息
-        for websocket in self.active_connections:
-            # 判断处理是否我自己发出的消息
-            sendmsg = f"{curr_user.username}说：{msg}"
-            await websocket.send_json(
-                {
-                    "type": "user_send_msg",
-                    "data": {
-                        "phone_number": curr_user.phone_number,
-                        "username": curr_user.username,
-                        "msg": sendmsg,
-                        "datetime": datetime.datetime.now().strftime(
-                            "%Y-%m-%d %H:%M:%S"
-                        ),
-                    },
-                }
-            )
+    async def broadcast_room_user_logout(self, leave_user, room: str = DEFAULT_ROOM):
+        self.registry.broadcast(room, self._user_payload(EVENT_TYPE_LOGOUT, leave_user))
+
+    async def broadcast_user_send_message(
+        self, curr_user: UserDistribute, msg: str, room: str = DEFAULT_ROOM
+    ):
+        self.registry.broadcast(room, self._send_message_payload(curr_user, msg))
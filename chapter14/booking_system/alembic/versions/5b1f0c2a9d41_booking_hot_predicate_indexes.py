@@ -0,0 +1,81 @@
+"""booking hot predicate indexes
+
+Revision ID: 5b1f0c2a9d41
+Revises:
+Create Date: 2022-06-20 10:12:31.408213
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5b1f0c2a9d41"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 预约订单表数据量大，使用 CONCURRENTLY 创建索引，不阻塞线上的写入；
+    # CONCURRENTLY 不能在事务中执行，所以放在 autocommit_block 里面
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_doctor_subscribeinfo_uopenid_statue_id",
+            "doctor_subscribeinfo",
+            ["visit_uopenid", "statue", "id"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # 只包含未支付订单的部分索引
+        op.create_index(
+            "ix_doctor_subscribeinfo_unpay_uopenid",
+            "doctor_subscribeinfo",
+            ["visit_uopenid"],
+            postgresql_where=sa.text("statue = 1"),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_doctor_subscribeinfo_dno_orderid_uopenid",
+            "doctor_subscribeinfo",
+            ["dno", "orderid", "visit_uopenid"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_doctor_scheduling_dno_enable_dnotime",
+            "doctor_scheduling",
+            ["dno", "enable", "dnotime"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_doctor_scheduling_dno_enable_dnotime",
+            table_name="doctor_scheduling",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.drop_index(
+            "ix_doctor_subscribeinfo_dno_orderid_uopenid",
+            table_name="doctor_subscribeinfo",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.drop_index(
+            "ix_doctor_subscribeinfo_unpay_uopenid",
+            table_name="doctor_subscribeinfo",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.drop_index(
+            "ix_doctor_subscribeinfo_uopenid_statue_id",
+            table_name="doctor_subscribeinfo",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
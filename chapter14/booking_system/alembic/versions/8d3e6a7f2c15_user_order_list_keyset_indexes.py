@@ -0,0 +1,67 @@
+"""user order list keyset indexes
+
+Revision ID: 8d3e6a7f2c15
+Revises: 5b1f0c2a9d41
+Create Date: 2022-06-24 15:40:12.127301
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8d3e6a7f2c15"
+down_revision = "5b1f0c2a9d41"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 用户订单列表改为按 (create_time, id) 游标分页，索引需要包含排序的字段
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_doctor_subscribeinfo_uopenid_statue_ctime_id",
+            "doctor_subscribeinfo",
+            ["visit_uopenid", "statue", "create_time", "id"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # 不传订单状态时查询全部状态的订单
+        op.create_index(
+            "ix_doctor_subscribeinfo_uopenid_ctime_id",
+            "doctor_subscribeinfo",
+            ["visit_uopenid", "create_time", "id"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # 被上面的索引替代
+        op.drop_index(
+            "ix_doctor_subscribeinfo_uopenid_statue_id",
+            table_name="doctor_subscribeinfo",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_doctor_subscribeinfo_uopenid_statue_id",
+            "doctor_subscribeinfo",
+            ["visit_uopenid", "statue", "id"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.drop_index(
+            "ix_doctor_subscribeinfo_uopenid_ctime_id",
+            table_name="doctor_subscribeinfo",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.drop_index(
+            "ix_doctor_subscribeinfo_uopenid_statue_ctime_id",
+            table_name="doctor_subscribeinfo",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
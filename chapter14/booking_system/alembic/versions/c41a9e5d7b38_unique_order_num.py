@@ -0,0 +1,55 @@
+"""unique order num
+
+Revision ID: c41a9e5d7b38
+Revises: 8d3e6a7f2c15
+Create Date: 2022-06-27 11:05:46.532017
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c41a9e5d7b38"
+down_revision = "8d3e6a7f2c15"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 订单编号同时作为微信支付的 out_trade_no，需要保证唯一；
+    # 执行前需要先处理历史数据中重复的订单编号，否则创建唯一索引会失败
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ux_doctor_subscribeinfo_orderid",
+            "doctor_subscribeinfo",
+            ["orderid"],
+            unique=True,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # 被上面的唯一索引替代
+        op.drop_index(
+            "ix_doctor_subscribeinfo_orderid",
+            table_name="doctor_subscribeinfo",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_doctor_subscribeinfo_orderid",
+            "doctor_subscribeinfo",
+            ["orderid"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.drop_index(
+            "ux_doctor_subscribeinfo_orderid",
+            table_name="doctor_subscribeinfo",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
@@ -0,0 +1,39 @@
+"""scheduling calendar index
+
+Revision ID: e2b7f4a1c963
+Revises: c41a9e5d7b38
+Create Date: 2022-06-29 09:48:20.615734
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e2b7f4a1c963"
+down_revision = "c41a9e5d7b38"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 排班日历按日期汇总所有医生的排班，不带医生编号，用不上 (dno, enable, dnotime) 索引
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_doctor_scheduling_enable_dnotime",
+            "doctor_scheduling",
+            ["enable", "dnotime"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_doctor_scheduling_enable_dnotime",
+            table_name="doctor_scheduling",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
@@ -1,11 +1,16 @@
-from fastapi import Depends
+from fastapi import Depends, Query, Request
+from fastapi.responses import StreamingResponse
 from apis.doctor.repository import DoctorServeries
 from db.async_database import depends_get_db_session
 from db.async_database import AsyncSession
 from exts.responses.json_response import Success, Fail
 from apis.doctor.api import router_docrot
-from apis.doctor.schemas import SchedulingInfo
+from apis.doctor.schemas import SchedulingInfo, SchedulingCalendarForm
 from utils.datatime_helper import diff_days_for_now_time
+from config.config import get_settings
+from exts.stock_push import stock_push_hub
+import orjson
+import datetime
 
 
 @router_docrot.get("/doctor_list", summary="获取可以预约医生列表信息")
@@ -15,7 +20,7 @@ async def callbadk(db_session: AsyncSession = Depends(depends_get_db_session)):
     :param db_session: 数据库连接依赖注入对象\n\n
     :return: 返回可以预约医生列表信息\n\n
     """
-    info = await DoctorServeries.get_doctor_list_infos(db_session)
+    info = await DoctorServeries.get_doctor_list_infos_cache(db_session)
     return Success(result=info)
 
 
@@ -34,19 +39,19 @@ async def callbadk(
             return Fail(message="当前日期无效,日期格式错误!")
     # 查询排班信息
     doctor_result, doctor_scheduling_result = (
-        await DoctorServeries.get_doctor_scheduling_info(
+        await DoctorServeries.get_doctor_scheduling_info_cache(
             db_session, dno=forms.dno, start_time=forms.start_time
         )
     )
     scheduling_info = {}
     for item in doctor_scheduling_result:
-        if item.ampm == "am":
+        if item["ampm"] == "am":
             if "am" not in scheduling_info:
                 scheduling_info["am"] = []
                 scheduling_info["am"].append(item)
             else:
                 scheduling_info["am"].append(item)
-        if item.ampm == "pm":
+        if item["ampm"] == "pm":
             if "pm" not in scheduling_info:
                 scheduling_info["pm"] = []
                 scheduling_info["pm"].append(item)
@@ -56,3 +61,73 @@ async def callbadk(
     return (
         Success(result=backinfo) if doctor_result else Fail(message="当前医生信息信息")
     )
+
+
+@router_docrot.post("/doctor_scheduling_calendar", summary="获取多个医生多天的排班日历")
+async def callbadk(
+    forms: SchedulingCalendarForm,
+    db_session: AsyncSession = Depends(depends_get_db_session),
+):
+    """
+    一次返回多个医生多天的排班日历，每天分上午、下午汇总号源数和剩余库存\n\n
+    :return: {"calendar": {医生编号: {日期: {"am": {...}, "pm": {...}}}}}\n\n
+    """
+    if forms.start_time:
+        try:
+            start_time = datetime.datetime.strptime(forms.start_time, "%Y-%m-%d").date()
+        except ValueError:
+            return Fail(message="当前日期无效,日期格式错误!")
+        # 当前系统日期对比，超过系统时间预约信息则无法查询
+        if diff_days_for_now_time(forms.start_time) < 0:
+            return Fail(message="当前日期无效,无排班信息!")
+    else:
+        start_time = datetime.date.today()
+    calendar = await DoctorServeries.get_doctor_scheduling_calendar_cache(
+        db_session,
+        # 去重并保持顺序
+        dnos=list(dict.fromkeys(forms.dnos)),
+        start_time=start_time,
+        days=forms.days,
+        ttl=get_settings().SCHEDULING_CALENDAR_CACHE_TTL,
+    )
+    return Success(
+        result={
+            "start_time": str(start_time),
+            "days": forms.days,
+            "calendar": calendar,
+        }
+    )
+
+
+@router_docrot.get("/doctor_stock_stream", summary="订阅医生号源库存的实时变化（SSE）")
+async def callbadk(
+    request: Request,
+    dnos: str = Query(..., min_length=1, description="医生编号，多个用逗号分隔"),
+):
+    """
+    号源库存变化时推送 event: stock，数据为 {号源编号: {"dno": 医生编号, "nsnumstock": 库存}}，
+    没有变化时定时发送心跳注释，客户端使用 EventSource 订阅即可，不需要再轮询排班接口\n\n
+    """
+    dno_list = [dno for dno in dnos.split(",")[:100] if dno]
+
+    async def event_stream():
+        # 在生成器里面订阅，客户端在开始推送前断开时不会留下没有取消的订阅
+        subscription = stock_push_hub.subscribe(dno_list)
+        try:
+            # 让浏览器断线后1秒重连
+            yield b"retry: 1000\n\n"
+            while not await request.is_disconnected():
+                changes = await subscription.get(timeout=stock_push_hub.heartbeat_interval)
+                if changes is None:
+                    yield b": ping\n\n"
+                    continue
+                yield b"event: stock\ndata: " + orjson.dumps(changes) + b"\n\n"
+        finally:
+            stock_push_hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # 关闭nginx的缓冲，保证及时推送
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
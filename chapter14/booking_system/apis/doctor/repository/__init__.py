@@ -1,8 +1,62 @@
-from sqlalchemy import select, update, delete
+from sqlalchemy import (
+    select,
+    update,
+    delete,
+    values,
+    column,
+    func,
+    exists,
+    and_,
+    literal,
+    Integer,
+    Text,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
 from db.models import Doctorinfo, DoctorScheduling, DoctorSubscribeinfo
-from typing import Optional
+from typing import Optional, Dict, List, NamedTuple, Tuple
+from decimal import Decimal
 from utils.datatime_helper import str_to_datatime, datatime_to_str, datetime
+from exts.read_cache import read_cache
+from exts.stock_push import stock_push_hub
+
+
+class DoctorRecord(NamedTuple):
+    """预约下单用到的医生信息"""
+
+    dno: str
+    dnname: str
+    pic: str
+    rank: str
+    addr: str
+    fee: Decimal
+
+
+class NsindexSchedulingRecord(NamedTuple):
+    """某个号源时段的排班信息"""
+
+    nsindex: str
+    ampm: str
+    dnotime: datetime.date
+    nsnum: int
+    nsnumstock: int
+    tiempm: datetime.datetime
+    tiemampmstr: str
+
+
+class RestockRecord(NamedTuple):
+    """回补后的号源库存"""
+
+    dno: str
+    nsindex: str
+    nsnumstock: int
+
+
+class DoctorNsindexSchedulingRecord(NamedTuple):
+    """医生信息、号源排班信息以及预约人是否有未支付订单，一次查询返回"""
+
+    doctor: Optional[DoctorRecord]
+    scheduling: Optional[NsindexSchedulingRecord]
+    has_unpay_order: bool
 
 
 class DoctorServeries:
@@ -36,9 +90,15 @@ class DoctorServeries:
         :param end_time:  当前医生的排班截止时间点 默认查询当天的时间排班
         :return:
         """
-        # 获取排班信息
-        # 查询出当前医生的信息
-        query = select(
+        if start_time:
+            # 格式化时间处理
+            start_time = str_to_datatime(start_time)
+        else:
+            start_time = str_to_datatime(datatime_to_str(datetime.datetime.now()))
+        end_time = start_time + datetime.timedelta(days=1)
+
+        # 医生信息和排班信息一次查询：医生 LEFT JOIN 当天的排班，没有排班时也能返回医生信息
+        doctor_columns = (
             Doctorinfo.dno,
             Doctorinfo.dnname,
             Doctorinfo.destag,
@@ -46,105 +106,391 @@ class DoctorServeries:
             Doctorinfo.rank,
             Doctorinfo.describe,
         )
-        _result = await async_session.execute(
-            query.where(Doctorinfo.enable == enable, Doctorinfo.dno == dno)
+        scheduling_columns = (
+            DoctorScheduling.nsindex,
+            DoctorScheduling.nsnum,
+            DoctorScheduling.ampm,
+            DoctorScheduling.dnotime,
+            DoctorScheduling.tiempm,
+            DoctorScheduling.nsnumstock,
+            DoctorScheduling.tiemampmstr,
         )
-        doctor_result: Optional[Doctorinfo] = _result.first()
-        # 再查询当前医生下面分开上午 和下午的排班信息
-        doctor_scheduling_result = []
-        if doctor_result:
-            query = select(
-                DoctorScheduling.nsindex,
-                DoctorScheduling.nsnum,
-                DoctorScheduling.ampm,
-                DoctorScheduling.dnotime,
-                DoctorScheduling.tiempm,
-                DoctorScheduling.nsnumstock,
-                DoctorScheduling.tiemampmstr,
-            )
-            # 查询当前医生排班信息归属
-            query = query.where(
-                DoctorScheduling.enable == enable, DoctorScheduling.dno == dno
+        query = (
+            select(*doctor_columns, *scheduling_columns)
+            .select_from(Doctorinfo)
+            .outerjoin(
+                DoctorScheduling,
+                and_(
+                    DoctorScheduling.dno == Doctorinfo.dno,
+                    DoctorScheduling.enable == enable,
+                    DoctorScheduling.dnotime >= start_time,
+                    DoctorScheduling.dnotime < end_time,
+                ),
             )
+            .where(Doctorinfo.enable == enable, Doctorinfo.dno == dno)
+        )
+        _result = await async_session.execute(query)
+        rows = _result.all()
+        if not rows:
+            return None, []
+        doctor_keys = [item.key for item in doctor_columns]
+        scheduling_keys = [item.key for item in scheduling_columns]
+        doctor_result = {key: rows[0]._mapping[key] for key in doctor_keys}
+        doctor_scheduling_result = [
+            {key: row._mapping[key] for key in scheduling_keys}
+            for row in rows
+            # LEFT JOIN 没有排班时排班的字段都为NULL
+            if row.nsindex is not None
+        ]
+        return doctor_result, doctor_scheduling_result
 
-            if start_time:
-                # 格式化时间处理
-                start_time = str_to_datatime(start_time)
-                end_time = str_to_datatime(
-                    datatime_to_str((start_time + datetime.timedelta(days=1)))
-                )
-            else:
-                # 格式化时间处理
-                start_time = str_to_datatime(datatime_to_str(datetime.datetime.now()))
-                end_time = str_to_datatime(
-                    datatime_to_str(
-                        (datetime.datetime.now() + datetime.timedelta(days=1))
-                    )
-                )
+    @staticmethod
+    async def get_doctor_list_infos_cache(async_session: AsyncSession, enable: int = 1):
+        """医生列表信息，读穿缓存"""
 
-            query = query.where(
-                DoctorScheduling.dnotime >= start_time,
-                DoctorScheduling.dnotime < end_time,
+        async def loader():
+            result = await DoctorServeries.get_doctor_list_infos(
+                async_session, enable=enable
             )
+            return [dict(item._mapping) for item in result]
 
-            _result = await async_session.execute(query)
-            doctor_scheduling_result = _result.all()
-        return doctor_result, doctor_scheduling_result
+        return await read_cache.get_or_load(f"doctor:list:{enable}", loader)
 
     @staticmethod
-    async def get_doctor_curr_nsindex_scheduling_info(
-        async_session: AsyncSession, dno, nsindex, enable: int = 1
+    async def get_doctor_scheduling_info_cache(
+        async_session: AsyncSession, dno, enable: int = 1, start_time=None
     ):
-        query = select(
-            Doctorinfo.dno,
-            Doctorinfo.dnname,
-            Doctorinfo.pic,
-            Doctorinfo.rank,
-            Doctorinfo.addr,
-            Doctorinfo.fee,
+        """
+        医生排班信息：医生信息和排班时段等静态信息走缓存，号源库存每次实时查询
+        :return: 医生信息, 排班信息列表（字典）
+        """
+        day = start_time or datatime_to_str(datetime.datetime.now())
+
+        async def loader():
+            doctor_result, doctor_scheduling_result = (
+                await DoctorServeries.get_doctor_scheduling_info(
+                    async_session, dno=dno, enable=enable, start_time=day
+                )
+            )
+            scheduling = []
+            for item in doctor_scheduling_result:
+                # 库存不缓存
+                item.pop("nsnumstock", None)
+                scheduling.append(item)
+            return {"doctor": doctor_result, "scheduling": scheduling}
+
+        cached = await read_cache.get_or_load(
+            f"doctor:scheduling:{dno}:{enable}:{day}", loader
         )
-        _result = await async_session.execute(
-            query.where(Doctorinfo.enable == enable, Doctorinfo.dno == dno)
+        scheduling = cached["scheduling"]
+        nsnumstocks = await DoctorServeries.get_nsnumstock_by_nsindexs(
+            async_session, nsindexs=[item["nsindex"] for item in scheduling]
         )
-        doctor_result: Optional[Doctorinfo] = _result.first()
-        # 再查询当前医生下面分开上午 和下午的排班信息
-        doctor_nsnuminfo_result: Optional[DoctorScheduling] = None
-        if doctor_result:
-            query = select(
-                DoctorScheduling.nsindex,
-                DoctorScheduling.ampm,
+        # 缓存里的对象是共享的，合并库存时需要复制
+        return cached["doctor"], [
+            dict(item, nsnumstock=nsnumstocks.get(item["nsindex"])) for item in scheduling
+        ]
+
+    @staticmethod
+    async def get_scheduling_calendar_aggregate(
+        async_session: AsyncSession, days: List[datetime.date], enable: int = 1
+    ) -> Dict[str, Dict[str, Dict]]:
+        """
+        按天、上下午汇总所有医生的排班号源情况，一次分组查询：
+        SELECT dnotime, dno, ampm, count(*), sum(nsnum), sum(nsnumstock),
+               count(*) FILTER (WHERE nsnumstock > 0)
+        FROM doctor_scheduling WHERE enable = ? AND dnotime IN (...)
+        GROUP BY dnotime, dno, ampm
+        :param days: 需要汇总的日期列表
+        :return: {日期: {医生编号: {ampm: 汇总信息}}}
+        """
+        query = (
+            select(
                 DoctorScheduling.dnotime,
-                DoctorScheduling.nsnum,
-                DoctorScheduling.nsnumstock,
-                DoctorScheduling.tiempm,
-                DoctorScheduling.tiemampmstr,
+                DoctorScheduling.dno,
+                DoctorScheduling.ampm,
+                func.count().label("slots"),
+                func.sum(DoctorScheduling.nsnum).label("nsnum"),
+                func.sum(DoctorScheduling.nsnumstock).label("nsnumstock"),
+                func.count()
+                .filter(DoctorScheduling.nsnumstock > 0)
+                .label("available_slots"),
             )
-            # 查询当前医生排班信息归属
-            query = query.where(
+            .where(
                 DoctorScheduling.enable == enable,
-                DoctorScheduling.dno == dno,
-                DoctorScheduling.nsindex == nsindex,
+                DoctorScheduling.dnotime.in_(days),
+            )
+            .group_by(
+                DoctorScheduling.dnotime, DoctorScheduling.dno, DoctorScheduling.ampm
+            )
+        )
+        _result = await async_session.execute(query)
+        calendar = {datatime_to_str(day): {} for day in days}
+        for row in _result.all():
+            calendar[datatime_to_str(row.dnotime)].setdefault(row.dno, {})[
+                row.ampm
+            ] = {
+                "slots": row.slots,
+                "available_slots": row.available_slots,
+                "nsnum": int(row.nsnum or 0),
+                "nsnumstock": int(row.nsnumstock or 0),
+                # is_reserve -属性 1:表示可以点击预约  2：有排班记录，但是已预约满
+                "is_reserve": 1 if row.available_slots else 2,
+            }
+        return calendar
+
+    @staticmethod
+    async def get_doctor_scheduling_calendar_cache(
+        async_session: AsyncSession,
+        dnos: List[str],
+        start_time: datetime.date,
+        days: int = 7,
+        enable: int = 1,
+        ttl: float = None,
+    ) -> Dict[str, Dict[str, Dict]]:
+        """
+        多个医生多天的排班日历，按天缓存所有医生的汇总信息，
+        未命中缓存的日期合并为一次分组查询
+        :param ttl: 缓存过期时间，汇总信息包含库存，需要比较短的过期时间
+        :return: {医生编号: {日期: {ampm: 汇总信息}}}，没有排班的日期不返回
+        """
+        day_list = [start_time + datetime.timedelta(days=i) for i in range(days)]
+        keys = {f"doctor:calendar:{enable}:{datatime_to_str(day)}": day for day in day_list}
+
+        async def loader(missing_keys):
+            calendar = await DoctorServeries.get_scheduling_calendar_aggregate(
+                async_session, days=[keys[key] for key in missing_keys], enable=enable
+            )
+            return {key: calendar[datatime_to_str(keys[key])] for key in missing_keys}
+
+        cached = await read_cache.get_many_or_load(
+            list(keys), loader, local_ttl=ttl, redis_ttl=ttl
+        )
+        result = {dno: {} for dno in dnos}
+        for key, day in keys.items():
+            day_calendar = cached.get(key) or {}
+            for dno in dnos:
+                if dno in day_calendar:
+                    result[dno][datatime_to_str(day)] = day_calendar[dno]
+        return result
+
+    @staticmethod
+    async def get_nsnumstock_by_nsindexs(
+        async_session: AsyncSession, nsindexs: List[str]
+    ) -> Dict[str, int]:
+        """批量查询号源的实时库存"""
+        if not nsindexs:
+            return {}
+        _result = await async_session.execute(
+            select(DoctorScheduling.nsindex, DoctorScheduling.nsnumstock).where(
+                DoctorScheduling.nsindex.in_(nsindexs)
             )
+        )
+        return {item.nsindex: item.nsnumstock for item in _result.all()}
+
+    @staticmethod
+    async def invalidate_doctor_cache(dno=None):
+        """
+        医生信息或排班信息变更后调用，清理对应的缓存；号源库存不缓存，库存变更不需要调用
+        :param dno: 只清理这个医生的排班缓存，为None时清理所有医生相关的缓存
+        """
+        if dno is None:
+            await read_cache.invalidate_prefix("doctor:")
+            return
+        await read_cache.invalidate_prefix("doctor:list:")
+        await read_cache.invalidate_prefix(f"doctor:scheduling:{dno}:")
+        # 排班日历按天缓存了所有医生的信息
+        await read_cache.invalidate_prefix("doctor:calendar:")
 
-            _result = await async_session.execute(query)
-            doctor_nsnuminfo_result = _result.first()
+    @staticmethod
+    async def get_doctor_nsindex_scheduling_record(
+        async_session: AsyncSession, dno, nsindex, visit_uopenid=None, enable: int = 1
+    ) -> DoctorNsindexSchedulingRecord:
+        """
+        一次查询返回医生信息、号源排班信息，传入visit_uopenid时同时判断预约人是否有未支付的订单：
+        SELECT d.*, s.*, EXISTS(SELECT 1 FROM doctor_subscribeinfo WHERE visit_uopenid = ? AND statue = 1)
+        FROM doctorinfo d LEFT JOIN doctor_scheduling s ON s.dno = d.dno AND s.nsindex = ? AND s.enable = ?
+        WHERE d.dno = ? AND d.enable = ?
+        :param async_session:
+        :param dno:
+        :param nsindex:
+        :param visit_uopenid: 可选，预约人openid
+        :param enable:
+        :return:
+        """
+        if visit_uopenid is not None:
+            # 订单状态（1:订单就绪，还没支付）
+            has_unpay_order = exists().where(
+                DoctorSubscribeinfo.visit_uopenid == visit_uopenid,
+                DoctorSubscribeinfo.statue == 1,
+            )
+        else:
+            has_unpay_order = literal(False)
+        query = (
+            select(
+                *[getattr(Doctorinfo, key) for key in DoctorRecord._fields],
+                *[
+                    getattr(DoctorScheduling, key)
+                    for key in NsindexSchedulingRecord._fields
+                ],
+                has_unpay_order.label("has_unpay_order"),
+            )
+            .select_from(Doctorinfo)
+            .outerjoin(
+                DoctorScheduling,
+                and_(
+                    DoctorScheduling.dno == Doctorinfo.dno,
+                    DoctorScheduling.nsindex == nsindex,
+                    DoctorScheduling.enable == enable,
+                ),
+            )
+            .where(Doctorinfo.enable == enable, Doctorinfo.dno == dno)
+        )
+        _result = await async_session.execute(query)
+        row = _result.first()
+        if row is None:
+            return DoctorNsindexSchedulingRecord(None, None, False)
+        # 按字段顺序切分，避免逐个字段按名称取值
+        doctor_size = len(DoctorRecord._fields)
+        scheduling_size = len(NsindexSchedulingRecord._fields)
+        scheduling = row[doctor_size : doctor_size + scheduling_size]
+        return DoctorNsindexSchedulingRecord(
+            doctor=DoctorRecord._make(row[:doctor_size]),
+            # LEFT JOIN 没有对应的号源时排班的字段都为NULL
+            scheduling=(
+                NsindexSchedulingRecord._make(scheduling)
+                if scheduling[0] is not None
+                else None
+            ),
+            has_unpay_order=bool(row[-1]),
+        )
 
-        return doctor_result, doctor_nsnuminfo_result
+    @staticmethod
+    async def get_doctor_curr_nsindex_scheduling_info(
+        async_session: AsyncSession, dno, nsindex, enable: int = 1
+    ) -> Tuple[Optional[DoctorRecord], Optional[NsindexSchedulingRecord]]:
+        record = await DoctorServeries.get_doctor_nsindex_scheduling_record(
+            async_session, dno=dno, nsindex=nsindex, enable=enable
+        )
+        return record.doctor, record.scheduling
 
     @staticmethod
     async def updata_nusnum_info_dno(
         async_session: AsyncSession, dno, nsindex, isup=True
     ):
-        response = update(DoctorSubscribeinfo).where(
-            DoctorScheduling.dno == dno, DoctorScheduling.nsindex == nsindex
-        )
+        """
+        号源库存变更：isup=True 表示占用一个号源（库存-1），False 表示释放一个号源（库存+1）
+        :param async_session:
+        :param dno:
+        :param nsindex:
+        :param isup:
+        :return: 变更后的库存数，None 表示变更失败（号源已约满或无需回补）
+        """
         if isup:
-            result = await async_session.execute(
-                response.values(use_nsnum=DoctorScheduling.use_nsnum + 1)
+            return await DoctorServeries.deduct_nsnumstock(
+                async_session, dno=dno, nsindex=nsindex
             )
-        else:
-            result = await async_session.execute(
-                response.values(use_nsnum=DoctorScheduling.use_nsnum - 1)
+        return await DoctorServeries.restock_nsnumstock(
+            async_session, dno=dno, nsindex=nsindex
+        )
+
+    @staticmethod
+    async def deduct_nsnumstock(
+        async_session: AsyncSession, dno, nsindex, enable: int = 1
+    ) -> Optional[int]:
+        """
+        原子扣减号源库存：
+        UPDATE doctor_scheduling SET nsnumstock = nsnumstock - 1
+        WHERE dno = ? AND nsindex = ? AND nsnumstock > 0 RETURNING nsnumstock
+        库存判断和扣减在同一条语句内完成，并发下不会超卖；扣减后立即提交，
+        避免在后续调用微信支付期间一直持有行锁，引起行锁排队。
+        :param async_session:
+        :param dno:
+        :param nsindex:
+        :param enable:
+        :return: 扣减后剩余库存数，None 表示库存不足扣减失败
+        """
+        query = (
+            update(DoctorScheduling)
+            .where(
+                DoctorScheduling.dno == dno,
+                DoctorScheduling.nsindex == nsindex,
+                DoctorScheduling.enable == enable,
+                DoctorScheduling.nsnumstock > 0,
             )
+            .values(nsnumstock=DoctorScheduling.nsnumstock - 1)
+            .returning(DoctorScheduling.nsnumstock)
+            .execution_options(synchronize_session=False)
+        )
+        _result = await async_session.execute(query)
+        nsnumstock = _result.scalar()
         await async_session.commit()
-        return result.rowcount
+        # 推送最新的库存给关注这个医生的客户端
+        stock_push_hub.publish(dno, nsindex, nsnumstock)
+        return nsnumstock
+
+    @staticmethod
+    async def restock_nsnumstock(
+        async_session: AsyncSession, dno, nsindex
+    ) -> Optional[int]:
+        """
+        回补号源库存（取消订单、超时未支付、下单失败），回补后的库存不会超过号源总数
+        :param async_session:
+        :param dno:
+        :param nsindex:
+        :return: 回补后的库存数，None 表示无需回补
+        """
+        query = (
+            update(DoctorScheduling)
+            .where(
+                DoctorScheduling.dno == dno,
+                DoctorScheduling.nsindex == nsindex,
+                DoctorScheduling.nsnumstock < DoctorScheduling.nsnum,
+            )
+            .values(nsnumstock=DoctorScheduling.nsnumstock + 1)
+            .returning(DoctorScheduling.nsnumstock)
+            .execution_options(synchronize_session=False)
+        )
+        _result = await async_session.execute(query)
+        nsnumstock = _result.scalar()
+        await async_session.commit()
+        # 推送最新的库存给关注这个医生的客户端
+        stock_push_hub.publish(dno, nsindex, nsnumstock)
+        return nsnumstock
+
+    @staticmethod
+    async def bulk_restock_nsnumstock(
+        async_session: AsyncSession, nsindex_counts: Dict[str, int]
+    ) -> List[RestockRecord]:
+        """
+        批量回补号源库存，同一个号源的多个订单合并为一次加法：
+        UPDATE doctor_scheduling SET nsnumstock = LEAST(nsnumstock + v.cnt, nsnum)
+        FROM (VALUES (:nsindex, :cnt), ...) AS v WHERE doctor_scheduling.nsindex = v.nsindex
+        注意这里不提交事务，需要和订单状态的更新在同一个事务里面提交
+        :param async_session:
+        :param nsindex_counts: {号源编号: 回补数量}
+        :return: 更新后的(dno, nsindex, nsnumstock)列表，提交事务后由调用方推送库存变化
+        """
+        if not nsindex_counts:
+            return []
+        restock_values = values(
+            column("nsindex", Text), column("cnt", Integer), name="restock"
+        ).data(list(nsindex_counts.items()))
+        query = (
+            update(DoctorScheduling)
+            .where(DoctorScheduling.nsindex == restock_values.c.nsindex)
+            .values(
+                nsnumstock=func.least(
+                    DoctorScheduling.nsnumstock + restock_values.c.cnt,
+                    DoctorScheduling.nsnum,
+                )
+            )
+            .returning(
+                DoctorScheduling.dno,
+                DoctorScheduling.nsindex,
+                DoctorScheduling.nsnumstock,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        result = await async_session.execute(query)
+        return [RestockRecord(*row) for row in result.all()]
@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from typing import List
+from pydantic import BaseModel, Field
 
 
 class SchedulingInfo(BaseModel):
@@ -8,6 +9,15 @@ class SchedulingInfo(BaseModel):
     start_time: str = None
 
 
+class SchedulingCalendarForm(BaseModel):
+    # 预约医生编号列表
+    dnos: List[str] = Field(..., min_items=1, max_items=100)
+    # 日历开始日期，默认当天
+    start_time: str = None
+    # 查询的天数
+    days: int = Field(7, ge=1, le=14)
+
+
 class MakeReserveOrderForm(BaseModel):
     # 预约医生编号
     dno: str
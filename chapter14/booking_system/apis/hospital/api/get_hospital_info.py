@@ -8,5 +8,5 @@ from ..api import router_hospital
 
 @router_hospital.get("/hospital_info", summary="获取医院信息")
 async def callbadk(db_session: AsyncSession = Depends(depends_get_db_session)):
-    info = await HospitalServeries.get_hospital_info(db_session, id=1)
+    info = await HospitalServeries.get_hospital_info_cache(db_session, id=1)
     return Success(result=info)
@@ -2,6 +2,7 @@ from sqlalchemy import select, update, delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from db.models import Hospitalinfo
 from db.async_database import async_engine, Base
+from exts.read_cache import read_cache
 
 
 class HospitalServeries:
@@ -16,3 +17,18 @@ class HospitalServeries:
         scalars_result = _result.first()
         # scalars_result = _result.scalars().first()
         return scalars_result
+
+    @staticmethod
+    async def get_hospital_info_cache(async_session: AsyncSession, id: int):
+        """医院信息，读穿缓存"""
+
+        async def loader():
+            result = await HospitalServeries.get_hospital_info(async_session, id=id)
+            return dict(result._mapping) if result else None
+
+        return await read_cache.get_or_load(f"hospital:info:{id}", loader)
+
+    @staticmethod
+    async def invalidate_hospital_cache(id: int):
+        """医院信息变更后调用，清理对应的缓存"""
+        await read_cache.invalidate(f"hospital:info:{id}")
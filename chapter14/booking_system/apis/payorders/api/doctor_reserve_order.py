@@ -1,6 +1,7 @@
 from fastapi import Depends
 from apis.payorders.repository import PayOrderServeries
 from apis.doctor.repository import DoctorServeries
+from apis.userorders.repository import Serveries as UserOrdersServeries
 from db.async_database import depends_get_db_session
 from db.async_database import AsyncSession
 from exts.responses.json_response import Success, Fail
@@ -11,15 +12,34 @@ from utils.datatime_helper import datetime
 from utils import ordernum_helper, json_helper
 from exts.wechatpy.pay import WeChatPay, WeChatPayException
 from config.config import get_settings
-from apis.payorders.dependencies import get_client_ip
+from apis.payorders.dependencies import get_client_ip, get_async_wx_pay
+from exts.wechatpy.pay.async_pay import AsyncWeChatPay
 
-# 初始化同步连接rabbitmq
-from exts.rabbit import sync_rabbit_client
-from exts.async_rabbit import async_rabbit_client
+# 订单超时的延时消息
+from exts.delay_scheduler import delay_scheduler
 import decimal
 from asgiref.sync import sync_to_async
 
 
+async def send_order_expire_publish(routing_key, order_info_json, message_ttl):
+    """
+    发送订单超时未支付的延时消息
+    :return: 是否发送成功
+    """
+    try:
+        return bool(
+            await delay_scheduler.send_delay_publish(
+                routing_key=routing_key,
+                body=order_info_json,
+                content_type="application/json",
+                message_ttl=message_ttl,
+            )
+        )
+    except Exception as ex:
+        print("订单超时延时消息发送失败", ex)
+        return False
+
+
 @router_payorders.post(
     "/doctor_reserve_order", summary="填写预约人员信息,处理订单的提交"
 )
@@ -27,12 +47,17 @@ async def callbadk(
     forms: PayReserveOrderForm,
     db_session: AsyncSession = Depends(depends_get_db_session),
     client_ip: str = Depends(get_client_ip),
+    wx_pay: AsyncWeChatPay = Depends(get_async_wx_pay),
 ):
-    # 检测是否没支付的订单信息，取消或支付后才可以继续操作预约
-    get_order_info = await PayOrderServeries.get_order_info_byvisit_uopenid_state(
-        db_session, visit_uopenid=forms.visit_uopenid, statue=1
+    # 未支付订单检测、医生信息、号源排班信息一次查询返回
+    reserve_record = await DoctorServeries.get_doctor_nsindex_scheduling_record(
+        db_session,
+        dno=forms.dno,
+        nsindex=forms.nsindex,
+        visit_uopenid=forms.visit_uopenid,
     )
-    if get_order_info:
+    # 检测是否没支付的订单信息，取消或支付后才可以继续操作预约
+    if reserve_record.has_unpay_order:
         return Fail(
             api_code=200,
             result=None,
@@ -41,12 +66,14 @@ async def callbadk(
 
     # 下单处理
     doctor_result, doctor_nsnuminfo_result = (
-        await DoctorServeries.get_doctor_curr_nsindex_scheduling_info(
-            db_session, dno=forms.dno, nsindex=forms.nsindex
-        )
+        reserve_record.doctor,
+        reserve_record.scheduling,
     )
     if not doctor_nsnuminfo_result:
         return Fail(api_code=200, result=None, message="排班信息不存在！！")
+    # 号源已约满的直接返回，避免无效的库存扣减争抢
+    if doctor_nsnuminfo_result.nsnumstock <= 0:
+        return Fail(api_code=200, result=None, message="当前时段预约已无号！")
 
     tiempmss = str(doctor_nsnuminfo_result.tiempm).split(" ")[1].split(":")
     visitday = str(doctor_nsnuminfo_result.dnotime)
@@ -58,7 +85,7 @@ async def callbadk(
         tiemampmstr,
     )
     # 订单编号
-    orderid = ordernum_helper.order_num_3(user_num=forms.visit_uphone)
+    orderid = ordernum_helper.order_num_snowflake()
     payfee = str(doctor_result.fee)
     order_info = {
         "dno": forms.dno,
@@ -70,12 +97,12 @@ async def callbadk(
     }
     # 开始提交微信支付生成订单信息
     order_info_json = json_helper.dict_to_json(order_info)
-    # 支付订单生成，但是注意的地方是，这里因为是同步的的，这里回引起阻塞哟！
-    wx_pay = WeChatPay(
-        appid=get_settings().GZX_ID,
-        api_key=get_settings().GZX_PAY_KEY,
-        mch_id=get_settings().MCH_ID,
+    # 预扣号源库存（单条件UPDATE原子扣减），扣减失败说明号源已被约满
+    nsnumstock = await DoctorServeries.deduct_nsnumstock(
+        db_session, dno=forms.dno, nsindex=forms.nsindex
     )
+    if nsnumstock is None:
+        return Fail(api_code=200, result=None, message="当前时段预约已无号！")
     try:
         # 商品描述
         body = f"XXX中医馆诊费"
@@ -89,8 +116,8 @@ async def callbadk(
         # out_trade_no - 商户系统内部订单号
         # 回调透传信息 attach-在查询API和支付通知中原样返回，可作为自定义参数使用。
         attach = f"{forms.dno}|{orderid}|{forms.nsindex}"
-        # 支付响应回调对象
-        pay_wx_res_result = wx_pay.order.create(
+        # 支付响应回调对象，使用共享连接池的异步客户端，不会阻塞事件循环
+        pay_wx_res_result = await wx_pay.order.create(
             trade_type="JSAPI",
             body=body,
             detail=detail,
@@ -106,12 +133,20 @@ async def callbadk(
         # 记录请求异常回调信息
         order_info["wcpayex.return_msg"] = wcpayex.errmsg
         print(wcpayex.errmsg)
+        # 支付订单生成失败，回补预扣的号源库存
+        await DoctorServeries.restock_nsnumstock(
+            db_session, dno=forms.dno, nsindex=forms.nsindex
+        )
         return Fail(
             api_code=200,
             result=None,
             message=f"微信支付配置服务异常，请稍后重试！！{wcpayex.errmsg}",
         )
     except Exception:
+        # 支付订单生成失败，回补预扣的号源库存
+        await DoctorServeries.restock_nsnumstock(
+            db_session, dno=forms.dno, nsindex=forms.nsindex
+        )
         return Fail(
             api_code=200,
             result=None,
@@ -134,53 +169,66 @@ async def callbadk(
             nonce_str=pay_wx_res_result.get("nonce_str"),
         )
 
-        creat_order_info_result = await PayOrderServeries.creat_order_info(
-            db_session,
-            dno=forms.dno,
-            orderid=orderid,
-            # 订单所属-支付诊费
-            payfee=payfee,
-            visit_uname=forms.visit_uname,
-            visit_uopenid=forms.visit_uopenid,
-            visit_uphone=forms.visit_uphone,
-            visit_usex=forms.visit_usex,
-            visit_uage=forms.visit_uage,
-            # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单）
-            statue=1,
-            # 订单所属-就诊状态（0:待预约 1：待就诊 2：已就诊）
-            visit_statue=0,
-            # 订单所属-就诊日期
-            visitday=visitday,
-            # 订单所属-就诊时间（周x-上午-8：00）
-            visittime=visittime,
-            create_time=datetime.datetime.now(),
-            # =========================
-            nsindex=forms.nsindex,
-        )
+        try:
+            creat_order_info_result = await PayOrderServeries.creat_order_info(
+                db_session,
+                dno=forms.dno,
+                orderid=orderid,
+                # 订单所属-支付诊费
+                payfee=payfee,
+                visit_uname=forms.visit_uname,
+                visit_uopenid=forms.visit_uopenid,
+                visit_uphone=forms.visit_uphone,
+                visit_usex=forms.visit_usex,
+                visit_uage=forms.visit_uage,
+                # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单）
+                statue=1,
+                # 订单所属-就诊状态（0:待预约 1：待就诊 2：已就诊）
+                visit_statue=0,
+                # 订单所属-就诊日期
+                visitday=visitday,
+                # 订单所属-就诊时间（周x-上午-8：00）
+                visittime=visittime,
+                create_time=datetime.datetime.now(),
+                # =========================
+                nsindex=forms.nsindex,
+            )
+        except Exception as ex:
+            # 订单写入失败（如订单号重复），回滚后由下面的流程回补预扣的号源库存
+            print("创建订单失败", ex)
+            await db_session.rollback()
+            creat_order_info_result = None
 
-        # 订单创建完成后，需要执行预约号源数的库存扣减
-
-        # 开始发送订单到消息队列中
-        # 获取消息操作事件- 15分钟（函数内部已经*1000）
-        pay_message_ttl = 60 * 15
-        order_exchange_name = "xz-order-exchange"
-        order_routing_key = "order_handler"
-        sync_rabbit_client.send_basic_publish(
-            exchange_name=order_exchange_name,
-            routing_key=order_routing_key,
-            body=order_info_json,
-            content_type="application/json",
-            is_delay=True,
-            message_ttl=pay_message_ttl,
-        )
+        # 号源库存已在下单前预扣，超时未支付或取消订单时再由对应流程回补
 
         if creat_order_info_result:
-            return Success(
-                api_code=200,
-                result={"orderid": orderid, "wx_info": wx_jsapi_data},
-                message="订单预约成功！",
+            # 订单写入成功后再发送到消息队列中
+            # 获取消息操作事件- 超时时间（秒），相同超时时间的订单进入同一个延时队列
+            pay_message_ttl = 60 * 15
+            order_routing_key = "order_handler"
+            if await send_order_expire_publish(
+                order_routing_key, order_info_json, pay_message_ttl
+            ):
+                return Success(
+                    api_code=200,
+                    result={"orderid": orderid, "wx_info": wx_jsapi_data},
+                    message="订单预约成功！",
+                )
+            # 延时消息发送失败时订单不会超时关闭，取消订单并回补预扣的号源库存
+            await UserOrdersServeries.cancel_unpay_order_info_restock(
+                db_session,
+                dno=forms.dno,
+                visit_uopenid=forms.visit_uopenid,
+                orderid=orderid,
+            )
+            return Fail(
+                api_code=200, result=None, message="订单提交失败，请稍后重试！！"
             )
 
+    # 订单未能创建成功，回补预扣的号源库存
+    await DoctorServeries.restock_nsnumstock(
+        db_session, dno=forms.dno, nsindex=forms.nsindex
+    )
     # 记录请求异常回调信息
     return Fail(
         api_code=200, result=None, message="微信服务请求处理异常，请稍后重试！！"
@@ -194,12 +242,17 @@ async def callbadk(
     forms: PayReserveOrderForm,
     db_session: AsyncSession = Depends(depends_get_db_session),
     client_ip: str = Depends(get_client_ip),
+    wx_pay: AsyncWeChatPay = Depends(get_async_wx_pay),
 ):
-    # 检测是否没支付的订单信息，取消或支付后才可以继续操作预约
-    get_order_info = await PayOrderServeries.get_order_info_byvisit_uopenid_state(
-        db_session, visit_uopenid=forms.visit_uopenid, statue=1
+    # 未支付订单检测、医生信息、号源排班信息一次查询返回
+    reserve_record = await DoctorServeries.get_doctor_nsindex_scheduling_record(
+        db_session,
+        dno=forms.dno,
+        nsindex=forms.nsindex,
+        visit_uopenid=forms.visit_uopenid,
     )
-    if get_order_info:
+    # 检测是否没支付的订单信息，取消或支付后才可以继续操作预约
+    if reserve_record.has_unpay_order:
         return Fail(
             api_code=200,
             result=None,
@@ -208,12 +261,14 @@ async def callbadk(
 
     # 下单处理
     doctor_result, doctor_nsnuminfo_result = (
-        await DoctorServeries.get_doctor_curr_nsindex_scheduling_info(
-            db_session, dno=forms.dno, nsindex=forms.nsindex
-        )
+        reserve_record.doctor,
+        reserve_record.scheduling,
     )
     if not doctor_nsnuminfo_result:
         return Fail(api_code=200, result=None, message="排班信息不存在！！")
+    # 号源已约满的直接返回，避免无效的库存扣减争抢
+    if doctor_nsnuminfo_result.nsnumstock <= 0:
+        return Fail(api_code=200, result=None, message="当前时段预约已无号！")
 
     tiempmss = str(doctor_nsnuminfo_result.tiempm).split(" ")[1].split(":")
     visitday = str(doctor_nsnuminfo_result.dnotime)
@@ -225,7 +280,7 @@ async def callbadk(
         tiemampmstr,
     )
     # 订单编号
-    orderid = ordernum_helper.order_num_3(user_num=forms.visit_uphone)
+    orderid = ordernum_helper.order_num_snowflake()
     payfee = str(doctor_result.fee)
     order_info = {
         "dno": forms.dno,
@@ -237,12 +292,12 @@ async def callbadk(
     }
     # 开始提交微信支付生成订单信息
     order_info_json = json_helper.dict_to_json(order_info)
-    # 支付订单生成，但是注意的地方是，这里因为是同步的的，这里回引起阻塞哟！
-    wx_pay = WeChatPay(
-        appid=get_settings().GZX_ID,
-        api_key=get_settings().GZX_PAY_KEY,
-        mch_id=get_settings().MCH_ID,
+    # 预扣号源库存（单条件UPDATE原子扣减），扣减失败说明号源已被约满
+    nsnumstock = await DoctorServeries.deduct_nsnumstock(
+        db_session, dno=forms.dno, nsindex=forms.nsindex
     )
+    if nsnumstock is None:
+        return Fail(api_code=200, result=None, message="当前时段预约已无号！")
     try:
         # 商品描述
         body = f"XXX中医馆诊费"
@@ -256,8 +311,8 @@ async def callbadk(
         # out_trade_no - 商户系统内部订单号
         # 回调透传信息 attach-在查询API和支付通知中原样返回，可作为自定义参数使用。
         attach = f"{forms.dno}|{orderid}|{forms.nsindex}"
-        # 支付响应回调对象
-        pay_wx_res_result = wx_pay.order.create(
+        # 支付响应回调对象，使用共享连接池的异步客户端，不会阻塞事件循环
+        pay_wx_res_result = await wx_pay.order.create(
             trade_type="JSAPI",
             body=body,
             detail=detail,
@@ -273,12 +328,20 @@ async def callbadk(
         # 记录请求异常回调信息
         order_info["wcpayex.return_msg"] = wcpayex.errmsg
         print(wcpayex.errmsg)
+        # 支付订单生成失败，回补预扣的号源库存
+        await DoctorServeries.restock_nsnumstock(
+            db_session, dno=forms.dno, nsindex=forms.nsindex
+        )
         return Fail(
             api_code=200,
             result=None,
             message=f"微信支付配置服务异常，请稍后重试！！{wcpayex.errmsg}",
         )
     except Exception:
+        # 支付订单生成失败，回补预扣的号源库存
+        await DoctorServeries.restock_nsnumstock(
+            db_session, dno=forms.dno, nsindex=forms.nsindex
+        )
         return Fail(
             api_code=200,
             result=None,
@@ -301,52 +364,66 @@ async def callbadk(
             nonce_str=pay_wx_res_result.get("nonce_str"),
         )
 
-        creat_order_info_result = await PayOrderServeries.creat_order_info(
-            db_session,
-            dno=forms.dno,
-            orderid=orderid,
-            # 订单所属-支付诊费
-            payfee=payfee,
-            visit_uname=forms.visit_uname,
-            visit_uopenid=forms.visit_uopenid,
-            visit_uphone=forms.visit_uphone,
-            visit_usex=forms.visit_usex,
-            visit_uage=forms.visit_uage,
-            # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单）
-            statue=1,
-            # 订单所属-就诊状态（0:待预约 1：待就诊 2：已就诊）
-            visit_statue=0,
-            # 订单所属-就诊日期
-            visitday=visitday,
-            # 订单所属-就诊时间（周x-上午-8：00）
-            visittime=visittime,
-            create_time=datetime.datetime.now(),
-            # =========================
-            nsindex=forms.nsindex,
-        )
+        try:
+            creat_order_info_result = await PayOrderServeries.creat_order_info(
+                db_session,
+                dno=forms.dno,
+                orderid=orderid,
+                # 订单所属-支付诊费
+                payfee=payfee,
+                visit_uname=forms.visit_uname,
+                visit_uopenid=forms.visit_uopenid,
+                visit_uphone=forms.visit_uphone,
+                visit_usex=forms.visit_usex,
+                visit_uage=forms.visit_uage,
+                # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单）
+                statue=1,
+                # 订单所属-就诊状态（0:待预约 1：待就诊 2：已就诊）
+                visit_statue=0,
+                # 订单所属-就诊日期
+                visitday=visitday,
+                # 订单所属-就诊时间（周x-上午-8：00）
+                visittime=visittime,
+                create_time=datetime.datetime.now(),
+                # =========================
+                nsindex=forms.nsindex,
+            )
+        except Exception as ex:
+            # 订单写入失败（如订单号重复），回滚后由下面的流程回补预扣的号源库存
+            print("创建订单失败", ex)
+            await db_session.rollback()
+            creat_order_info_result = None
 
-        # 订单创建完成后，需要执行预约号源数的库存扣减
-
-        # 开始发送订单到消息队列中
-        # 获取消息操作事件- 15分钟（函数内部已经*1000）
-        pay_message_ttl = 5
-        order_exchange_name = "xz-order-exchange1"
-        order_routing_key = "order_handler1"
-        await async_rabbit_client.send_basic_publish(
-            routing_key=order_routing_key,
-            body=order_info_json,
-            content_type="application/json",
-            is_delay=True,
-            message_ttl=pay_message_ttl,
-        )
+        # 号源库存已在下单前预扣，超时未支付或取消订单时再由对应流程回补
 
         if creat_order_info_result:
-            return Success(
-                api_code=200,
-                result={"orderid": orderid, "wx_info": wx_jsapi_data},
-                message="订单预约成功！",
+            # 订单写入成功后再发送到消息队列中
+            # 获取消息操作事件- 超时时间（秒），相同超时时间的订单进入同一个延时队列
+            pay_message_ttl = 5
+            order_routing_key = "order_handler1"
+            if await send_order_expire_publish(
+                order_routing_key, order_info_json, pay_message_ttl
+            ):
+                return Success(
+                    api_code=200,
+                    result={"orderid": orderid, "wx_info": wx_jsapi_data},
+                    message="订单预约成功！",
+                )
+            # 延时消息发送失败时订单不会超时关闭，取消订单并回补预扣的号源库存
+            await UserOrdersServeries.cancel_unpay_order_info_restock(
+                db_session,
+                dno=forms.dno,
+                visit_uopenid=forms.visit_uopenid,
+                orderid=orderid,
+            )
+            return Fail(
+                api_code=200, result=None, message="订单提交失败，请稍后重试！！"
             )
 
+    # 订单未能创建成功，回补预扣的号源库存
+    await DoctorServeries.restock_nsnumstock(
+        db_session, dno=forms.dno, nsindex=forms.nsindex
+    )
     # 记录请求异常回调信息
     return Fail(
         api_code=200, result=None, message="微信服务请求处理异常，请稍后重试！！"
@@ -361,11 +438,15 @@ async def callbadk(
     db_session: AsyncSession = Depends(depends_get_db_session),
     client_ip: str = Depends(get_client_ip),
 ):
-    # 检测是否没支付的订单信息，取消或支付后才可以继续操作预约
-    get_order_info = await PayOrderServeries.get_order_info_byvisit_uopenid_state(
-        db_session, visit_uopenid=forms.visit_uopenid, statue=1
+    # 未支付订单检测、医生信息、号源排班信息一次查询返回
+    reserve_record = await DoctorServeries.get_doctor_nsindex_scheduling_record(
+        db_session,
+        dno=forms.dno,
+        nsindex=forms.nsindex,
+        visit_uopenid=forms.visit_uopenid,
     )
-    if get_order_info:
+    # 检测是否没支付的订单信息，取消或支付后才可以继续操作预约
+    if reserve_record.has_unpay_order:
         return Fail(
             api_code=200,
             result=None,
@@ -374,12 +455,14 @@ async def callbadk(
 
     # 下单处理
     doctor_result, doctor_nsnuminfo_result = (
-        await DoctorServeries.get_doctor_curr_nsindex_scheduling_info(
-            db_session, dno=forms.dno, nsindex=forms.nsindex
-        )
+        reserve_record.doctor,
+        reserve_record.scheduling,
     )
     if not doctor_nsnuminfo_result:
         return Fail(api_code=200, result=None, message="排班信息不存在！！")
+    # 号源已约满的直接返回，避免无效的库存扣减争抢
+    if doctor_nsnuminfo_result.nsnumstock <= 0:
+        return Fail(api_code=200, result=None, message="当前时段预约已无号！")
 
     tiempmss = str(doctor_nsnuminfo_result.tiempm).split(" ")[1].split(":")
     visitday = str(doctor_nsnuminfo_result.dnotime)
@@ -391,7 +474,7 @@ async def callbadk(
         tiemampmstr,
     )
     # 订单编号
-    orderid = ordernum_helper.order_num_3(user_num=forms.visit_uphone)
+    orderid = ordernum_helper.order_num_snowflake()
     payfee = str(doctor_result.fee)
     order_info = {
         "dno": forms.dno,
@@ -403,6 +486,12 @@ async def callbadk(
     }
     # 开始提交微信支付生成订单信息
     order_info_json = json_helper.dict_to_json(order_info)
+    # 预扣号源库存（单条件UPDATE原子扣减），扣减失败说明号源已被约满
+    nsnumstock = await DoctorServeries.deduct_nsnumstock(
+        db_session, dno=forms.dno, nsindex=forms.nsindex
+    )
+    if nsnumstock is None:
+        return Fail(api_code=200, result=None, message="当前时段预约已无号！")
     # 支付订单生成，但是注意的地方是，这里因为是同步的的，这里回引起阻塞哟！
 
     wx_pay = WeChatPay(
@@ -425,7 +514,10 @@ async def callbadk(
         attach = f"{forms.dno}|{orderid}|{forms.nsindex}"
         # 支付响应回调对象
 
-        pay_wx_res_result = await sync_to_async(func=wx_pay.order.create)(
+        # thread_sensitive=False 让每个请求使用线程池中独立的线程，不会排队到同一个线程上串行执行
+        pay_wx_res_result = await sync_to_async(
+            func=wx_pay.order.create, thread_sensitive=False
+        )(
             trade_type="JSAPI",
             body=body,
             detail=detail,
@@ -453,12 +545,20 @@ async def callbadk(
         # 记录请求异常回调信息
         order_info["wcpayex.return_msg"] = wcpayex.errmsg
         print(wcpayex.errmsg)
+        # 支付订单生成失败，回补预扣的号源库存
+        await DoctorServeries.restock_nsnumstock(
+            db_session, dno=forms.dno, nsindex=forms.nsindex
+        )
         return Fail(
             api_code=200,
             result=None,
             message=f"微信支付配置服务异常，请稍后重试！！{wcpayex.errmsg}",
         )
     except Exception:
+        # 支付订单生成失败，回补预扣的号源库存
+        await DoctorServeries.restock_nsnumstock(
+            db_session, dno=forms.dno, nsindex=forms.nsindex
+        )
         return Fail(
             api_code=200,
             result=None,
@@ -481,52 +581,66 @@ async def callbadk(
             nonce_str=pay_wx_res_result.get("nonce_str"),
         )
 
-        creat_order_info_result = await PayOrderServeries.creat_order_info(
-            db_session,
-            dno=forms.dno,
-            orderid=orderid,
-            # 订单所属-支付诊费
-            payfee=payfee,
-            visit_uname=forms.visit_uname,
-            visit_uopenid=forms.visit_uopenid,
-            visit_uphone=forms.visit_uphone,
-            visit_usex=forms.visit_usex,
-            visit_uage=forms.visit_uage,
-            # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单）
-            statue=1,
-            # 订单所属-就诊状态（0:待预约 1：待就诊 2：已就诊）
-            visit_statue=0,
-            # 订单所属-就诊日期
-            visitday=visitday,
-            # 订单所属-就诊时间（周x-上午-8：00）
-            visittime=visittime,
-            create_time=datetime.datetime.now(),
-            # =========================
-            nsindex=forms.nsindex,
-        )
+        try:
+            creat_order_info_result = await PayOrderServeries.creat_order_info(
+                db_session,
+                dno=forms.dno,
+                orderid=orderid,
+                # 订单所属-支付诊费
+                payfee=payfee,
+                visit_uname=forms.visit_uname,
+                visit_uopenid=forms.visit_uopenid,
+                visit_uphone=forms.visit_uphone,
+                visit_usex=forms.visit_usex,
+                visit_uage=forms.visit_uage,
+                # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单）
+                statue=1,
+                # 订单所属-就诊状态（0:待预约 1：待就诊 2：已就诊）
+                visit_statue=0,
+                # 订单所属-就诊日期
+                visitday=visitday,
+                # 订单所属-就诊时间（周x-上午-8：00）
+                visittime=visittime,
+                create_time=datetime.datetime.now(),
+                # =========================
+                nsindex=forms.nsindex,
+            )
+        except Exception as ex:
+            # 订单写入失败（如订单号重复），回滚后由下面的流程回补预扣的号源库存
+            print("创建订单失败", ex)
+            await db_session.rollback()
+            creat_order_info_result = None
 
-        # 订单创建完成后，需要执行预约号源数的库存扣减
-
-        # 开始发送订单到消息队列中
-        # 获取消息操作事件- 15分钟（函数内部已经*1000）
-        pay_message_ttl = 5
-        order_exchange_name = "xz-order-exchange1"
-        order_routing_key = "order_handler1"
-        await async_rabbit_client.send_basic_publish(
-            routing_key=order_routing_key,
-            body=order_info_json,
-            content_type="application/json",
-            is_delay=True,
-            message_ttl=pay_message_ttl,
-        )
+        # 号源库存已在下单前预扣，超时未支付或取消订单时再由对应流程回补
 
         if creat_order_info_result:
-            return Success(
-                api_code=200,
-                result={"orderid": orderid, "wx_info": wx_jsapi_data},
-                message="订单预约成功！",
+            # 订单写入成功后再发送到消息队列中
+            # 获取消息操作事件- 超时时间（秒），相同超时时间的订单进入同一个延时队列
+            pay_message_ttl = 5
+            order_routing_key = "order_handler1"
+            if await send_order_expire_publish(
+                order_routing_key, order_info_json, pay_message_ttl
+            ):
+                return Success(
+                    api_code=200,
+                    result={"orderid": orderid, "wx_info": wx_jsapi_data},
+                    message="订单预约成功！",
+                )
+            # 延时消息发送失败时订单不会超时关闭，取消订单并回补预扣的号源库存
+            await UserOrdersServeries.cancel_unpay_order_info_restock(
+                db_session,
+                dno=forms.dno,
+                visit_uopenid=forms.visit_uopenid,
+                orderid=orderid,
+            )
+            return Fail(
+                api_code=200, result=None, message="订单提交失败，请稍后重试！！"
             )
 
+    # 订单未能创建成功，回补预扣的号源库存
+    await DoctorServeries.restock_nsnumstock(
+        db_session, dno=forms.dno, nsindex=forms.nsindex
+    )
     # 记录请求异常回调信息
     return Fail(
         api_code=200, result=None, message="微信服务请求处理异常，请稍后重试！！"
@@ -5,8 +5,9 @@ from db.async_database import AsyncSession
 from exts.responses.json_response import Success, Fail
 from apis.payorders.api import router_payorders
 from apis.payorders.schemas import PayCancelPayOrderForm
-from exts.wechatpy.pay import WeChatPay, WeChatPayException
-from apis.payorders.dependencies import get_client_ip
+from exts.wechatpy.pay import WeChatPayException
+from apis.payorders.dependencies import get_client_ip, get_async_wx_pay
+from exts.wechatpy.pay.async_pay import AsyncWeChatPay
 from utils import datatime_helper, json_helper
 from config.config import get_settings
 import decimal
@@ -17,6 +18,7 @@ async def callbadk(
     forms: PayCancelPayOrderForm = Depends(),
     db_session: AsyncSession = Depends(depends_get_db_session),
     client_ip: str = Depends(get_client_ip),
+    wx_pay: AsyncWeChatPay = Depends(get_async_wx_pay),
 ):
     # 获取预约详情信息列表
     doctor_order_info_result = (
@@ -81,11 +83,6 @@ async def callbadk(
 
     # 新手支付生成
     try:
-        wx_pay = WeChatPay(
-            appid=get_settings().GZX_ID,
-            api_key=get_settings().GZX_PAY_KEY,
-            mch_id=get_settings().MCH_ID,
-        )
         orderid = doctor_order_info_result.orderid
         order_info_json = json_helper.dict_to_json(order_info)
         payfee = doctor_order_info_result.payfee
@@ -111,7 +108,7 @@ async def callbadk(
         # 回调透传信息 attach-在查询API和支付通知中原样返回，可作为自定义参数使用。
         attach = f"{forms.dno}|{orderid}|{nsindex}"
         # 支付响应回调对象
-        pay_wx_res_result = wx_pay.order.create(
+        pay_wx_res_result = await wx_pay.order.create(
             trade_type="JSAPI",
             body=body,
             detail=detail,
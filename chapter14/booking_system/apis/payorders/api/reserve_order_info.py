@@ -40,7 +40,7 @@ async def callbadk(
         ),
     }
     return (
-        Success(result={**doctor_result, **backresult})
+        Success(result={**doctor_result._asdict(), **backresult})
         if doctor_result
         else Fail(message="无当前医生排班信息")
     )
@@ -1,4 +1,10 @@
 from starlette.requests import Request
+from functools import lru_cache
+from config.config import get_settings
+from exts.wechatpy.pay.async_pay import AsyncWeChatPay
+from exts.wechatpy.client.async_client import AsyncWeChatClient
+from exts.wechatpy.session.asyncredisstorage import AsyncRedisStorage
+from exts.async_redis import async_redis_client
 
 
 def get_client_ip(request: Request):
@@ -11,3 +17,43 @@ def get_client_ip(request: Request):
     if forwarded:
         return forwarded.split(",")[0]
     return request.client.host
+
+
+@lru_cache()
+def get_async_wx_pay() -> AsyncWeChatPay:
+    """
+    进程内共享的异步微信支付客户端，复用同一个连接池
+    :return:
+    """
+    settings = get_settings()
+    return AsyncWeChatPay(
+        appid=settings.GZX_ID,
+        api_key=settings.GZX_PAY_KEY,
+        mch_id=settings.MCH_ID,
+        timeout=settings.WX_PAY_TIMEOUT,
+        max_connections=settings.WX_PAY_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.WX_PAY_MAX_KEEPALIVE_CONNECTIONS,
+        max_concurrency=settings.WX_PAY_MAX_CONCURRENCY,
+    )
+
+
+@lru_cache()
+def get_async_wx_client() -> AsyncWeChatClient:
+    """
+    进程内共享的异步公众号客户端，access_token 在进程内缓存，
+    启用redis的时候多个worker通过redis共享同一个access_token
+    :return:
+    """
+    settings = get_settings()
+    session = (
+        AsyncRedisStorage(async_redis_client.redis)
+        if async_redis_client.enabled
+        else None
+    )
+    return AsyncWeChatClient(
+        appid=settings.GZX_ID,
+        secret=settings.GZX_SECRET,
+        session=session,
+        timeout=settings.WX_CLIENT_TIMEOUT,
+        refresh_ahead=settings.WX_TOKEN_REFRESH_AHEAD,
+    )
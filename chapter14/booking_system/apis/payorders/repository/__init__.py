@@ -1,7 +1,7 @@
-from sqlalchemy import select, update, delete
+from sqlalchemy import select, update, delete, any_, func
 from sqlalchemy.ext.asyncio import AsyncSession
 from db.models import Doctorinfo, DoctorScheduling, DoctorSubscribeinfo
-from typing import Optional
+from typing import Optional, List
 from db.async_database import async_context_get_db
 
 
@@ -131,6 +131,58 @@ class PayOrderServeries:
         # result.rowcount 1:更新成功 0 更新失败
         return result.rowcount
 
+    @staticmethod
+    async def mark_order_paid(async_session: AsyncSession, dno, orderid, visit_uopenid):
+        """
+        把未支付的订单更新为已支付，条件更新保证重复的支付通知只有一个能更新成功：
+        UPDATE doctor_subscribeinfo SET statue = 2, visit_statue = 1, notify_callback_time = now()
+        WHERE dno = :dno AND orderid = :orderid AND visit_uopenid = :visit_uopenid AND statue = 1
+        RETURNING visittime, visitday
+        :return: 更新成功返回订单的(visittime, visitday)，订单不存在或者不是未支付状态返回None
+        """
+        query = (
+            update(DoctorSubscribeinfo)
+            .where(
+                DoctorSubscribeinfo.dno == dno,
+                DoctorSubscribeinfo.orderid == orderid,
+                DoctorSubscribeinfo.visit_uopenid == visit_uopenid,
+                DoctorSubscribeinfo.statue == 1,
+            )
+            # 标记已支付，待就诊！
+            .values(statue=2, visit_statue=1, notify_callback_time=func.now())
+            .returning(DoctorSubscribeinfo.visittime, DoctorSubscribeinfo.visitday)
+            .execution_options(synchronize_session=False)
+        )
+        _result = await async_session.execute(query)
+        paid_result = _result.first()
+        await async_session.commit()
+        return paid_result
+
+    @staticmethod
+    async def expire_unpay_orders(async_session: AsyncSession, orderids: List[str]):
+        """
+        批量把超时未支付的订单更新为4（超时未支付订单），一条语句处理一批订单：
+        UPDATE doctor_subscribeinfo SET statue = 4
+        WHERE orderid = ANY(:orderids) AND statue = 1 RETURNING dno, nsindex
+        已支付、已取消的订单不会被更新，也就不会重复回补库存
+        :param async_session:
+        :param orderids: 订单编号列表
+        :return: 被更新的订单的(dno, nsindex)列表，由调用方回补库存
+        """
+        if not orderids:
+            return []
+        query = (
+            update(DoctorSubscribeinfo)
+            .where(
+                DoctorSubscribeinfo.orderid == any_(orderids),
+                DoctorSubscribeinfo.statue == 1,
+            )
+            .values(statue=4)
+            .returning(DoctorSubscribeinfo.dno, DoctorSubscribeinfo.nsindex)
+            .execution_options(synchronize_session=False)
+        )
+        _result = await async_session.execute(query)
+        return _result.all()
 
 if __name__ == "__main__":
     import asyncio
@@ -47,13 +47,12 @@ async def callbadk(
             api_code=200, result=None, message="该订单处于申请退款状态,请勿重复操作！"
         )
 
-        # 更新没有支付的成功的订单的，状态！
-    isok = await Serveries.updata_order_info_byorder_dno_olny(
+        # 更新没有支付的成功的订单的，状态！同时回补号源库存
+    isok = await Serveries.cancel_unpay_order_info_restock(
         db_session,
         dno=forms.dno,
         orderid=forms.orderid,
         visit_uopenid=forms.visit_uopenid,
-        statue=3,
     )
 
     return (
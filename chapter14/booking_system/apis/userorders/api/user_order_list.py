@@ -1,12 +1,23 @@
 from fastapi import Depends
-from db.async_database import depends_get_db_session
+from fastapi.responses import StreamingResponse
+from db.async_database import depends_get_db_session, async_context_get_db
 from db.async_database import AsyncSession
-from exts.responses.json_response import Success, Fail
+from exts.responses.json_response import Success, Fail, orjson_dumps
 from ..api import router_userorders
 from ..schemas import UserOrderIonfoListForm
 from ..repository import Serveries
 
 
+async def stream_order_list_ndjson(visit_uopenid, statue):
+    # 流式响应的生命周期比依赖注入的会话长，这里单独使用一个会话
+    async with async_context_get_db() as session:
+        async for partition in Serveries.stream_order_info_by_visit_uopenid(
+            session, visit_uopenid=visit_uopenid, statue=statue
+        ):
+            # 每一批订单合并成一次写出，一行一个订单
+            yield b"".join(orjson_dumps(dict(row)) + b"\n" for row in partition)
+
+
 @router_userorders.post("/user_order_list", summary="用户自己订单列表")
 async def callbadk(
     forms: UserOrderIonfoListForm,
@@ -14,12 +25,29 @@ async def callbadk(
 ):
     # 检测用户的有消息
     # 判断当前用户是否已经被拉黑啦，禁用了！
-    result = await Serveries.get_order_info_list_by_visit_uopenid_select(
-        db_session, visit_uopenid=forms.visit_uopenid, statue=forms.statue
-    )
+    if forms.stream:
+        # 导出全部订单，以NDJSON流的方式返回，不一次性加载到内存
+        return StreamingResponse(
+            stream_order_list_ndjson(forms.visit_uopenid, forms.statue),
+            media_type="application/x-ndjson",
+        )
+    try:
+        result, next_cursor = await Serveries.get_order_info_page_by_visit_uopenid(
+            db_session,
+            visit_uopenid=forms.visit_uopenid,
+            statue=forms.statue,
+            limit=forms.limit,
+            cursor=forms.cursor,
+        )
+    except ValueError:
+        return Fail(api_code=200, result=None, message="分页游标无效！")
     # is_reserve -属性 1:表示可以点击预约  2：有排班记录，但是已预约满
     return (
-        Success(api_code=200, result=result, message="查询成功")
-        if result
+        Success(
+            api_code=200,
+            result={"orders": result, "next_cursor": next_cursor},
+            message="查询成功",
+        )
+        if result or forms.cursor
         else Fail(api_code=200, result=None, message="无此订单状态列表信息！")
     )
@@ -1,10 +1,33 @@
 import asyncio
+import base64
+import datetime
 
-from sqlalchemy import select, update, delete
+import orjson
+from sqlalchemy import select, update, delete, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession, AsyncResult
 from db.models import Doctorinfo, DoctorSubscribeinfo, DoctorScheduling
 from db.async_database import async_context_get_db
-from typing import Optional
+from apis.doctor.repository import DoctorServeries
+from exts.stock_push import stock_push_hub
+from typing import Optional, List, Tuple, AsyncIterator
+
+
+def encode_order_cursor(create_time: datetime.datetime, id: int) -> str:
+    """分页游标：最后一条记录的 (create_time, id)"""
+    return base64.urlsafe_b64encode(
+        orjson.dumps([create_time.isoformat(), id])
+    ).decode()
+
+
+def decode_order_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """
+    :raise ValueError: 游标格式错误
+    """
+    try:
+        create_time, id = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(create_time), int(id)
+    except (TypeError, orjson.JSONDecodeError, base64.binascii.Error) as ex:
+        raise ValueError("无效的分页游标") from ex
 
 
 class Serveries:
@@ -54,6 +77,47 @@ class Serveries:
         await async_session.commit()
         return result.rowcount
 
+    @staticmethod
+    async def cancel_unpay_order_info_restock(
+        async_session: AsyncSession, dno, visit_uopenid, orderid
+    ):
+        """
+        取消未支付的订单并回补号源库存
+        只有状态还是1（未支付）的订单才会被更新为3（取消订单），
+        和超时未支付的死信消费并发时也只会有一方回补库存
+        :param async_session:
+        :param dno:
+        :param visit_uopenid:
+        :param orderid:
+        :return: 1:取消成功 0:取消失败
+        """
+        response = (
+            update(DoctorSubscribeinfo)
+            .where(
+                DoctorSubscribeinfo.dno == dno,
+                DoctorSubscribeinfo.visit_uopenid == visit_uopenid,
+                DoctorSubscribeinfo.orderid == orderid,
+                DoctorSubscribeinfo.statue == 1,
+            )
+            .values(statue=3)
+            .returning(DoctorSubscribeinfo.nsindex)
+            .execution_options(synchronize_session=False)
+        )
+        result = await async_session.execute(response)
+        nsindex = result.scalar()
+        if nsindex is None:
+            await async_session.commit()
+            return 0
+        # 订单状态的更新和库存回补在同一个事务里面提交，不会出现订单已取消库存没有回补
+        restocked = await DoctorServeries.bulk_restock_nsnumstock(
+            async_session, nsindex_counts={nsindex: 1}
+        )
+        await async_session.commit()
+        # 事务提交后再推送回补后的库存
+        for item in restocked:
+            stock_push_hub.publish(item.dno, item.nsindex, item.nsnumstock)
+        return 1
+
     @staticmethod
     async def get_order_info_list_by_visit_uopenid_select(
         async_session: AsyncSession, visit_uopenid, statue=1
@@ -101,6 +165,85 @@ class Serveries:
         # _rows = _subscribe_info_result.all()
         # return [item._mapping for item in _rows]
 
+    @staticmethod
+    def _order_list_query(visit_uopenid, statue=None):
+        """用户订单列表查询，按 (create_time, id) 倒序"""
+        query = (
+            select(
+                DoctorSubscribeinfo.id,
+                DoctorSubscribeinfo.orderid,
+                # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单 4:超时自动取消）
+                DoctorSubscribeinfo.statue,
+                DoctorSubscribeinfo.dno,
+                DoctorSubscribeinfo.visittime,
+                DoctorSubscribeinfo.visitday,
+                DoctorSubscribeinfo.payfee,
+                DoctorSubscribeinfo.visit_statue,
+                DoctorSubscribeinfo.create_time,
+                Doctorinfo.dnname,
+                Doctorinfo.addr,
+                Doctorinfo.rank,
+                Doctorinfo.pic,
+            )
+            .outerjoin_from(
+                DoctorSubscribeinfo,
+                Doctorinfo,
+                DoctorSubscribeinfo.dno == Doctorinfo.dno,
+            )
+            .filter(DoctorSubscribeinfo.visit_uopenid == visit_uopenid)
+            .order_by(
+                DoctorSubscribeinfo.create_time.desc(), DoctorSubscribeinfo.id.desc()
+            )
+        )
+        # 不传订单状态时查询全部状态的订单
+        if statue is not None:
+            query = query.filter(DoctorSubscribeinfo.statue == statue)
+        return query
+
+    @staticmethod
+    async def get_order_info_page_by_visit_uopenid(
+        async_session: AsyncSession,
+        visit_uopenid,
+        statue=None,
+        limit: int = 20,
+        cursor: str = None,
+    ) -> Tuple[List, Optional[str]]:
+        """
+        游标分页（keyset）查询用户订单列表，翻页的耗时不会随着页数增加
+        WHERE (create_time, id) < (:create_time, :id) ORDER BY create_time DESC, id DESC LIMIT :limit
+        :param cursor: 上一页返回的游标，为空表示第一页
+        :return: 当前页的订单列表, 下一页的游标（没有下一页时为None）
+        """
+        query = Serveries._order_list_query(visit_uopenid, statue=statue)
+        if cursor:
+            create_time, id = decode_order_cursor(cursor)
+            query = query.filter(
+                tuple_(DoctorSubscribeinfo.create_time, DoctorSubscribeinfo.id)
+                < tuple_(create_time, id)
+            )
+        # 多查一条用来判断是否还有下一页
+        _result = await async_session.execute(query.limit(limit + 1))
+        rows = _result.mappings().all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_order_cursor(rows[-1]["create_time"], rows[-1]["id"])
+        return rows, next_cursor
+
+    @staticmethod
+    async def stream_order_info_by_visit_uopenid(
+        async_session: AsyncSession, visit_uopenid, statue=None, partition_size=500
+    ) -> AsyncIterator[List]:
+        """
+        使用服务端游标分批读取用户的全部订单，不会一次性加载到内存
+        :return: 每次返回一批订单
+        """
+        _result = await async_session.stream(
+            Serveries._order_list_query(visit_uopenid, statue=statue)
+        )
+        async for partition in _result.mappings().partitions(partition_size):
+            yield partition
+
     @staticmethod
     async def get_order_info_list_by_visit_uopenid_detailt(
         async_session: AsyncSession, visit_uopenid, orderid, dno
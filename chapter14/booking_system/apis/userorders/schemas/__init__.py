@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from fastapi import Depends, Query
 from pydantic.dataclasses import dataclass
 
@@ -18,6 +18,12 @@ class UserOrderIonfoListForm(BaseModel):
     visit_uopenid: str = Query(..., min_length=1, description="就诊人微信ID")
     # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单 4：超时未支付订单 5：申请退款状态 6：已退款状态）
     statue: int = None
+    # 每页数量
+    limit: int = Field(20, ge=1, le=100, description="每页数量")
+    # 上一页返回的next_cursor，为空表示第一页
+    cursor: str = None
+    # 是否以NDJSON流的方式一次返回全部订单（忽略分页参数）
+    stream: bool = False
 
 
 class WxCodeForm(BaseModel):
@@ -43,7 +43,7 @@ ApiExceptionHandler().init_app(app)
 # app.router.route_class = ContextLogerRoute
 # app.add_middleware(BindContextvarMiddleware)
 
-# 这个中间件会引发异步测试卡顿
+# 纯ASGI的请求日志中间件，日志在后台线程写入，sample_rates可以按路由前缀设置采样率
 # from middlewares.loger.middleware import  LogerMiddleware
 # app.add_middleware(LogerMiddleware,log_pro_path=os.path.split(os.path.realpath(__file__))[0])
 
@@ -58,6 +58,60 @@ app.include_router(router_docrot)
 app.include_router(router_userorders)
 app.include_router(router_payorders)
 
+# 放号时预约下单等接口的准入控制和排队，其他接口不受影响
+from plugins.admission_control import AdmissionControlPlugin
+
+AdmissionControlPlugin().init_app(app, get_settings())
+
+# 数据库连接池监控指标（/metrics）和长时间占用连接的检测
+from db.pool_monitor import db_pool_monitor
+
+db_pool_monitor.init_app(app=app, poolconf=get_settings())
+
+# 初始化redis，没有配置REDIS_URL的时候不启用
+from exts.async_redis import async_redis_client
+
+async_redis_client.init_app(app=app, redisconf=get_settings())
+
+# 共享的异步微信支付、公众号客户端，服务关闭时释放连接池
+from apis.payorders.dependencies import get_async_wx_pay, get_async_wx_client
+
+get_async_wx_pay().init_app(app)
+get_async_wx_client().init_app(app)
+
+# 医生、排班、医院等读多写少数据的读穿缓存
+from exts.read_cache import read_cache
+
+read_cache.init_app(
+    app=app, cacheconf=get_settings(), get_redis=lambda: async_redis_client.redis
+)
+# 缓存的命中率等指标从 /metrics 输出
+db_pool_monitor.register_collector(read_cache.render_prometheus)
+
+# 号源库存变化的实时推送
+from exts.stock_push import stock_push_hub
+
+stock_push_hub.init_app(
+    app=app, pushconf=get_settings(), get_redis=lambda: async_redis_client.redis
+)
+
+# 支付回调等重复通知的幂等处理
+from exts.idempotency import idempotency_guard
+
+idempotency_guard.init_app(
+    app=app, idemconf=get_settings(), get_redis=lambda: async_redis_client.redis
+)
+
+# 模板消息异步投递队列
+from exts.template_queue import template_message_queue
+
+template_message_queue.init_app(
+    app=app,
+    queueconf=get_settings(),
+    get_client=get_async_wx_client,
+    get_redis=lambda: async_redis_client.redis,
+)
+
 
 # 初始化同步连接rabbitmq
 from exts.async_rabbit import async_rabbit_client
@@ -85,6 +139,7 @@ async def startup_callback_init_data():
 
     await async_rabbit_client.make_queue_bind(
         exchange_name=order_dead_letter_exchange_name,
+        queue_name=order_dead_letter_queue_name,
         routing_key=order_dead_letter_routing_key,
     )
 
@@ -101,7 +156,9 @@ async def startup_callback_init_data():
         queue_name=order_queue_name, arguments=order_queue_arguments
     )
     await async_rabbit_client.make_queue_bind(
-        exchange_name=order_exchange_name, routing_key=order_routing_key
+        exchange_name=order_exchange_name,
+        queue_name=order_queue_name,
+        routing_key=order_routing_key,
     )
 
 
@@ -109,6 +166,16 @@ async_rabbit_client.init_app(
     app=app, rabbitconf=get_settings(), startup_callback=startup_callback_init_data
 )
 
+# 订单超时的延时消息调度，需要在rabbit客户端初始化之后
+from exts.delay_scheduler import delay_scheduler
+
+delay_scheduler.init_app(
+    app=app,
+    delayconf=get_settings(),
+    rabbit_client=async_rabbit_client,
+    get_redis=lambda: async_redis_client.redis,
+)
+
 
 def startup_callback_init_data_sync():
     # 为测试方便每次启动都删除
@@ -150,6 +217,16 @@ def startup_callback_init_data_sync():
     )
 
 
+# 雪花订单号的进程编号，没有配置ORDER_WORKER_ID时通过redis租用
+from exts.order_worker import order_worker_lease
+
+order_worker_lease.init_app(
+    app=app, workerconf=get_settings(), get_redis=lambda: async_redis_client.redis
+)
+
+# 使用redis的扩展都注册之后再注册redis的shutdown事件，保证它们关闭时redis还可以使用
+async_redis_client.init_shutdown(app)
+
 # try:
 #   sync_rabbit_client.init_app(app=app,rabbitconf=get_settings(),startup_callback=startup_callback_init_data_sync)
 # except:
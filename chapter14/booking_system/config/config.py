@@ -1,4 +1,5 @@
 from pydantic import BaseSettings
+from typing import Dict
 from functools import lru_cache
 
 
@@ -23,6 +24,21 @@ class Settings(BaseSettings):
     # 默认的连接池的额大小
     DB_POOL_SIZE: int = 60
     DB_MAX_OVERFLOW: int = 0
+    # 获取连接的超时时间（秒）
+    DB_POOL_TIMEOUT: float = 30
+    # 数据库服务端分配给本服务的总连接数，大于0时按worker数量计算每个进程的连接池大小，
+    # 不再使用DB_POOL_SIZE
+    DB_CONNECTION_BUDGET: int = 0
+    # 总连接数中预留给订单消费者进程、数据库迁移等的连接数
+    DB_CONNECTION_RESERVED: int = 10
+    # uvicorn/gunicorn的worker进程数量
+    WEB_CONCURRENCY: int = 1
+    # 获取连接等待超过多少秒记录调用栈
+    DB_POOL_SLOW_CHECKOUT_SECONDS: float = 1
+    # 连接占用超过多少秒记录调用栈
+    DB_POOL_LONG_HELD_SECONDS: float = 10
+    # 检测长时间占用连接的间隔（秒）
+    DB_POOL_WATCH_INTERVAL: float = 5
 
     # 公众号-开发者ID(AppID)
     GZX_ID: str = "wx91df1c5a300ddc3d"  # 微信公众号ID
@@ -33,6 +49,33 @@ class Settings(BaseSettings):
     NOTIFY_URL = (
         "http://hx.wohuayuan.com/hs/api/v1/doctor/subscribe/paycallback"  # 支付回调
     )
+    # 微信支付接口单次请求超时时间（秒）
+    WX_PAY_TIMEOUT: float = 10
+    # 微信支付连接池最大连接数
+    WX_PAY_MAX_CONNECTIONS: int = 100
+    # 微信支付连接池保持的长连接数
+    WX_PAY_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    # 同时请求微信支付接口的并发数上限
+    WX_PAY_MAX_CONCURRENCY: int = 50
+    # 微信公众号接口单次请求超时时间（秒）
+    WX_CLIENT_TIMEOUT: float = 10
+    # access_token提前刷新的秒数
+    WX_TOKEN_REFRESH_AHEAD: int = 300
+    # 模板消息投递队列的长度
+    WX_TEMPLATE_QUEUE_MAXSIZE: int = 10000
+    # 模板消息每批发送的数量
+    WX_TEMPLATE_BATCH_SIZE: int = 20
+    # 模板消息发送协程数
+    WX_TEMPLATE_WORKERS: int = 2
+    # 模板消息每秒发送数量上限
+    WX_TEMPLATE_RATE: float = 50
+    # 模板消息发送失败的最大重试次数
+    WX_TEMPLATE_MAX_RETRIES: int = 5
+    # 模板消息溢出、死信保存的redis列表
+    WX_TEMPLATE_SPILL_KEY: str = "booking:wx_template:spill"
+    WX_TEMPLATE_DEAD_LETTER_KEY: str = "booking:wx_template:dead_letter"
+    # 服务关闭时等待正在发送的模板消息的最长时间（秒）
+    WX_TEMPLATE_STOP_TIMEOUT: float = 10
 
     #  没有值的情况下的默认值--默认情况下读取的环境变量的值
     # 链接用户名
@@ -47,6 +90,86 @@ class Settings(BaseSettings):
     VIRTUAL_HOST: str = "yuyueguahao"
     # 心跳检测
     RABBIT_HEARTBEAT = 5
+    # 是否开启发布确认
+    RABBIT_PUBLISHER_CONFIRMS: bool = True
+    # 启动时连接失败的重试次数
+    RABBIT_CONNECT_RETRIES: int = 5
+    # 重连的间隔时间（秒），启动重试时按指数退避
+    RABBIT_RECONNECT_INTERVAL: float = 1.0
+    # 超时订单消费者的预取消息数
+    ORDER_CONSUMER_PREFETCH: int = 500
+    # 超时订单每批合并处理的消息数
+    ORDER_CONSUMER_BATCH_SIZE: int = 200
+    # 超时订单消息不足一批时的最长等待时间（秒）
+    ORDER_CONSUMER_FLUSH_INTERVAL: float = 0.5
+    # 订单超时延时消息的调度后端：tiered（按延时分层的队列） 或 redis（有序集合）
+    ORDER_DELAY_BACKEND: str = "tiered"
+    # 延时消息到期后投递的交换机，即超时订单消费者监听的死信交换机
+    ORDER_DELAY_TARGET_EXCHANGE: str = "xz-dead-letter-exchange"
+    # 分层队列的名称前缀，队列名称如 xz-order-delay.900s
+    ORDER_DELAY_QUEUE_PREFIX: str = "xz-order-delay"
+    # redis后端保存延时消息的有序集合
+    ORDER_DELAY_ZSET_KEY: str = "booking:order_delay"
+    # redis后端轮询到期消息的间隔（秒）
+    ORDER_DELAY_POLL_INTERVAL: float = 0.5
+    # redis后端每次最多取出的到期消息数
+    ORDER_DELAY_BATCH_SIZE: int = 500
+    # redis后端取出的消息的投递租约（秒），到期未确认投递的消息会被重新取出投递
+    ORDER_DELAY_LEASE_SECONDS: float = 30
+
+    # 没有配置环境变量ORDER_WORKER_ID时，通过redis租用订单号进程编号的key前缀
+    ORDER_WORKER_KEY_PREFIX: str = "booking:order_worker:"
+    # 订单号进程编号的租约时长（秒）
+    ORDER_WORKER_LEASE_TTL: int = 60
+    # 没有配置ORDER_WORKER_ID也没有启用redis时是否启动失败，多进程/多副本部署时建议开启
+    ORDER_WORKER_ID_REQUIRED: bool = False
+
+    # redis链接地址，例如：redis://redis:6379/0，为空的时候不启用redis，使用进程内的实现
+    REDIS_URL: str = ""
+    # redis连接池最大连接数
+    REDIS_MAX_CONNECTIONS: int = 100
+    # 读穿缓存：进程内缓存的最大key数量
+    READ_CACHE_LOCAL_MAXSIZE: int = 1024
+    # 读穿缓存：进程内缓存过期时间（秒），其他worker的变更最多延迟这么久可见
+    READ_CACHE_LOCAL_TTL: float = 10
+    # 读穿缓存：redis缓存过期时间（秒）
+    READ_CACHE_REDIS_TTL: float = 300
+    # 读穿缓存：redis key前缀
+    READ_CACHE_KEY_PREFIX: str = "booking:cache:"
+    # 读穿缓存：按key统计指标时保留的最近访问的key数量
+    READ_CACHE_KEY_STATS_MAXSIZE: int = 200
+    # 排班日历按天汇总信息的缓存时间（秒），包含库存信息，不宜过长
+    SCHEDULING_CALENDAR_CACHE_TTL: float = 5
+    # 号源库存推送：redis pub/sub 频道
+    STOCK_PUSH_CHANNEL: str = "booking:stock"
+    # 号源库存推送：合并推送的周期（秒），周期内同一个号源只推送最新的库存
+    STOCK_PUSH_FLUSH_INTERVAL: float = 0.2
+    # 号源库存推送：SSE连接的心跳间隔（秒）
+    STOCK_PUSH_HEARTBEAT_INTERVAL: float = 15
+    # 幂等处理：已处理集合的过期时间（秒），需要覆盖微信支付回调的最长重试时间（约24小时）
+    IDEMPOTENT_TTL: float = 90000
+    # 幂等处理：进程内已处理集合的最大key数量
+    IDEMPOTENT_LOCAL_MAXSIZE: int = 10000
+    # 幂等处理：redis key前缀
+    IDEMPOTENT_KEY_PREFIX: str = "booking:idempotent:"
+    # 准入控制：是否启用
+    ADMISSION_ENABLED: bool = True
+    # 准入控制：需要控制的路由前缀和每个进程的并发许可数，前缀相同的路由共用许可，
+    # 总数需要小于数据库连接池大小，给其他读接口留出连接
+    ADMISSION_ROUTE_LIMITS: Dict[str, int] = {
+        "/api/v1/doctor_reserve_order": 30,
+        "/api/v1/doctor_order_check": 10,
+    }
+    # 准入控制：每个路由前缀最多排队的请求数，超过直接拒绝
+    ADMISSION_MAX_WAITING: int = 2000
+    # 准入控制：预计等待时间超过多少秒时直接拒绝
+    ADMISSION_MAX_ESTIMATED_WAIT: float = 30
+    # 准入控制：请求在服务端最多等待多少秒，超过返回排队凭证
+    ADMISSION_HOLD_SECONDS: float = 2
+    # 准入控制：排队凭证的有效期（秒），客户端需要在有效期内带上凭证重试
+    ADMISSION_TICKET_TTL: float = 60
+    # 准入控制：轮到的凭证为它预留许可的时间（秒）
+    ADMISSION_READY_TTL: float = 5
 
 
 @lru_cache()
@@ -11,6 +11,7 @@ from sqlalchemy.engine.url import URL
 
 # URL地址格式
 from config.config import get_settings
+from db.pool_monitor import get_pool_options, InstrumentedAsyncAdaptedQueuePool
 
 # 创建异步引擎对象
 settings = get_settings()
@@ -24,8 +25,9 @@ async_engine = create_async_engine(
         settings.DB_DATABASE,
     ),
     echo=settings.DB_ECHO,
-    pool_size=settings.DB_POOL_SIZE,
-    max_overflow=settings.DB_MAX_OVERFLOW,
+    # 连接池大小按配置的总连接数和worker数量计算，并记录连接池的监控指标
+    poolclass=InstrumentedAsyncAdaptedQueuePool,
+    **get_pool_options(settings),
     future=True,
 )
 
@@ -47,7 +49,6 @@ async def depends_get_db_session() -> AsyncGenerator[AsyncSession, None]:
     db_session = None
     try:
         db_session = AsyncSessionLocal()
-        print("获取会话！！！！")
         yield db_session
         await db_session.commit()
     except SQLAlchemyError as ex:
@@ -0,0 +1,153 @@
+#!/usr/bin/evn python
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   文件名称 :     index_benchmark
+   文件功能描述 :   预约订单表热点查询的索引压测
+   创建人 :       小钟同学
+   创建时间 :          2022/6/20
+-------------------------------------------------
+   修改描述-2022/6/20:
+   在独立的 bench schema 中复制 doctor_subscribeinfo 表结构，生成大量的订单数据，
+   分别在只有原来的单列索引（dno、orderid）和加上 alembic 迁移中的组合索引、部分索引后，
+   统计热点查询的耗时，不会影响 public 下的业务数据。
+
+   python -m db.index_benchmark --rows 2000000 --users 200000 --loops 500
+-------------------------------------------------
+"""
+import argparse
+import random
+import statistics
+import time
+
+from sqlalchemy import text
+
+from db.sync_database import sync_engine
+
+BENCH_TABLE = "bench.doctor_subscribeinfo"
+
+# 和 alembic/versions 中的索引保持一致
+HOT_INDEXES = [
+    f"CREATE INDEX bench_uopenid_statue_ctime_id ON {BENCH_TABLE} (visit_uopenid, statue, create_time, id)",
+    f"CREATE INDEX bench_uopenid_ctime_id ON {BENCH_TABLE} (visit_uopenid, create_time, id)",
+    f"CREATE INDEX bench_unpay_uopenid ON {BENCH_TABLE} (visit_uopenid) WHERE statue = 1",
+    f"CREATE INDEX bench_dno_orderid_uopenid ON {BENCH_TABLE} (dno, orderid, visit_uopenid)",
+]
+
+HOT_QUERIES = {
+    # 下单前检测是否存在未支付的订单
+    "unpay_order_exists": f"SELECT 1 FROM {BENCH_TABLE} "
+    "WHERE visit_uopenid = :visit_uopenid AND statue = 1 LIMIT 1",
+    # 用户订单列表
+    "user_order_list": f"SELECT orderid, statue, dno, visittime, visitday, payfee FROM {BENCH_TABLE} "
+    "WHERE visit_uopenid = :visit_uopenid AND statue = :statue "
+    "ORDER BY create_time DESC, id DESC LIMIT 21",
+    # 用户订单列表翻页（游标分页）
+    "user_order_list_next_page": f"SELECT orderid, statue, dno, visittime, visitday, payfee FROM {BENCH_TABLE} "
+    "WHERE visit_uopenid = :visit_uopenid AND (create_time, id) < (now(), :id) "
+    "ORDER BY create_time DESC, id DESC LIMIT 21",
+    # 支付回调、取消订单按订单查询更新
+    "order_by_dno_orderid_uopenid": f"SELECT statue, nsindex FROM {BENCH_TABLE} "
+    "WHERE dno = :dno AND orderid = :orderid AND visit_uopenid = :visit_uopenid",
+}
+
+
+def seed(conn, rows, users, doctors):
+    conn.execute(text("CREATE SCHEMA IF NOT EXISTS bench"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {BENCH_TABLE}"))
+    conn.execute(
+        text(
+            f"CREATE TABLE {BENCH_TABLE} (LIKE public.doctor_subscribeinfo INCLUDING DEFAULTS)"
+        )
+    )
+    # 订单状态大部分是已支付、取消、超时，未支付的只占少数
+    conn.execute(
+        text(
+            f"""
+            INSERT INTO {BENCH_TABLE} (id, dno, orderid, nsindex, statue, visitday, visittime,
+                payfee, visit_uopenid, visit_uname, visit_uphone, visit_statue, create_time)
+            SELECT g,
+                   'D' || (g % :doctors),
+                   lpad(g::text, 20, '0'),
+                   'D' || (g % :doctors) || '-' || (g % 30),
+                   CASE WHEN g % 50 = 0 THEN 1 ELSE 2 + g % 4 END,
+                   '2022-06-20', '周一 上午 08:00-09:00', '30',
+                   'openid_' || (g % :users), '测试', '13800000000', 1,
+                   now() - (g || ' seconds')::interval
+            FROM generate_series(1, :rows) AS g
+            """
+        ),
+        {"rows": rows, "users": users, "doctors": doctors},
+    )
+    # 原来只有的单列索引
+    conn.execute(text(f"CREATE INDEX bench_dno ON {BENCH_TABLE} (dno)"))
+    conn.execute(text(f"CREATE INDEX bench_orderid ON {BENCH_TABLE} (orderid)"))
+    conn.execute(text(f"ANALYZE {BENCH_TABLE}"))
+
+
+def make_params(rows, users, doctors):
+    g = random.randint(1, rows)
+    return {
+        "visit_uopenid": f"openid_{g % users}",
+        "statue": 2,
+        "dno": f"D{g % doctors}",
+        "orderid": str(g).zfill(20),
+        "id": g,
+    }
+
+
+def run_queries(conn, loops, rows, users, doctors):
+    report = {}
+    for name, sql in HOT_QUERIES.items():
+        statement = text(sql)
+        costs = []
+        for _ in range(loops):
+            params = make_params(rows, users, doctors)
+            start = time.perf_counter()
+            conn.execute(statement, params).fetchall()
+            costs.append((time.perf_counter() - start) * 1000)
+        costs.sort()
+        report[name] = {
+            "avg": statistics.mean(costs),
+            "p50": costs[len(costs) // 2],
+            "p99": costs[int(len(costs) * 0.99) - 1],
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="预约订单表热点查询的索引压测")
+    parser.add_argument("--rows", type=int, default=2000000, help="生成的订单数")
+    parser.add_argument("--users", type=int, default=200000, help="预约用户数")
+    parser.add_argument("--doctors", type=int, default=50, help="医生数")
+    parser.add_argument("--loops", type=int, default=500, help="每个查询执行次数")
+    parser.add_argument("--keep", action="store_true", help="保留压测数据")
+    args = parser.parse_args()
+
+    with sync_engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        print(f"生成 {args.rows} 条订单数据...")
+        start = time.perf_counter()
+        seed(conn, args.rows, args.users, args.doctors)
+        print(f"生成完成，耗时 {time.perf_counter() - start:.1f}s")
+
+        before = run_queries(conn, args.loops, args.rows, args.users, args.doctors)
+        for sql in HOT_INDEXES:
+            conn.execute(text(sql))
+        conn.execute(text(f"ANALYZE {BENCH_TABLE}"))
+        after = run_queries(conn, args.loops, args.rows, args.users, args.doctors)
+
+        print(f"{'query':<32}{'before avg/p50/p99 (ms)':>30}{'after avg/p50/p99 (ms)':>30}")
+        for name in HOT_QUERIES:
+            b, a = before[name], after[name]
+            print(
+                f"{name:<32}"
+                f"{b['avg']:>10.3f}{b['p50']:>10.3f}{b['p99']:>10.3f}"
+                f"{a['avg']:>10.3f}{a['p50']:>10.3f}{a['p99']:>10.3f}"
+            )
+        if not args.keep:
+            conn.execute(text("DROP SCHEMA bench CASCADE"))
+
+
+if __name__ == "__main__":
+    main()
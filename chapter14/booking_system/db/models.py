@@ -7,6 +7,7 @@ from sqlalchemy import (
     SmallInteger,
     Text,
     UniqueConstraint,
+    Index,
     text,
     DECIMAL,
     Numeric,
@@ -19,7 +20,13 @@ metadata = Base.metadata
 
 class DoctorScheduling(Base):
     __tablename__ = "doctor_scheduling"
-    __table_args__ = {"comment": "医生排班信息表"}
+    __table_args__ = (
+        # 排班按医生和日期范围查询
+        Index("ix_doctor_scheduling_dno_enable_dnotime", "dno", "enable", "dnotime"),
+        # 排班日历按日期汇总所有医生的排班
+        Index("ix_doctor_scheduling_enable_dnotime", "enable", "dnotime"),
+        {"comment": "医生排班信息表"},
+    )
 
     id = Column(
         Integer,
@@ -57,7 +64,43 @@ class DoctorScheduling(Base):
 
 class DoctorSubscribeinfo(Base):
     __tablename__ = "doctor_subscribeinfo"
-    __table_args__ = {"comment": "预约信息详情表"}
+    __table_args__ = (
+        # 用户订单列表，按订单状态筛选，(create_time, id) 用于游标分页
+        Index(
+            "ix_doctor_subscribeinfo_uopenid_statue_ctime_id",
+            "visit_uopenid",
+            "statue",
+            "create_time",
+            "id",
+        ),
+        # 用户订单列表，不按订单状态筛选
+        Index(
+            "ix_doctor_subscribeinfo_uopenid_ctime_id",
+            "visit_uopenid",
+            "create_time",
+            "id",
+        ),
+        # 只包含未支付订单的部分索引，下单前检测是否存在未支付的订单
+        Index(
+            "ix_doctor_subscribeinfo_unpay_uopenid",
+            "visit_uopenid",
+            postgresql_where=text("statue = 1"),
+        ),
+        # 订单编号唯一，同时作为微信支付的 out_trade_no
+        Index(
+            "ux_doctor_subscribeinfo_orderid",
+            "orderid",
+            unique=True,
+        ),
+        # 支付回调、取消订单等按订单更新
+        Index(
+            "ix_doctor_subscribeinfo_dno_orderid_uopenid",
+            "dno",
+            "orderid",
+            "visit_uopenid",
+        ),
+        {"comment": "预约信息详情表"},
+    )
 
     id = Column(
         Integer,
@@ -72,9 +115,7 @@ class DoctorSubscribeinfo(Base):
         server_default=text("''::text"),
         comment="所属医生编号",
     )
-    orderid = Column(
-        Text, index=True, server_default=text("''::text"), comment="订单编号"
-    )
+    orderid = Column(Text, server_default=text("''::text"), comment="订单编号")
     nsindex = Column(Text, server_default=text("''::text"), comment="订单编号")
     statue = Column(
         Integer,
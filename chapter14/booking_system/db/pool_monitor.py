@@ -0,0 +1,361 @@
+"""
+数据库连接池的监控和按worker数量分配连接池大小
+
+以前只能从接口500才知道连接池耗尽了，这里提供：
+1：获取连接的等待时间直方图、使用中/空闲连接数、正在等待连接的数量，
+   通过 /metrics 接口输出Prometheus格式的指标
+2：获取连接超过 DB_POOL_SLOW_CHECKOUT_SECONDS 秒时记录当时的调用栈；
+   连接占用超过 DB_POOL_LONG_HELD_SECONDS 秒时记录占用连接的协程（或线程）当前的调用栈，
+   调用栈在检测到的时候才获取，正常获取连接时没有额外的开销
+3：配置了数据库服务端给本服务的连接数 DB_CONNECTION_BUDGET 时，
+   按worker数量平均分配每个进程的连接池大小
+"""
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+import traceback
+import typing
+import weakref
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+# 获取连接等待时间和连接占用时间的直方图分桶（秒）
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+HELD_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def get_pool_options(settings) -> typing.Dict:
+    """
+    根据配置计算每个进程的连接池参数
+    配置了 DB_CONNECTION_BUDGET 时，扣除预留给消费者进程等的连接数后按worker数量平均分配，
+    每个进程的 pool_size + max_overflow 不超过分到的连接数
+    """
+    pool_size = settings.DB_POOL_SIZE
+    max_overflow = settings.DB_MAX_OVERFLOW
+    if settings.DB_CONNECTION_BUDGET > 0:
+        workers = max(settings.WEB_CONCURRENCY, 1)
+        per_worker = max(
+            (settings.DB_CONNECTION_BUDGET - settings.DB_CONNECTION_RESERVED)
+            // workers,
+            1,
+        )
+        max_overflow = min(max_overflow, per_worker - 1)
+        pool_size = per_worker - max_overflow
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+    }
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels) -> typing.List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class PoolStats:
+    """单个连接池的统计信息"""
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.waiting = 0
+        self.checkout_wait = Histogram(WAIT_BUCKETS)
+        self.held_time = Histogram(HELD_BUCKETS)
+        self.checkout_timeouts = 0
+        self.slow_checkouts = 0
+        self.long_held = 0
+        # 使用中的连接 {连接记录: [获取时间, 占用者, 是否已经报告过]}
+        self.held: typing.Dict[typing.Any, typing.List] = {}
+
+
+def _current_owner():
+    """占用连接的协程，没有事件循环时是当前线程"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return weakref.ref(task)
+    return threading.get_ident()
+
+
+def _format_owner_stack(owner, limit=20) -> str:
+    if isinstance(owner, weakref.ref):
+        task = owner()
+        if task is None:
+            return "<协程已结束>"
+        frames = task.get_stack(limit=limit)
+        summary = traceback.StackSummary.extract(
+            ((frame, frame.f_lineno) for frame in frames)
+        )
+        return f"{task.get_name()}\n" + "".join(summary.format())
+    frame = sys._current_frames().get(owner)
+    if frame is None:
+        return "<线程已结束>"
+    return f"thread-{owner}\n" + "".join(traceback.format_stack(frame, limit=limit))
+
+
+def _format_current_stack(limit=20) -> str:
+    owner = _current_owner()
+    if isinstance(owner, weakref.ref):
+        return _format_owner_stack(owner, limit)
+    # 去掉连接池内部的调用
+    return "".join(traceback.format_stack(sys._getframe(2), limit=limit))
+
+
+class PoolInstrumentMixin:
+    """记录获取连接的等待时间和连接的占用情况"""
+
+    metrics_name = "default"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 连接池重建（recreate）时替换成新的连接池
+        self._stats = db_pool_monitor.register(self.metrics_name, self)
+
+    def _do_get(self):
+        stats = self._stats
+        stats.waiting += 1
+        start_time = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            stats.checkout_timeouts += 1
+            logger.warning(
+                "数据库连接池[%s]获取连接超时，使用中%s个，等待中%s个\n%s",
+                self.metrics_name,
+                self.checkedout(),
+                stats.waiting,
+                _format_current_stack(),
+            )
+            raise
+        finally:
+            stats.waiting -= 1
+        waited = time.perf_counter() - start_time
+        stats.checkout_wait.observe(waited)
+        if waited > db_pool_monitor.slow_checkout_seconds:
+            stats.slow_checkouts += 1
+            logger.warning(
+                "数据库连接池[%s]获取连接等待了%.3f秒\n%s",
+                self.metrics_name,
+                waited,
+                _format_current_stack(),
+            )
+        stats.held[record] = [time.perf_counter(), _current_owner(), False]
+        return record
+
+    def _do_return_conn(self, conn):
+        held = self._stats.held.pop(conn, None)
+        if held is not None:
+            self._stats.held_time.observe(time.perf_counter() - held[0])
+        super()._do_return_conn(conn)
+
+
+class InstrumentedAsyncAdaptedQueuePool(PoolInstrumentMixin, AsyncAdaptedQueuePool):
+    metrics_name = "async"
+
+
+class InstrumentedQueuePool(PoolInstrumentMixin, QueuePool):
+    metrics_name = "sync"
+
+
+class DBPoolMonitor:
+    pass
+
+    def __init__(self, app: FastAPI = None):
+        self.pools: typing.Dict[str, PoolStats] = {}
+        # 其他模块注册的指标输出函数，和连接池指标一起从 /metrics 输出
+        self.collectors: typing.List[typing.Callable[[], str]] = []
+        self.slow_checkout_seconds = 1.0
+        self.long_held_seconds = 10.0
+        self.watch_interval = 5.0
+        self._task: typing.Optional[asyncio.Task] = None
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None)
+
+    def init_app(self, app: FastAPI, poolconf, metrics_path="/metrics"):
+        """
+        :param app: 注册指标接口和长时间占用连接的检测任务
+        :param poolconf: 配置信息
+        :param metrics_path: Prometheus指标接口的路径
+        :return:
+        """
+        self.app = app
+        if poolconf is not None:
+            self.slow_checkout_seconds = poolconf.DB_POOL_SLOW_CHECKOUT_SECONDS
+            self.long_held_seconds = poolconf.DB_POOL_LONG_HELD_SECONDS
+            self.watch_interval = poolconf.DB_POOL_WATCH_INTERVAL
+
+        @app.get(metrics_path, include_in_schema=False)
+        async def db_pool_metrics():
+            return PlainTextResponse(
+                "".join(
+                    [self.render_prometheus()]
+                    + [collector() for collector in self.collectors]
+                ),
+                media_type="text/plain; version=0.0.4; charset=utf-8",
+            )
+
+        @app.on_event("startup")
+        async def startup_event():
+            self._task = asyncio.create_task(self._watch_loop())
+
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            if self._task is not None:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                self._task = None
+
+    def register_collector(self, collector: typing.Callable[[], str]):
+        """注册其他模块的Prometheus格式指标，如读穿缓存的命中率"""
+        self.collectors.append(collector)
+
+    def register(self, name, pool) -> PoolStats:
+        stats = PoolStats(name, pool)
+        self.pools[name] = stats
+        return stats
+
+    def check_long_held(self) -> int:
+        """记录占用连接时间过长的调用栈，每次占用只记录一次"""
+        found = 0
+        now = time.perf_counter()
+        for stats in self.pools.values():
+            for held in list(stats.held.values()):
+                start_time, owner, reported = held
+                if reported or now - start_time < self.long_held_seconds:
+                    continue
+                held[2] = True
+                stats.long_held += 1
+                found += 1
+                logger.warning(
+                    "数据库连接池[%s]的连接已经被占用了%.1f秒\n%s",
+                    stats.name,
+                    now - start_time,
+                    _format_owner_stack(owner),
+                )
+        return found
+
+    async def _watch_loop(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                self.check_long_held()
+            except Exception:
+                logger.exception("数据库连接池检测异常")
+
+    def render_prometheus(self) -> str:
+        lines = []
+
+        def metric(name, kind, doc, values):
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            for stats in self.pools.values():
+                labels = f'pool="{stats.name}"'
+                value = values(stats)
+                if isinstance(value, Histogram):
+                    lines.extend(value.render(name, labels))
+                else:
+                    lines.append(f"{name}{{{labels}}} {value}")
+
+        metric(
+            "db_pool_size",
+            "gauge",
+            "Configured pool size",
+            lambda s: s.pool.size(),
+        )
+        metric(
+            "db_pool_max_overflow",
+            "gauge",
+            "Configured max overflow",
+            lambda s: s.pool._max_overflow,
+        )
+        metric(
+            "db_pool_in_use",
+            "gauge",
+            "Connections checked out",
+            lambda s: s.pool.checkedout(),
+        )
+        metric(
+            "db_pool_idle",
+            "gauge",
+            "Idle connections in the pool",
+            lambda s: s.pool.checkedin(),
+        )
+        metric(
+            "db_pool_overflow",
+            "gauge",
+            "Connections opened beyond pool size",
+            lambda s: max(s.pool.overflow(), 0),
+        )
+        metric(
+            "db_pool_waiting",
+            "gauge",
+            "Checkouts waiting for a connection",
+            lambda s: s.waiting,
+        )
+        metric(
+            "db_pool_checkout_wait_seconds",
+            "histogram",
+            "Time spent waiting for a connection",
+            lambda s: s.checkout_wait,
+        )
+        metric(
+            "db_pool_held_seconds",
+            "histogram",
+            "Time a connection was held before checkin",
+            lambda s: s.held_time,
+        )
+        metric(
+            "db_pool_checkout_timeouts_total",
+            "counter",
+            "Checkouts that timed out",
+            lambda s: s.checkout_timeouts,
+        )
+        metric(
+            "db_pool_slow_checkouts_total",
+            "counter",
+            "Checkouts slower than the slow threshold",
+            lambda s: s.slow_checkouts,
+        )
+        metric(
+            "db_pool_long_held_total",
+            "counter",
+            "Connections held longer than the long-held threshold",
+            lambda s: s.long_held,
+        )
+        return "\n".join(lines) + "\n"
+
+
+db_pool_monitor = DBPoolMonitor()
@@ -8,6 +8,7 @@ from sqlalchemy.engine.url import URL
 
 # URL地址格式
 from config.config import get_settings
+from db.pool_monitor import get_pool_options, InstrumentedQueuePool
 from sqlalchemy import create_engine
 
 # 创建异步引擎对象
@@ -25,8 +26,9 @@ sync_engine = create_engine(
         settings.DB_DATABASE,
     ),
     echo=settings.DB_ECHO,
-    pool_size=settings.DB_POOL_SIZE,
-    max_overflow=settings.DB_MAX_OVERFLOW,
+    # 连接池大小按配置的总连接数和worker数量计算，并记录连接池的监控指标
+    poolclass=InstrumentedQueuePool,
+    **get_pool_options(settings),
     future=True,
 )
 
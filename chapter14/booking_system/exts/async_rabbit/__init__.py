@@ -1,19 +1,33 @@
 from aio_pika import ExchangeType
 from fastapi import FastAPI
-from pika.exceptions import UnroutableError
-import pika
 
-import threading
 import aio_pika
 import asyncio
+import typing
 from aio_pika import Message, connect_robust
 from aio_pika.abc import AbstractIncomingMessage
+from aio_pika.exceptions import DeliveryError, AMQPConnectionError, ChannelInvalidStateError
 
 
 class AsyncRabbitMQClint:
-    pass
+    """
+    异步的rabbitmq客户端
+
+    1：每个交换机使用各自独立的信道发布消息，发布时需要指定交换机的名称
+    2：可选开启发布确认（publisher confirms），批量发布时并发等待确认
+    3：connect_robust 断线自动重连，启动时连接失败按指数退避重试，信道关闭后自动重新打开
+    """
 
     def __init__(self, app: FastAPI = None):
+        self.connection: aio_pika.abc.AbstractRobustConnection = None
+        # 交换机名称 -> 信道
+        self._channels: typing.Dict[str, aio_pika.abc.AbstractChannel] = {}
+        # 交换机名称 -> 交换机
+        self._exchanges: typing.Dict[str, aio_pika.abc.AbstractExchange] = {}
+        # 队列名称 -> 队列
+        self._queues: typing.Dict[str, aio_pika.abc.AbstractQueue] = {}
+        self._channel_lock = asyncio.Lock()
+        self.publisher_confirms = False
         # 如果有APPC传入则直接的进行初始化的操作即可
         if app is not None:
             self.init_app(app, None, None)
@@ -32,77 +46,167 @@ class AsyncRabbitMQClint:
             await self._clear_all()
 
     async def init_sync_rabbit(self, rabbitconf):
-        self.connection = await aio_pika.connect_robust(
-            host=rabbitconf.RABBIT_HOST,
-            port=rabbitconf.RABBIT_PORT,
-            virtualhost=rabbitconf.VIRTUAL_HOST,
-            login=rabbitconf.RABBIT_USERNAME,
-            loop=asyncio.get_event_loop(),
-            password=rabbitconf.RABBIT_PASSWORD,
-        )
-        # channel_number: int = None,
-        # publisher_confirms: bool = True,
-        # on_return_raises: bool = False,
+        self.publisher_confirms = rabbitconf.RABBIT_PUBLISHER_CONFIRMS
+        retries = rabbitconf.RABBIT_CONNECT_RETRIES
+        for attempt in range(retries):
+            try:
+                self.connection = await connect_robust(
+                    host=rabbitconf.RABBIT_HOST,
+                    port=rabbitconf.RABBIT_PORT,
+                    virtualhost=rabbitconf.VIRTUAL_HOST,
+                    login=rabbitconf.RABBIT_USERNAME,
+                    password=rabbitconf.RABBIT_PASSWORD,
+                    reconnect_interval=rabbitconf.RABBIT_RECONNECT_INTERVAL,
+                )
+                break
+            except (AMQPConnectionError, ConnectionError, OSError):
+                if attempt == retries - 1:
+                    raise
+                # 指数退避等待后重试
+                await asyncio.sleep(rabbitconf.RABBIT_RECONNECT_INTERVAL * (2**attempt))
+        # 声明交换机和队列使用的管理信道
         self.channel: aio_pika.abc.AbstractChannel = await self.connection.channel(
             publisher_confirms=False
         )
 
+    async def _get_channel(self, exchange_name) -> aio_pika.abc.AbstractChannel:
+        """获取交换机对应的发布信道，不存在或已关闭时重新打开"""
+        channel = self._channels.get(exchange_name)
+        if channel is not None and not channel.is_closed:
+            return channel
+        async with self._channel_lock:
+            channel = self._channels.get(exchange_name)
+            if channel is None or channel.is_closed:
+                channel = await self.connection.channel(
+                    publisher_confirms=self.publisher_confirms
+                )
+                self._channels[exchange_name] = channel
+                # 信道变了，交换机对象需要重新获取
+                self._exchanges.pop(exchange_name, None)
+        return channel
+
+    async def get_exchange(self, exchange_name) -> aio_pika.abc.AbstractExchange:
+        """获取已存在的交换机，''表示默认交换机"""
+        channel = await self._get_channel(exchange_name)
+        # 重新打开信道时 _get_channel 已经删除了旧的交换机对象
+        exchange = self._exchanges.get(exchange_name)
+        if exchange is None:
+            if exchange_name:
+                exchange = await channel.get_exchange(exchange_name, ensure=False)
+            else:
+                exchange = channel.default_exchange
+            self._exchanges[exchange_name] = exchange
+        return exchange
+
     async def make_exchange_declare(
         self, exchange_name, exchange_type="fanout", durable=True
     ):
         """创建交换机"""
         #  if auto_delete and durable is None:
         #             durable = False
-        self.exchange = await self.channel.declare_exchange(
+        channel = await self._get_channel(exchange_name)
+        self._exchanges[exchange_name] = await channel.declare_exchange(
             name=exchange_name, type=exchange_type, auto_delete=False, durable=durable
         )
+        return self._exchanges[exchange_name]
 
     async def make_queue_declare(
         self, queue_name, durable=True, auto_delete=False, arguments=None
     ):
-        self.queue = await self.channel.declare_queue(
+        """创建队列"""
+        self._queues[queue_name] = await self.channel.declare_queue(
             name=queue_name,
             durable=durable,
             auto_delete=auto_delete,
             arguments=arguments,
-            exclusive=True,
         )
+        return self._queues[queue_name]
 
-    async def make_queue_bind(self, exchange_name, routing_key):
+    async def make_queue_bind(self, exchange_name, queue_name, routing_key):
         """同伙routing_key把交换机和队列的绑定"""
-        await self.queue.bind(exchange=exchange_name, routing_key=routing_key)
+        await self._queues[queue_name].bind(
+            exchange=exchange_name, routing_key=routing_key
+        )
+
+    @staticmethod
+    def _make_message(
+        body,
+        content_type="text/plain",
+        content_encoding="utf-8",
+        message_ttl=3,
+        delivery_mode=2,
+        is_delay=False,
+    ):
+        if isinstance(body, str):
+            body = body.encode(content_encoding)
+        if is_delay:
+            return Message(
+                body,
+                expiration=message_ttl,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                delivery_mode=delivery_mode,
+            )
+        return Message(body, delivery_mode=delivery_mode)
 
     async def send_basic_publish(
         self,
         routing_key,
         body,
+        exchange_name="",
         content_type="text/plain",
         content_encoding="utf-8",
         message_ttl=3,
         delivery_mode=2,
         is_delay=False,
+        retries=3,
     ):
-        """生产数据"""
-        # 使用简单的所发的方式来避免多线程的不安全引发的问题
-        try:
-            if is_delay:
-                await self.exchange.publish(
-                    Message(
-                        bytes(body, "utf-8"),
-                        expiration=message_ttl * 1000,
-                        content_type=content_type,
-                        content_encoding=content_encoding,
-                        delivery_mode=delivery_mode,
-                    ),
-                    routing_key=routing_key,
-                )
-            else:
-                await self.exchange.publish(
-                    Message(bytes(body, "utf-8"), delivery_mode=delivery_mode),
-                    routing_key=routing_key,
+        """
+        生产数据
+        :return: 是否发送成功，开启发布确认时服务端确认后才返回True
+        """
+        message = self._make_message(
+            body,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            message_ttl=message_ttl,
+            delivery_mode=delivery_mode,
+            is_delay=is_delay,
+        )
+        for attempt in range(retries):
+            try:
+                exchange = await self.get_exchange(exchange_name)
+                await exchange.publish(message, routing_key=routing_key)
+                return True
+            except DeliveryError:
+                print("消息发送失败")
+                return False
+            except (ChannelInvalidStateError, AMQPConnectionError, ConnectionError):
+                # 信道或连接已断开，等待重连后重新发送
+                self._channels.pop(exchange_name, None)
+                await asyncio.sleep(0.1 * (2**attempt))
+        return False
+
+    async def publish_batch(
+        self, exchange_name, messages: typing.Iterable[typing.Tuple[str, typing.Any]], **kwargs
+    ):
+        """
+        批量发布消息，开启发布确认时并发等待服务端的确认，而不是逐条等待
+        :param exchange_name: 交换机名称
+        :param messages: (routing_key, body) 列表
+        :return: 每条消息是否发送成功
+        """
+        exchange = await self.get_exchange(exchange_name)
+        results = await asyncio.gather(
+            *(
+                exchange.publish(
+                    self._make_message(body, **kwargs), routing_key=routing_key
                 )
-        except UnroutableError:
-            print("消息发送失败")
+                for routing_key, body in messages
+            ),
+            return_exceptions=True,
+        )
+        return [not isinstance(result, BaseException) for result in results]
 
     async def _close_connect(self):
         """
@@ -121,15 +225,21 @@ class AsyncRabbitMQClint:
         if not hasattr(self, "channel"):
             raise ValueError("the object of SenderClient has not attr of channel.")
 
+        for channel in self._channels.values():
+            if not channel.is_closed:
+                await channel.close()
+        self._channels.clear()
+        self._exchanges.clear()
+        self._queues.clear()
         await self.channel.close()
 
     async def _clear_all(self):
         """清理连接与信道"""
-        await self._close_connect()
-        self.connection = None
-
         await self._close_channel()
         self.channel = None
 
+        await self._close_connect()
+        self.connection = None
+
 
 async_rabbit_client = AsyncRabbitMQClint()
@@ -0,0 +1,48 @@
+from fastapi import FastAPI
+import aioredis
+
+
+class AsyncRedisClient:
+    pass
+
+    def __init__(self, app: FastAPI = None):
+        # 没有配置REDIS_URL的时候为None，使用方需要退回到进程内的实现
+        self.redis: aioredis.Redis = None
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None)
+
+    def init_app(self, app: FastAPI, redisconf):
+        self.app = app
+        if not redisconf.REDIS_URL:
+            return
+        # from_url 只是创建连接池，第一次执行命令的时候才会真正建立连接
+        self.redis = aioredis.from_url(
+            redisconf.REDIS_URL,
+            encoding="utf-8",
+            decode_responses=True,
+            max_connections=redisconf.REDIS_MAX_CONNECTIONS,
+        )
+
+    def init_shutdown(self, app: FastAPI):
+        """
+        注册关闭连接池的shutdown事件，shutdown事件按注册的顺序执行，
+        其他扩展关闭时还需要使用redis（如溢出未发送的消息），所以需要在它们之后注册
+        """
+
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            await self._clear_all()
+
+    @property
+    def enabled(self):
+        return self.redis is not None
+
+    async def _clear_all(self):
+        """关闭连接池"""
+        if self.redis is not None:
+            await self.redis.close()
+        self.redis = None
+
+
+async_redis_client = AsyncRedisClient()
@@ -0,0 +1,274 @@
+"""
+订单超时等延时消息的调度
+
+原来的实现是给每条消息设置 expiration 后投递到同一个队列，由队列的死信交换机转发。
+rabbitmq 只会在消息到达队头时才检查是否过期，15分钟的消息排在前面时，后面5秒的消息也要
+跟着等15分钟。这里提供两种可替换的调度后端，发布接口保持一致：
+
+1：tiered（默认）：按延时时长自动创建分层队列（队列级别的 x-message-ttl），同一个队列里
+   的消息延时相同，先进先出，不存在队头阻塞，到期后由死信交换机转发给超时订单消费者
+2：redis：消息按到期时间放入 redis 的有序集合，后台协程定时批量取出到期的消息，
+   直接投递到超时订单消费者的交换机，百万级待处理订单也只需要 O(logN) 的读写；
+   取出的消息先移到处理中的有序集合（score为租约到期时间），投递成功后才删除，
+   进程在投递前退出时租约到期后会被重新取出投递（至少投递一次）
+"""
+import asyncio
+import json
+import logging
+import time
+import typing
+import uuid
+
+from fastapi import FastAPI
+
+logger = logging.getLogger(__name__)
+
+
+class DelayBackendBase:
+    """延时消息调度后端"""
+
+    def __init__(self, rabbit_client, target_exchange):
+        self.rabbit_client = rabbit_client
+        # 到期后消息投递的交换机
+        self.target_exchange = target_exchange
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def schedule(self, routing_key, body, delay, content_type):
+        raise NotImplementedError
+
+
+class TieredQueueDelayBackend(DelayBackendBase):
+    """按延时时长分层的队列，每个延时时长一个队列"""
+
+    def __init__(self, rabbit_client, target_exchange, queue_prefix):
+        super().__init__(rabbit_client, target_exchange)
+        self.queue_prefix = queue_prefix
+        self._declared: typing.Set[str] = set()
+        self._declare_lock = asyncio.Lock()
+
+    def tier_queue_name(self, delay):
+        return f"{self.queue_prefix}.{delay}s"
+
+    async def _ensure_tier(self, delay):
+        queue_name = self.tier_queue_name(delay)
+        if queue_name in self._declared:
+            return queue_name
+        async with self._declare_lock:
+            if queue_name not in self._declared:
+                await self.rabbit_client.make_queue_declare(
+                    queue_name=queue_name,
+                    arguments={
+                        # 队列级别的过期时间，队列里的消息延时都相同
+                        "x-message-ttl": int(delay * 1000),
+                        "x-dead-letter-exchange": self.target_exchange,
+                    },
+                )
+                self._declared.add(queue_name)
+        return queue_name
+
+    async def schedule(self, routing_key, body, delay, content_type):
+        queue_name = await self._ensure_tier(delay)
+        # 通过默认交换机直接投递到分层队列
+        return await self.rabbit_client.send_basic_publish(
+            exchange_name="",
+            routing_key=queue_name,
+            body=body,
+            content_type=content_type,
+        )
+
+
+class RedisZSetDelayBackend(DelayBackendBase):
+    """基于redis有序集合的延时调度，score为到期时间戳"""
+
+    # 原子的取出一批已到期的消息移到处理中的集合，多个进程同时轮询时同一条消息只会被一个进程取到；
+    # 处理中的消息租约到期（取出的进程没有确认投递）时先放回待投递的集合
+    CLAIM_DUE_SCRIPT = """
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, item in ipairs(expired) do
+        redis.call('ZADD', KEYS[1], ARGV[1], item)
+    end
+    if #expired > 0 then
+        redis.call('ZREM', KEYS[2], unpack(expired))
+    end
+    local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, item in ipairs(items) do
+        redis.call('ZADD', KEYS[2], ARGV[3], item)
+    end
+    if #items > 0 then
+        redis.call('ZREM', KEYS[1], unpack(items))
+    end
+    return items
+    """
+
+    def __init__(
+        self,
+        rabbit_client,
+        target_exchange,
+        get_redis: typing.Callable,
+        zset_key,
+        poll_interval=0.5,
+        batch_size=500,
+        lease_seconds=30,
+    ):
+        super().__init__(rabbit_client, target_exchange)
+        self.get_redis = get_redis
+        self.zset_key = zset_key
+        # 已取出正在投递的消息
+        self.processing_key = f"{zset_key}:processing"
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._poller: asyncio.Task = None
+
+    async def start(self):
+        if self.get_redis() is None:
+            raise RuntimeError("使用redis延时调度需要配置REDIS_URL")
+        self._claim_due = self.get_redis().register_script(self.CLAIM_DUE_SCRIPT)
+        self._poller = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+    async def schedule(self, routing_key, body, delay, content_type):
+        member = json.dumps(
+            {
+                # 保证相同内容的消息在有序集合里不会互相覆盖
+                "id": uuid.uuid4().hex,
+                "routing_key": routing_key,
+                "body": body,
+                "content_type": content_type,
+            }
+        )
+        await self.get_redis().zadd(self.zset_key, {member: time.time() + delay})
+        return True
+
+    async def _poll(self):
+        while True:
+            try:
+                now = time.time()
+                items = await self._claim_due(
+                    keys=[self.zset_key, self.processing_key],
+                    args=[now, self.batch_size, now + self.lease_seconds],
+                )
+                if items:
+                    await self._fire(items)
+            except Exception:
+                # 没有确认的消息租约到期后会重新投递，轮询不能因为异常停止
+                logger.exception("延时消息轮询失败")
+                await asyncio.sleep(self.poll_interval)
+                continue
+            # 取满一批说明还有积压，不等待继续取
+            if len(items) < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _fire(self, items):
+        done, retry = [], {}
+        for item in items:
+            try:
+                message = json.loads(item)
+            except ValueError:
+                # 格式错误的消息无法投递，直接删除
+                logger.error("延时消息格式错误，丢弃: %s", item)
+                done.append(item)
+                continue
+            try:
+                ok = await self.rabbit_client.send_basic_publish(
+                    exchange_name=self.target_exchange,
+                    routing_key=message["routing_key"],
+                    body=message["body"],
+                    content_type=message["content_type"],
+                )
+            except Exception as ex:
+                logger.warning("延时消息投递失败: %s", ex)
+                ok = False
+            if ok:
+                done.append(item)
+            else:
+                retry[item] = time.time() + self.poll_interval
+        # 投递成功的消息才从处理中的集合删除，投递失败的消息放回去，下一轮再投递
+        async with self.get_redis().pipeline(transaction=True) as pipe:
+            if retry:
+                pipe.zadd(self.zset_key, retry)
+            pipe.zrem(self.processing_key, *done, *retry)
+            await pipe.execute()
+
+
+class DelayScheduler:
+    pass
+
+    def __init__(self, app: FastAPI = None):
+        self.backend: DelayBackendBase = None
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None, None)
+
+    def init_app(
+        self,
+        app: FastAPI,
+        delayconf,
+        rabbit_client,
+        get_redis: typing.Callable = None,
+    ):
+        """
+        需要在rabbit客户端的init_app之后调用，保证启动时rabbit连接已经建立
+        :param app:
+        :param delayconf: 配置信息
+        :param rabbit_client: AsyncRabbitMQClint
+        :param get_redis: 可选，返回 aioredis.Redis 的函数，redis后端需要
+        :return:
+        """
+        self.app = app
+        self.target_exchange = delayconf.ORDER_DELAY_TARGET_EXCHANGE
+        if delayconf.ORDER_DELAY_BACKEND == "redis":
+            self.backend = RedisZSetDelayBackend(
+                rabbit_client,
+                self.target_exchange,
+                get_redis=get_redis,
+                zset_key=delayconf.ORDER_DELAY_ZSET_KEY,
+                poll_interval=delayconf.ORDER_DELAY_POLL_INTERVAL,
+                batch_size=delayconf.ORDER_DELAY_BATCH_SIZE,
+                lease_seconds=delayconf.ORDER_DELAY_LEASE_SECONDS,
+            )
+        else:
+            self.backend = TieredQueueDelayBackend(
+                rabbit_client,
+                self.target_exchange,
+                queue_prefix=delayconf.ORDER_DELAY_QUEUE_PREFIX,
+            )
+
+        @app.on_event("startup")
+        async def startup_event():
+            # 到期消息投递的交换机，和超时订单消费者声明的保持一致
+            await rabbit_client.make_exchange_declare(
+                exchange_name=self.target_exchange, exchange_type="fanout"
+            )
+            await self.backend.start()
+
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            await self.backend.stop()
+
+    async def send_delay_publish(
+        self, routing_key, body, message_ttl, content_type="text/plain"
+    ):
+        """
+        发布一条延时消息，message_ttl 秒后投递到超时订单消费者
+        :return: 是否发布成功
+        """
+        return await self.backend.schedule(
+            routing_key=routing_key,
+            body=body,
+            delay=message_ttl,
+            content_type=content_type,
+        )
+
+
+delay_scheduler = DelayScheduler()
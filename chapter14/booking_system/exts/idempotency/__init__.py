@@ -0,0 +1,123 @@
+"""
+支付回调等外部重复通知的幂等处理
+
+微信支付在没有收到SUCCESS应答时会多次重复通知，同一笔支付的重复通知：
+1：已处理完成的，通过进程内的短期已处理集合（和redis共享的已处理集合）直接判断，不需要访问数据库
+2：同一个进程内正在处理中的，直接返回处理中，由微信稍后重试
+3：最终的正确性由数据库的 UPDATE ... WHERE statue = 1 条件更新保证，已处理集合只是快速路径，
+   redis不可用时退化为只使用进程内集合
+"""
+import logging
+import typing
+
+from fastapi import FastAPI
+
+from exts.read_cache import LocalTTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyGuard:
+    pass
+
+    def __init__(self, app: FastAPI = None):
+        self.local = LocalTTLCache(maxsize=10000)
+        self.get_redis: typing.Callable = lambda: None
+        self.ttl = 86400
+        self.key_prefix = "booking:idempotent:"
+        # 当前进程内正在处理中的key
+        self._inflight: typing.Set[str] = set()
+        # 统计信息
+        self.stats = {
+            "local_hits": 0,
+            "redis_hits": 0,
+            "inflight_hits": 0,
+            "misses": 0,
+            "marked": 0,
+            "redis_errors": 0,
+        }
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None)
+
+    def init_app(self, app: FastAPI, idemconf, get_redis: typing.Callable = None):
+        """
+        :param app:
+        :param idemconf: 配置信息
+        :param get_redis: 可选，返回 aioredis.Redis 的函数，返回None时只使用进程内的已处理集合
+        :return:
+        """
+        self.app = app
+        self.local = LocalTTLCache(maxsize=idemconf.IDEMPOTENT_LOCAL_MAXSIZE)
+        self.ttl = idemconf.IDEMPOTENT_TTL
+        self.key_prefix = idemconf.IDEMPOTENT_KEY_PREFIX
+        self.get_redis = get_redis or (lambda: None)
+
+    @staticmethod
+    def _keys(namespace, keys):
+        # 空的key（如通知里面没有transaction_id）忽略
+        return [f"{namespace}:{key}" for key in keys if key]
+
+    async def is_done(self, namespace: str, *keys) -> bool:
+        """
+        判断是否已经处理过，任意一个key处理过都算处理过
+        :param namespace: 业务命名空间，如 pay_notify
+        :param keys: 业务唯一标识，如 transaction_id、out_trade_no
+        :return:
+        """
+        keys = self._keys(namespace, keys)
+        for key in keys:
+            if self.local.get(key):
+                self.stats["local_hits"] += 1
+                return True
+        redis = self.get_redis()
+        if redis is not None and keys:
+            try:
+                values = await redis.mget(*(self.key_prefix + key for key in keys))
+            except Exception:
+                self.stats["redis_errors"] += 1
+                logger.exception("读取已处理集合异常")
+                values = []
+            if any(values):
+                self.stats["redis_hits"] += 1
+                # 其他worker处理过的，也记录到进程内
+                for key in keys:
+                    self.local.set(key, True, self.ttl)
+                return True
+        self.stats["misses"] += 1
+        return False
+
+    async def mark_done(self, namespace: str, *keys):
+        """标记为已处理，过期时间需要覆盖外部的最长重试时间"""
+        keys = self._keys(namespace, keys)
+        for key in keys:
+            self.local.set(key, True, self.ttl)
+        self.stats["marked"] += 1
+        redis = self.get_redis()
+        if redis is not None and keys:
+            try:
+                async with redis.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        pipe.set(self.key_prefix + key, 1, ex=int(self.ttl))
+                    await pipe.execute()
+            except Exception:
+                self.stats["redis_errors"] += 1
+                logger.exception("写入已处理集合异常")
+
+    def try_begin(self, namespace: str, key) -> bool:
+        """
+        标记当前进程开始处理，同一个key同时只有一个协程处理
+        :return: False 表示已经有协程在处理中
+        """
+        key = f"{namespace}:{key}"
+        if key in self._inflight:
+            self.stats["inflight_hits"] += 1
+            return False
+        self._inflight.add(key)
+        return True
+
+    def end(self, namespace: str, key):
+        self._inflight.discard(f"{namespace}:{key}")
+
+
+idempotency_guard = IdempotencyGuard()
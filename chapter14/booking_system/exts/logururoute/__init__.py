@@ -8,6 +8,7 @@
    创建时间 :          2021/12/30
 -------------------------------------------------
    修改描述-2021/12/30:
+   修改描述: 请求体只读取一次，解析、UA解析、序列化和写入交给后台线程（exts.logururoute.writer）
 -------------------------------------------------
 """
 
@@ -15,15 +16,18 @@ from time import perf_counter
 from fastapi.routing import APIRoute
 from typing import Callable, List, Dict, Optional
 from fastapi.responses import Response
-import shortuuid
 from datetime import datetime
-from user_agents import parse
-from urllib.parse import parse_qs
-from utils import json_helper
 from fastapi import Request, FastAPI
-from loguru import logger
-import json
+import orjson
 from exts.logururoute.config import setup_ext_loguru
+from exts.logururoute.writer import (
+    log_writer,
+    parse_useragent,
+    redact,
+    decode_body,
+    decode_query,
+    DEFAULT_REDACT_FIELDS,
+)
 
 from fastapi.responses import StreamingResponse
 from exts.requestvar import request
@@ -38,6 +42,10 @@ class ContextLogerRoute(APIRoute):
     is_record_useragent = True
     # 是否记录用户提交请求头信息
     is_record_headers = True
+    # 需要脱敏的请求参数字段
+    redact_fields = DEFAULT_REDACT_FIELDS
+    # 最多记录的请求体、响应体字节数
+    max_body_size = 4096
 
     def filter_request_url(self):
         path_info = request.url.path
@@ -60,129 +68,98 @@ class ContextLogerRoute(APIRoute):
             # 计算时间
             request.state.start_time = perf_counter()
 
-    async def make_request_log_msg(self) -> Dict:
-        log_msg = None
-        if self.filter_request_url():
-            ip, method, url = request.client.host, request.method, request.url.path
-            # 解析请求提交的表单信息
-            try:
-                body_form = await request.form()
-            except:
-                body_form = None
-            body = None
-            try:
-                body_bytes = await request.body()
-                if body_bytes:
-                    try:
-                        body = await request.json()
-                    except:
-                        pass
-                        if body_bytes:
-                            try:
-                                body = body_bytes.decode("utf-8")
-                            except:
-                                body = body_bytes.decode("gb2312")
-            except:
-                pass
-            # 在这里记录下当前提交的body的数据，用于下文的提取
-            request.state.body = body
-            # 从头部里面获取出对应的请求头信息，用户用户机型等信息获取
-            user_agent = parse(request.headers["user-agent"])
-            browser = user_agent.browser.version
-            if len(browser) >= 2:
-                browser_major, browser_minor = browser[0], browser[1]
-            else:
-                browser_major, browser_minor = 0, 0
-            # 用户当前系统OS信息提取
-            user_os = user_agent.os.version
-            if len(user_os) >= 2:
-                os_major, os_minor = user_os[0], user_os[1]
-            else:
-                os_major, os_minor = 0, 0
-
-            log_msg = {
-                "headers": (
-                    None
-                    if not self.is_record_headers
-                    else (
-                        [
-                            request.headers.get(i, "")
-                            for i in self.nesss_access_heads_keys
-                        ]
-                        if self.nesss_access_heads_keys
-                        else None
-                    )
-                ),
-                # 记录请求URL信息
-                "useragent": (
-                    None
-                    if not self.is_record_useragent
-                    else {
-                        "os": "{} {}".format(
-                            user_agent.os.family, user_agent.os.version_string
-                        ),
-                        "browser": "{} {}".format(
-                            user_agent.browser.family, user_agent.browser.version_string
-                        ),
-                        "device": {
-                            "family": user_agent.device.family,
-                            "brand": user_agent.device.brand,
-                            "model": user_agent.device.model,
-                        },
-                    }
-                ),
-                "url": url,
-                # 记录请求方法
-                "method": method,
-                # 记录请求来源IP
-                "ip": ip,
-                # 'path': gziprequest.path,
-                # 记录请求提交的参数信息
-                "params": {
-                    "query_params": parse_qs(str(request.query_params)),
-                    "from": body_form,
-                    "body": body,
-                },
-                "ts": f"{datetime.now():%Y-%m-%d %H:%M:%S%z}",
-            }
-            # 对于没有的数据清除
-            if not log_msg["headers"]:
-                log_msg.pop("headers")
-            if not log_msg["params"]["query_params"]:
-                log_msg["params"].pop("query_params")
-            if not log_msg["params"]["from"]:
-                log_msg["params"].pop("from")
-            if not log_msg["params"]["body"]:
-                log_msg["params"].pop("body")
-
+    def build_request_log_msg(
+        self, url, method, ip, query_string, content_type, body_bytes, headers, ua, ts
+    ) -> Dict:
+        """在后台线程中调用，解析请求参数生成日志内容"""
+        params = {
+            "query_params": redact(decode_query(query_string), self.redact_fields),
+            "body": redact(decode_body(body_bytes, content_type), self.redact_fields),
+        }
+        log_msg = {
+            "url": url,
+            # 记录请求方法
+            "method": method,
+            # 记录请求来源IP
+            "ip": ip,
+            # 记录请求提交的参数信息
+            "params": {k: v for k, v in params.items() if v},
+            "ts": ts,
+        }
+        # 对于没有的数据不记录
+        if headers:
+            log_msg["headers"] = headers
+        if ua:
+            log_msg["useragent"] = parse_useragent(ua)
         return log_msg
 
+    async def make_request_log_msg(self) -> Optional[tuple]:
+        """只采集原始的请求数据，返回build_request_log_msg的参数"""
+        if not self.filter_request_url():
+            return None
+        # 请求体只读取一次，starlette会缓存，后续路由函数里再读取不会重复接收
+        body_bytes = await request.body()
+        # 在这里记录下当前提交的body的数据，用于下文的提取
+        request.state.body = body_bytes
+        return (
+            request.url.path,
+            request.method,
+            request.client.host if request.client else None,
+            request.scope.get("query_string"),
+            request.headers.get("content-type", ""),
+            body_bytes[: self.max_body_size],
+            (
+                [request.headers.get(i, "") for i in self.nesss_access_heads_keys]
+                if self.is_record_headers and self.nesss_access_heads_keys
+                else None
+            ),
+            request.headers.get("user-agent") if self.is_record_useragent else None,
+            f"{datetime.now():%Y-%m-%d %H:%M:%S%z}",
+        )
+
     async def before_request_record_loger(self, log_msg=None):
         if self.filter_request_url() and log_msg:
-            await async_trace_add_log_record(event_type="request", msg=log_msg)
+            await async_trace_add_log_record(
+                event_type="request", build=self.build_request_log_msg, args=log_msg
+            )
+
+    @staticmethod
+    def build_response_log_msg(status_code, cost_time, rsp_bytes, ts) -> Dict:
+        """在后台线程中调用，解析响应报文生成日志内容"""
+        rsp = None
+        if rsp_bytes is not None:
+            try:
+                rsp = orjson.loads(rsp_bytes)
+            except orjson.JSONDecodeError:
+                rsp = rsp_bytes.decode("utf-8", errors="replace")
+        return {
+            # 记录请求耗时
+            "status_code": status_code,
+            "cost_time": cost_time,
+            # 记录请求响应的最终报文信息
+            "rsp": rsp,
+            "ts": ts,
+        }
 
     async def after_request_record_loger(self, response: Response):
         if self.filter_response_context(response=response):
             start_time = getattr(request.state, "start_time")
             end_time = f"{(perf_counter() - start_time):.2f}"
             # 获取响应报文信息内容
-            rsp = None
             if not isinstance(response, StreamingResponse):
+                rsp_bytes = None
                 if isinstance(response, Response):
-                    rsp = str(response.body, encoding="utf-8")
-                    try:
-                        rsp = json_helper.json_to_dict(rsp)
-                    except:
-                        pass
-                log_msg = {
-                    # 记录请求耗时
-                    "status_code": response.status_code,
-                    "cost_time": end_time,
-                    #  记录请求响应的最终报文信息--eval的作用是去除相关的 转义符号 "\"ok\""===》ok
-                    "rsp": rsp,
-                    "ts": f"{datetime.now():%Y-%m-%d %H:%M:%S%z}",
-                }
-                await async_trace_add_log_record(event_type="response", msg=log_msg)
+                    rsp_bytes = bytes(response.body[: self.max_body_size])
+                await async_trace_add_log_record(
+                    event_type="response",
+                    build=self.build_response_log_msg,
+                    args=(
+                        response.status_code,
+                        end_time,
+                        rsp_bytes,
+                        f"{datetime.now():%Y-%m-%d %H:%M:%S%z}",
+                    ),
+                )
 
     async def teardown_requestcontext(self, request: Request, response: Response):
         pass
@@ -213,12 +190,38 @@ class ContextLogerRoute(APIRoute):
         return custom_route_handler
 
 
-async def async_trace_add_log_record(event_type="", msg={}, remarks=""):
+def _build_trace_log(traceid, trace_index, event_type, msg, remarks, build, args):
+    if build is not None:
+        msg = build(*args)
+    log = {
+        # 自定义一个新的参数复制到我们的请求上下文的对象中
+        "traceid": traceid,
+        # 定义链路所以序号
+        "trace_index": trace_index,
+        # 时间类型描述描述
+        "event_type": event_type,
+        # 日志内容详情
+        "msg": msg,
+        # 日志备注信息
+        "remarks": remarks,
+    }
+    #  为少少相关记录，删除不必要的为空的日志内容信息，
+    if not remarks:
+        log.pop("remarks")
+    if not msg:
+        log.pop("msg")
+    return (log,)
+
+
+async def async_trace_add_log_record(
+    event_type="", msg={}, remarks="", build: Callable = None, args: tuple = ()
+):
     """
 
     :param event_type: 日志记录事件描述
     :param msg: 日志记录信息字典
     :param remarks: 日志备注信息
+    :param build: 可选，在后台线程中调用 build(*args) 生成日志记录信息字典，代替msg
     :return:
     """
     # 如果没有这个标记的属性的，说明这个接口的不需要记录啦！
@@ -227,30 +230,14 @@ async def async_trace_add_log_record(event_type="", msg={}, remarks=""):
         trace_links_index = request.state.trace_links_index = (
             getattr(request.state, "trace_links_index") + 1
         )
-        log = {
-            # 自定义一个新的参数复制到我们的请求上下文的对象中
-            "traceid": getattr(request.state, "traceid"),
-            # 定义链路所以序号
-            "trace_index": trace_links_index,
-            # 时间类型描述描述
-            "event_type": event_type,
-            # 日志内容详情
-            "msg": msg,
-            # 日志备注信息
-            "remarks": remarks,
-        }
-        #  为少少相关记录，删除不必要的为空的日志内容信息，
-        if not remarks:
-            log.pop("remarks")
-        if not msg:
-            log.pop("msg")
-        try:
-            log_msg = json_helper.dict_to_json_ensure_ascii(log)  # 返回文本
-            logger.info(log_msg)
-        except:
-            logger.info(
-                getattr(request.state, "traceid")
-                + "：索引："
-                + str(getattr(request.state, "trace_links_index"))
-                + ":日志信息写入异常"
-            )
+        # 交给后台线程序列化和写入，队列满时丢弃不阻塞请求
+        log_writer.submit(
+            _build_trace_log,
+            getattr(request.state, "traceid"),
+            trace_links_index,
+            event_type,
+            msg,
+            remarks,
+            build,
+            args,
+        )
@@ -1,6 +1,7 @@
 from datetime import datetime
 from loguru import logger
 from fastapi import FastAPI
+from exts.logururoute.writer import log_writer
 
 
 def setup_ext_loguru(app: FastAPI, log_pro_path: str = None):
@@ -13,6 +14,12 @@ def setup_ext_loguru(app: FastAPI, log_pro_path: str = None):
     async def startup():
         # 日志文件初始化处理
         init_loguru_handlers(log_pro_path)
+        log_writer.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        # 把队列里面剩余的日志写完
+        log_writer.stop()
 
 
 def init_loguru_handlers(log_pro_path: str = None):
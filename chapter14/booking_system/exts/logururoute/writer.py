@@ -0,0 +1,145 @@
+"""
+请求日志的后台写入
+
+请求处理过程中只采集原始数据（原始请求体字节、请求头、状态码、耗时等）放入有界队列，
+请求体解析、UA解析、脱敏、序列化和写文件都在后台线程中完成，不占用事件循环。
+队列满时直接丢弃并计数，不会阻塞请求。
+"""
+import queue
+import threading
+import typing
+from functools import lru_cache
+from urllib.parse import parse_qs
+
+import orjson
+from loguru import logger
+from user_agents import parse
+
+# 默认需要脱敏的字段
+DEFAULT_REDACT_FIELDS = frozenset(
+    {
+        "password",
+        "token",
+        "access_token",
+        "authorization",
+        "cookie",
+        "visit_uphone",
+        "visit_uopenid",
+        "openid",
+        "code",
+    }
+)
+
+
+@lru_cache(maxsize=1024)
+def parse_useragent(ua_string: str) -> typing.Dict:
+    """UA解析比较耗时，同一个客户端的UA字符串都是相同的，缓存解析结果"""
+    user_agent = parse(ua_string)
+    return {
+        "os": "{} {}".format(user_agent.os.family, user_agent.os.version_string),
+        "browser": "{} {}".format(
+            user_agent.browser.family, user_agent.browser.version_string
+        ),
+        "device": {
+            "family": user_agent.device.family,
+            "brand": user_agent.device.brand,
+            "model": user_agent.device.model,
+        },
+    }
+
+
+def redact(value, fields=DEFAULT_REDACT_FIELDS):
+    """递归的把敏感字段的值替换为 ***"""
+    if isinstance(value, dict):
+        return {
+            k: "***" if str(k).lower() in fields else redact(v, fields)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item, fields) for item in value]
+    return value
+
+
+def decode_body(body_bytes: bytes, content_type: str = ""):
+    """解析请求体：json、表单或者文本"""
+    if not body_bytes:
+        return None
+    if "json" in content_type:
+        try:
+            return orjson.loads(body_bytes)
+        except orjson.JSONDecodeError:
+            pass
+    try:
+        text = body_bytes.decode("utf-8")
+    except UnicodeDecodeError:
+        text = body_bytes.decode("gb2312", errors="replace")
+    if "x-www-form-urlencoded" in content_type:
+        return {k: v[0] if len(v) == 1 else v for k, v in parse_qs(text).items()}
+    if "multipart/form-data" in content_type:
+        # 上传文件的内容不记录
+        return "<multipart/form-data {} bytes>".format(len(body_bytes))
+    return text
+
+
+def decode_query(query_string: bytes):
+    if not query_string:
+        return None
+    return parse_qs(query_string.decode("latin-1"))
+
+
+class BackgroundLogWriter:
+    pass
+
+    def __init__(self, maxsize=10000):
+        self.queue: "queue.Queue" = queue.Queue(maxsize=maxsize)
+        self._thread: threading.Thread = None
+        # 统计信息
+        self.stats = {"submitted": 0, "written": 0, "dropped": 0, "errors": 0}
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="request-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, build: typing.Callable[..., typing.Iterable[typing.Dict]], *args):
+        """
+        提交一条待写入的日志，不会阻塞
+        :param build: 在后台线程中调用，返回需要写入的日志字典
+        :return: False 表示队列已满，日志被丢弃
+        """
+        if self._thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((build, args))
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["submitted"] += 1
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            build, args = item
+            try:
+                for log in build(*args):
+                    logger.info(orjson.dumps(log, default=str).decode("utf-8"))
+                    self.stats["written"] += 1
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("请求日志写入异常")
+
+
+log_writer = BackgroundLogWriter()
@@ -0,0 +1,136 @@
+"""
+雪花订单号的进程编号租用
+
+雪花订单号需要每个进程使用不同的进程编号（0~1023），多副本部署时各个容器的PID基本相同，
+不能再用PID区分。没有配置环境变量 ORDER_WORKER_ID 时：
+1：启动时通过redis依次尝试 SET key NX EX 租用一个空闲的编号
+2：后台协程定时续期，续期发现编号已经被其他进程占用（如长时间失联后租约过期）时重新租用
+3：服务关闭时释放编号
+没有配置 ORDER_WORKER_ID 也没有启用redis时，部署多个进程需要保证 ORDER_WORKER_ID 不同，
+否则启动失败（ORDER_WORKER_ID_REQUIRED）或者只记录告警
+"""
+import asyncio
+import logging
+import os
+import typing
+import uuid
+
+from fastapi import FastAPI
+
+from utils.ordernum_helper import SnowflakeOrderNum, snowflake_order_num
+
+logger = logging.getLogger(__name__)
+
+
+class OrderWorkerLease:
+    pass
+
+    # 只有自己持有的编号才续期/释放
+    RENEW_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, app: FastAPI = None, generator: SnowflakeOrderNum = None):
+        self.generator = generator or snowflake_order_num
+        self.get_redis: typing.Callable = lambda: None
+        self.key_prefix = "booking:order_worker:"
+        self.ttl = 60
+        self.required = False
+        self.worker_id: typing.Optional[int] = None
+        self._token = uuid.uuid4().hex
+        self._task: typing.Optional[asyncio.Task] = None
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None)
+
+    def init_app(self, app: FastAPI, workerconf, get_redis: typing.Callable = None):
+        """
+        需要在redis的init_shutdown之前调用，保证关闭时还可以释放编号
+        :param app:
+        :param workerconf: 配置信息
+        :param get_redis: 可选，返回 aioredis.Redis 的函数
+        :return:
+        """
+        self.app = app
+        self.get_redis = get_redis or (lambda: None)
+        if workerconf is not None:
+            self.key_prefix = workerconf.ORDER_WORKER_KEY_PREFIX
+            self.ttl = int(workerconf.ORDER_WORKER_LEASE_TTL)
+            self.required = workerconf.ORDER_WORKER_ID_REQUIRED
+
+        @app.on_event("startup")
+        async def startup_event():
+            await self.start()
+
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            await self.stop()
+
+    async def start(self):
+        if self.generator.has_explicit_worker_id:
+            return
+        redis = self.get_redis()
+        if redis is None:
+            message = "没有配置ORDER_WORKER_ID也没有启用redis，订单号的进程编号使用PID的低10位，多个进程部署时可能重复"
+            if self.required:
+                raise RuntimeError(message)
+            logger.warning(message)
+            return
+        self._renew = redis.register_script(self.RENEW_SCRIPT)
+        self._release = redis.register_script(self.RELEASE_SCRIPT)
+        await self.acquire()
+        self._task = asyncio.create_task(self._renew_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.worker_id is not None:
+            try:
+                await self._release(keys=[self._key(self.worker_id)], args=[self._token])
+            except Exception:
+                logger.exception("释放订单号进程编号异常")
+
+    def _key(self, worker_id: int) -> str:
+        return f"{self.key_prefix}{worker_id}"
+
+    async def acquire(self):
+        """租用一个空闲的进程编号，从PID对应的编号开始尝试，减少多个进程之间的争抢"""
+        redis = self.get_redis()
+        size = SnowflakeOrderNum.MAX_WORKER_ID + 1
+        start = os.getpid() % size
+        for offset in range(size):
+            worker_id = (start + offset) % size
+            if await redis.set(self._key(worker_id), self._token, nx=True, ex=self.ttl):
+                self.worker_id = worker_id
+                self.generator.set_worker_id(worker_id)
+                logger.info("订单号进程编号租用成功：%s", worker_id)
+                return worker_id
+        raise RuntimeError("订单号的进程编号已经全部被占用")
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if await self._renew(
+                    keys=[self._key(self.worker_id)], args=[self._token, self.ttl]
+                ):
+                    continue
+                # 租约过期后编号可能已经被其他进程使用，重新租用一个
+                logger.warning("订单号进程编号%s的租约已失效，重新租用", self.worker_id)
+                await self.acquire()
+            except Exception:
+                logger.exception("订单号进程编号续期异常")
+
+
+order_worker_lease = OrderWorkerLease()
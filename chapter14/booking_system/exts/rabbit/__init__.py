@@ -1,17 +1,34 @@
 from fastapi import FastAPI
-from pika.exceptions import UnroutableError
+from pika.exceptions import (
+    UnroutableError,
+    NackError,
+    AMQPConnectionError,
+    AMQPChannelError,
+    StreamLostError,
+)
 import pika
 
 import threading
-
-lock = threading.Lock()
+import time
 import uuid
 
 
 class RabbitMQClintWithLock:
-    pass
+    """
+    同步的rabbitmq客户端
+
+    pika的BlockingConnection不是线程安全的，这里每个线程各自持有一个连接和信道，
+    不再需要全局锁来串行化所有的消息发送；连接断开后发送时会自动重连（带退避等待）。
+    """
 
     def __init__(self, app: FastAPI = None):
+        self._local = threading.local()
+        # 记录所有线程创建的连接，用于关闭时统一清理
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.parameters = None
+        # 是否开启消息发送确认
+        self.confirm_delivery = False
         # 如果有APPC传入则直接的进行初始化的操作即可
         if app is not None:
             self.init_app(app, None, None)
@@ -29,21 +46,69 @@ class RabbitMQClintWithLock:
         def shutdown_event():
             self._clear_all()
 
-    def init_sync_rabbit(self, rabbitconf):
+    def init_sync_rabbit(self, rabbitconf, confirm_delivery=False):
         credentials = pika.PlainCredentials(
             rabbitconf.RABBIT_USERNAME, rabbitconf.RABBIT_PASSWORD
         )
-        # 关闭心跳检测
+        # 关闭心跳检测，BlockingConnection只有在阻塞调用的时候才会处理心跳，
+        # 空闲时开启心跳反而会被服务端断开，连接失效的情况由发送时的自动重连处理
         # virtual_host 类型多租户情况环境隔离的分区，默认使用'/'
-        parameters = pika.ConnectionParameters(
+        self.parameters = pika.ConnectionParameters(
             rabbitconf.RABBIT_HOST,
             rabbitconf.RABBIT_PORT,
             rabbitconf.VIRTUAL_HOST,
             credentials,
             heartbeat=0,
         )
-        self.connection = pika.BlockingConnection(parameters)
-        self.channel = self.connection.channel()
+        self.confirm_delivery = confirm_delivery
+        self._connect()
+
+    @property
+    def connection(self):
+        return getattr(self._local, "connection", None)
+
+    @property
+    def channel(self):
+        return getattr(self._local, "channel", None)
+
+    def _connect(self, retries=5, backoff=0.2):
+        """为当前线程创建连接和信道，失败时按指数退避重试"""
+        for attempt in range(retries):
+            try:
+                connection = pika.BlockingConnection(self.parameters)
+                channel = connection.channel()
+                if self.confirm_delivery:
+                    channel.confirm_delivery()
+                break
+            except AMQPConnectionError:
+                if attempt == retries - 1:
+                    raise
+                time.sleep(backoff * (2**attempt))
+        self._local.connection = connection
+        self._local.channel = channel
+        with self._connections_lock:
+            self._connections.append(connection)
+        return channel
+
+    def _get_channel(self):
+        if not self._check_alive:
+            self._reset_local()
+            return self._connect()
+        return self.channel
+
+    def _reset_local(self):
+        connection = self.connection
+        if connection is not None:
+            with self._connections_lock:
+                if connection in self._connections:
+                    self._connections.remove(connection)
+            try:
+                if connection.is_open:
+                    connection.close()
+            except Exception:
+                pass
+        self._local.connection = None
+        self._local.channel = None
 
     @property
     def _check_alive(self):
@@ -59,20 +124,21 @@ class RabbitMQClintWithLock:
         self, exchange_name, exchange_type="fanout", durable=True
     ):
 
-        self.channel.exchange_declare(
+        self._get_channel().exchange_declare(
             exchange=exchange_name, exchange_type=exchange_type, durable=durable
         )
 
     def open_confirm_delivery(self):
         """开启消息发送到交换机过程监听回调机制，开启后可以在发送消息的时候进行异常的吹"""
-        self.channel.confirm_delivery()
+        self.confirm_delivery = True
+        self._get_channel().confirm_delivery()
 
     def make_queue_declare(
         self, queue_name, durable=True, auto_delete=False, arguments=None
     ):
         """创建队列"""
         pass
-        self.channel.queue_declare(
+        self._get_channel().queue_declare(
             queue=queue_name,
             durable=durable,
             auto_delete=auto_delete,
@@ -82,17 +148,17 @@ class RabbitMQClintWithLock:
     def make_queue_bind(self, exchange_name, queue_name, routing_key):
         """同伙routing_key把交换机和队列的绑定"""
         pass
-        self.channel.queue_bind(
+        self._get_channel().queue_bind(
             exchange=exchange_name, queue=queue_name, routing_key=routing_key
         )
 
     def make_queue_delete(self, queue):
         """删除队列"""
-        self.channel.queue_delete(queue)
+        self._get_channel().queue_delete(queue)
         print("delete queue:", queue)
 
     def make_exchange_delete(self, exchange_name):
-        self.channel.exchange_delete(exchange_name)
+        self._get_channel().exchange_delete(exchange_name)
 
     def send_basic_publish(
         self,
@@ -104,72 +170,63 @@ class RabbitMQClintWithLock:
         message_ttl=3,
         delivery_mode=2,
         is_delay=False,
+        retries=3,
     ):
         """生产数据"""
+        # BasicProperties的属性
+        #  self.content_type = content_type  消息内容的类型
+        #   self.content_encoding = content_encoding 消息内容编码
+        #   self.headers = headers 消息内容的传递的头部信息
+        #   self.delivery_mode = delivery_mode s消息是否持久化 1：不 2：是
+        #   self.priority = priority 消息优先级
+        #   self.correlation_id = correlation_id 消息关联的ID
+        #   self.reply_to = reply_to 用于指定恢复的队列的名称
+        #   self.expiration = expiration 消息失效时间
+        #   self.message_id = message_id 消息ID
+        #   self.timestamp = timestamp 消息的时间戳
+        #   self.type = type 类型
+        #   self.user_id = user_id 消息所属用户ID
+        #   self.app_id = app_id 应用的ID
+        #   self.cluster_id = cluster_id 集群ID
+        properties = None
+        if is_delay:
+            properties = pika.BasicProperties(
+                content_type=content_type,
+                content_encoding=content_encoding,
+                delivery_mode=delivery_mode,
+                message_id=str(uuid.uuid4()),
+            )
+            # expiration 字段以毫秒为单位表示 TTL 值,6 秒的 message
+            properties.expiration = f"{message_ttl * 1000}"  # 秒
 
-        # 使用简单的所发的方式来避免多线程的不安全引发的问题
-        print("开始发送！！")
-        with lock:
+        for attempt in range(retries):
             try:
-                if self._check_alive:
-                    print("开始发送！！11111")
-                    # BasicProperties的属性
-                    #  self.content_type = content_type  消息内容的类型
-                    #   self.content_encoding = content_encoding 消息内容编码
-                    #   self.headers = headers 消息内容的传递的头部信息
-                    #   self.delivery_mode = delivery_mode s消息是否持久化 1：不 2：是
-                    #   self.priority = priority 消息优先级
-                    #   self.correlation_id = correlation_id 消息关联的ID
-                    #   self.reply_to = reply_to 用于指定恢复的队列的名称
-                    #   self.expiration = expiration 消息失效时间
-                    #   self.message_id = message_id 消息ID
-                    #   self.timestamp = timestamp 消息的时间戳
-                    #   self.type = type 类型
-                    #   self.user_id = user_id 消息所属用户ID
-                    #   self.app_id = app_id 应用的ID
-                    #   self.cluster_id = cluster_id 集群ID
-
-                    correlation_id = str(uuid.uuid4())
-                    message_id = str(uuid.uuid4())
-
-                    if is_delay:
-                        properties = pika.BasicProperties(
-                            content_type=content_type,
-                            content_encoding=content_encoding,
-                            delivery_mode=delivery_mode,
-                        )
-                        # expiration 字段以毫秒为单位表示 TTL 值,6 秒的 message
-                        properties.expiration = f"{message_ttl * 1000}"  # 秒
-                        self.channel.basic_publish(
-                            # 默认使用的/的交换机
-                            exchange=exchange_name,
-                            # 默认的匹配的key
-                            routing_key=routing_key,
-                            # 发送的消息的内容
-                            body=body,
-                            # 发现的消息的类型
-                            properties=properties,
-                            # pika.BasicProperties中的delivery_mode=2指明message为持久的，1 的话 表示不是持久化 2：表示持久化
-                        )
-                    else:
-                        self.channel.basic_publish(
-                            # 默认使用的/的交换机
-                            exchange=exchange_name,
-                            # 默认的匹配的key
-                            routing_key=routing_key,
-                            # 发送的消息的内容
-                            body=body,
-                        )
-                else:
-                    print("连接已断开")
-                    # self.init_sync_rabbit()
-            except UnroutableError:
+                self._get_channel().basic_publish(
+                    # 默认使用的/的交换机
+                    exchange=exchange_name,
+                    # 默认的匹配的key
+                    routing_key=routing_key,
+                    # 发送的消息的内容
+                    body=body,
+                    # 发现的消息的类型
+                    properties=properties,
+                    # pika.BasicProperties中的delivery_mode=2指明message为持久的，1 的话 表示不是持久化 2：表示持久化
+                )
+                return True
+            except (UnroutableError, NackError):
                 print("消息发送失败")
+                return False
+            except (AMQPConnectionError, AMQPChannelError, StreamLostError):
+                print("连接已断开，重新连接后再发送")
+                self._reset_local()
+                time.sleep(0.1 * (2**attempt))
+        return False
 
     def listen_basic_consume(self, queue, func):
         """启动循环监听用于数据消费"""
-        self.channel.basic_consume(queue, func)
-        self.channel.start_consuming()
+        channel = self._get_channel()
+        channel.basic_consume(queue, func)
+        channel.start_consuming()
 
     def _close_connect(self):
         """
@@ -184,20 +241,22 @@ class RabbitMQClintWithLock:
         :param channel:
         :return:
         """
-        if not hasattr(self, "channel"):
+        if not self.channel:
             raise ValueError("the object of SenderClient has not attr of channel.")
 
         self.channel.close()
 
     def _clear_all(self):
         """清理连接与信道"""
-        if self.connection and self.connection.is_open:
-            self.connection.close()
-        self.connection = None
-
-        if self.channel and self.channel.is_open:
-            self.channel.close()
-        self.channel = None
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                if connection.is_open:
+                    connection.close()
+            except Exception:
+                pass
+        self._local = threading.local()
 
 
 sync_rabbit_client = RabbitMQClintWithLock()
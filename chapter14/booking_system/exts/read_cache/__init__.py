@@ -0,0 +1,353 @@
+"""
+读多写少数据（医生列表、排班、医院信息）的两级读穿缓存
+
+1：一级为进程内的LRU缓存，带过期时间，命中时不需要任何网络请求
+2：二级为多个worker共享的redis缓存，未配置REDIS_URL时只使用一级缓存
+3：缓存未命中时，同一个进程内同一个key只有一个协程去加载（single-flight），
+   多个worker之间通过redis的 SET NX 锁避免同时回源数据库（缓存击穿）
+4：过期时间加随机抖动，避免大量key同时过期（缓存雪崩）
+5：按key的命名空间（第一个冒号前的部分）和最近访问的key统计命中、未命中、回源等信息，
+   通过 /metrics 接口输出（见 render_prometheus）
+"""
+import asyncio
+import logging
+import random
+import time
+import typing
+from collections import Counter, OrderedDict, defaultdict
+
+import orjson
+from fastapi import FastAPI
+
+from exts.responses.json_response import orjson_dumps
+
+logger = logging.getLogger(__name__)
+
+
+class LocalTTLCache:
+    """进程内的LRU缓存，每个key有各自的过期时间"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, typing.Tuple[float, typing.Any]]" = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        for key in [key for key in self._data if key.startswith(prefix)]:
+            self._data.pop(key, None)
+
+
+class ReadThroughCache:
+    pass
+
+    # 缓存值为None时保存的占位符，避免不存在的数据每次都回源
+    NONE_PLACEHOLDER = "__none__"
+
+    def __init__(self, app: FastAPI = None):
+        self.local = LocalTTLCache()
+        self.get_redis: typing.Callable = lambda: None
+        self.local_ttl = 10
+        self.redis_ttl = 300
+        self.key_prefix = "booking:cache:"
+        self.key_stats_maxsize = 200
+        self._inflight: typing.Dict[str, asyncio.Future] = {}
+        # 按命名空间统计的指标
+        self.stats = defaultdict(
+            lambda: {
+                "local_hits": 0,
+                "redis_hits": 0,
+                "misses": 0,
+                "loads": 0,
+                "load_errors": 0,
+                "invalidations": 0,
+            }
+        )
+        # 按key统计的指标，只保留最近访问的 key_stats_maxsize 个key，避免指标数量无限增长
+        self.key_stats: "OrderedDict[str, typing.Counter[str]]" = OrderedDict()
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None)
+
+    def init_app(self, app: FastAPI, cacheconf, get_redis: typing.Callable = None):
+        """
+        :param app:
+        :param cacheconf: 配置信息
+        :param get_redis: 可选，返回 aioredis.Redis 的函数，返回None时只使用进程内缓存
+        :return:
+        """
+        self.app = app
+        self.local = LocalTTLCache(maxsize=cacheconf.READ_CACHE_LOCAL_MAXSIZE)
+        self.local_ttl = cacheconf.READ_CACHE_LOCAL_TTL
+        self.redis_ttl = cacheconf.READ_CACHE_REDIS_TTL
+        self.key_prefix = cacheconf.READ_CACHE_KEY_PREFIX
+        self.key_stats_maxsize = cacheconf.READ_CACHE_KEY_STATS_MAXSIZE
+        self.get_redis = get_redis or (lambda: None)
+
+    @staticmethod
+    def _namespace(key):
+        return key.split(":", 1)[0]
+
+    def _record(self, key, name, count=1):
+        """同时记录命名空间和key的指标"""
+        self.stats[self._namespace(key)][name] += count
+        key_stats = self.key_stats.get(key)
+        if key_stats is None:
+            key_stats = self.key_stats[key] = Counter()
+            while len(self.key_stats) > self.key_stats_maxsize:
+                self.key_stats.popitem(last=False)
+        else:
+            self.key_stats.move_to_end(key)
+        key_stats[name] += count
+
+    @staticmethod
+    def _jitter(ttl):
+        return ttl * random.uniform(0.9, 1.1)
+
+    def _encode(self, value):
+        if value is None:
+            return self.NONE_PLACEHOLDER
+        return orjson_dumps(value)
+
+    def _decode(self, value):
+        if value == self.NONE_PLACEHOLDER:
+            return None
+        return orjson.loads(value)
+
+    async def get_or_load(
+        self,
+        key: str,
+        loader: typing.Callable[[], typing.Awaitable[typing.Any]],
+        local_ttl: float = None,
+        redis_ttl: float = None,
+    ):
+        """
+        读取缓存，未命中时调用 loader 回源加载并写入缓存
+        :param key: 缓存key，格式为 命名空间:xxx
+        :param loader: 回源加载数据的协程函数，返回值需要可以json序列化
+        :return:
+        """
+        value = self.local.get(key, self)
+        if value is not self:
+            self._record(key, "local_hits")
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # 已经有协程在加载，等待同一个结果
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._load(
+                key, loader, local_ttl or self.local_ttl, redis_ttl or self.redis_ttl
+            )
+            future.set_result(value)
+            return value
+        except BaseException as ex:
+            future.set_exception(ex)
+            # 没有其他协程等待时，避免出现 Future exception was never retrieved 的警告
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _load(self, key, loader, local_ttl, redis_ttl):
+        redis = self.get_redis()
+        redis_key = self.key_prefix + key
+        if redis is not None:
+            try:
+                cached = await redis.get(redis_key)
+                if cached is None:
+                    # 其他worker正在回源时，等待它写入缓存
+                    cached = await self._wait_other_worker(redis, redis_key)
+                if cached is not None:
+                    self._record(key, "redis_hits")
+                    value = self._decode(cached)
+                    self.local.set(key, value, self._jitter(local_ttl))
+                    return value
+            except Exception as ex:
+                logger.warning("读取redis缓存失败: %s", ex)
+                redis = None
+
+        self._record(key, "misses")
+        try:
+            value = await loader()
+        except Exception:
+            self._record(key, "load_errors")
+            raise
+        self._record(key, "loads")
+        self.local.set(key, value, self._jitter(local_ttl))
+        if redis is not None:
+            try:
+                await redis.set(
+                    redis_key, self._encode(value), px=int(self._jitter(redis_ttl) * 1000)
+                )
+                await redis.delete(redis_key + ":lock")
+            except Exception as ex:
+                logger.warning("写入redis缓存失败: %s", ex)
+        return value
+
+    async def get_many_or_load(
+        self,
+        keys: typing.List[str],
+        loader: typing.Callable[
+            [typing.List[str]], typing.Awaitable[typing.Dict[str, typing.Any]]
+        ],
+        local_ttl: float = None,
+        redis_ttl: float = None,
+    ) -> typing.Dict[str, typing.Any]:
+        """
+        批量读取缓存，所有未命中的key交给 loader 一次回源加载
+        :param keys: 缓存key列表，需要属于同一个命名空间
+        :param loader: 传入未命中的key列表，返回 {key: 数据}，没有返回的key缓存为None
+        :return: {key: 数据}
+        """
+        if not keys:
+            return {}
+        local_ttl = local_ttl or self.local_ttl
+        redis_ttl = redis_ttl or self.redis_ttl
+        result = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key, self)
+            if value is self:
+                missing.append(key)
+            else:
+                self._record(key, "local_hits")
+                result[key] = value
+
+        redis = self.get_redis()
+        if missing and redis is not None:
+            try:
+                cached_values = await redis.mget(
+                    *[self.key_prefix + key for key in missing]
+                )
+                still_missing = []
+                for key, cached in zip(missing, cached_values):
+                    if cached is None:
+                        still_missing.append(key)
+                        continue
+                    self._record(key, "redis_hits")
+                    result[key] = self._decode(cached)
+                    self.local.set(key, result[key], self._jitter(local_ttl))
+                missing = still_missing
+            except Exception as ex:
+                logger.warning("读取redis缓存失败: %s", ex)
+                redis = None
+
+        if not missing:
+            return result
+        for key in missing:
+            self._record(key, "misses")
+        try:
+            loaded = await loader(missing)
+        except Exception:
+            for key in missing:
+                self._record(key, "load_errors")
+            raise
+        for key in missing:
+            self._record(key, "loads")
+        for key in missing:
+            result[key] = loaded.get(key)
+            self.local.set(key, result[key], self._jitter(local_ttl))
+        if redis is not None:
+            try:
+                async with redis.pipeline(transaction=False) as pipe:
+                    for key in missing:
+                        pipe.set(
+                            self.key_prefix + key,
+                            self._encode(result[key]),
+                            px=int(self._jitter(redis_ttl) * 1000),
+                        )
+                    await pipe.execute()
+            except Exception as ex:
+                logger.warning("写入redis缓存失败: %s", ex)
+        return result
+
+    async def _wait_other_worker(self, redis, redis_key, lock_timeout=3, wait=1.0):
+        """
+        获取回源锁，获取成功返回None由当前worker回源；
+        获取失败说明其他worker正在回源，最多等待 wait 秒后读取其结果
+        """
+        if await redis.set(redis_key + ":lock", "1", nx=True, ex=lock_timeout):
+            return None
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            cached = await redis.get(redis_key)
+            if cached is not None:
+                return cached
+        return None
+
+    async def invalidate(self, *keys):
+        """数据变更后删除缓存"""
+        for key in keys:
+            self._record(key, "invalidations")
+            self.local.delete(key)
+        redis = self.get_redis()
+        if redis is not None and keys:
+            await redis.delete(*[self.key_prefix + key for key in keys])
+
+    async def invalidate_prefix(self, prefix):
+        """删除某一类缓存，如 doctor:scheduling:D001:"""
+        self.stats[self._namespace(prefix)]["invalidations"] += 1
+        self.local.delete_prefix(prefix)
+        redis = self.get_redis()
+        if redis is not None:
+            keys = [
+                key async for key in redis.scan_iter(match=self.key_prefix + prefix + "*")
+            ]
+            if keys:
+                await redis.delete(*keys)
+
+    def render_prometheus(self) -> str:
+        """Prometheus格式的缓存指标，按命名空间和最近访问的key输出"""
+        lines = []
+        metrics = (
+            ("local_hits", "Reads served from the in-process cache"),
+            ("redis_hits", "Reads served from redis"),
+            ("misses", "Reads that missed both cache tiers"),
+            ("loads", "Loader calls that succeeded"),
+            ("load_errors", "Loader calls that raised"),
+            ("invalidations", "Cache invalidations"),
+        )
+        for name, doc in metrics:
+            for label, items in (
+                ("namespace", self.stats.items()),
+                ("key", self.key_stats.items()),
+            ):
+                metric = f"read_cache_{'key_' if label == 'key' else ''}{name}_total"
+                lines.append(f"# HELP {metric} {doc}")
+                lines.append(f"# TYPE {metric} counter")
+                for value, stats in items:
+                    lines.append(
+                        f'{metric}{{{label}="{_escape_label(value)}"}} {stats[name]}'
+                    )
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+read_cache = ReadThroughCache()
@@ -18,6 +18,8 @@ import json
 import datetime
 import decimal
 import typing
+import orjson
+from sqlalchemy.engine import Row, RowMapping
 from sqlalchemy.ext.declarative import DeclarativeMeta
 
 
@@ -56,6 +58,42 @@ class CJsonEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+# dict/list/str/int 等由orjson直接处理；时间类型保持原来的格式，交给orjson_default处理
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def orjson_default(obj):
+    """orjson无法直接序列化的类型的处理"""
+    # 查询结果行，一行只回调一次，不需要再逐个字段的回调
+    if isinstance(obj, Row):
+        return obj._asdict()
+    elif isinstance(obj, RowMapping):
+        return dict(obj)
+    elif isinstance(obj, datetime.datetime):
+        return obj.strftime("%Y-%m-%d %H:%M:%S")
+    elif isinstance(obj, datetime.date):
+        return obj.strftime("%Y-%m-%d")
+    elif isinstance(obj, datetime.time):
+        return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj, bytes):
+        return str(obj, encoding="utf-8")
+    elif isinstance(obj.__class__, DeclarativeMeta):
+        # 将SqlAlchemy结果序列化为JSON--查询全部的时候的处理返回
+        return {i.name: getattr(obj, i.name) for i in obj.__table__.columns}
+    elif hasattr(obj, "keys") and hasattr(obj, "__getitem__"):
+        return dict(obj)
+    elif hasattr(obj, "_asdict"):
+        # NamedTuple 类型的查询结果记录
+        return obj._asdict()
+    raise TypeError
+
+
+def orjson_dumps(content: typing.Any) -> bytes:
+    return orjson.dumps(content, default=orjson_default, option=ORJSON_OPTIONS)
+
+
 class ApiResponse(JSONResponse):
     # 定义返回响应码--如果不指定的话则默认都是返回200
     http_status_code = 200
@@ -65,7 +103,6 @@ class ApiResponse(JSONResponse):
     result: Optional[Dict[str, Any]] = None  # 结果可以是{} 或 []
     message = "成功"
     success = True
-    timestamp = int(time.time() * 1000)
 
     def __init__(
         self,
@@ -74,13 +111,20 @@ class ApiResponse(JSONResponse):
         api_code=None,
         result=None,
         message=None,
+        encoded_result: bytes = None,
         **options
     ):
+        """
+        :param encoded_result: 可选，已经序列化好的result（如缓存里面的数据，见encode_result），
+                               传入时不会再对result进行序列化
+        """
         self.message = message or self.message
         self.api_code = api_code or self.api_code
         self.success = success or self.success
         self.http_status_code = http_status_code or self.http_status_code
         self.result = result or self.result
+        # 每个响应各自的时间戳
+        self.timestamp = int(time.time() * 1000)
 
         # 返回内容体
         body = dict(
@@ -90,20 +134,24 @@ class ApiResponse(JSONResponse):
             result=self.result,
             timestamp=self.timestamp,
         )
+        if encoded_result is not None:
+            # 直接把序列化好的result拼接到返回内容体中
+            body.pop("result")
+            body = orjson_dumps(body)[:-1] + b',"result":' + encoded_result + b"}"
         super(ApiResponse, self).__init__(
             status_code=self.http_status_code, content=body, **options
         )
 
+    @staticmethod
+    def encode_result(result: typing.Any) -> bytes:
+        """序列化result，结果可以缓存起来后通过encoded_result参数直接返回"""
+        return orjson_dumps(result)
+
     # 这个render会自动调用，如果这里需要特殊的处理的话，可以重写这个地方
     def render(self, content: typing.Any) -> bytes:
-        return json.dumps(
-            content,
-            ensure_ascii=False,
-            allow_nan=False,
-            indent=None,
-            separators=(",", ":"),
-            cls=CJsonEncoder,
-        ).encode("utf-8")
+        if isinstance(content, bytes):
+            return content
+        return orjson_dumps(content)
 
 
 class BadrequestException(ApiResponse):
@@ -0,0 +1,185 @@
+"""
+号源库存变化的实时推送
+
+下单扣减、取消订单和超时未支付回补库存后调用 publish 记录号源的最新库存，
+客户端通过SSE订阅关注的医生，不需要再轮询排班和订单信息接口：
+1：同一个号源在一个刷新周期内的多次变化只保留最新的库存（合并），
+   抢号时1000次扣减也只会推送少量的消息
+2：启用redis时通过 pub/sub 广播给所有worker（包括超时订单消费者进程的回补），
+   未配置REDIS_URL时只在当前进程内推送
+3：订阅按医生编号建立索引，每条消息只分发给关注这个医生的连接；
+   每个连接也只保留每个号源的最新库存，慢的客户端不会积压消息
+"""
+import asyncio
+import logging
+import typing
+from collections import defaultdict
+
+import orjson
+from fastapi import FastAPI
+
+logger = logging.getLogger(__name__)
+
+
+class StockSubscription:
+    """一个客户端连接的订阅，只保留每个号源的最新库存"""
+
+    def __init__(self, dnos: typing.Iterable[str]):
+        self.dnos = frozenset(dnos)
+        self._pending: typing.Dict[str, typing.Dict] = {}
+        self._event = asyncio.Event()
+
+    def put(self, dno, nsindex, nsnumstock):
+        self._pending[nsindex] = {"dno": dno, "nsnumstock": nsnumstock}
+        self._event.set()
+
+    async def get(self, timeout: float = None) -> typing.Optional[typing.Dict]:
+        """
+        等待库存变化
+        :return: {号源编号: {"dno": 医生编号, "nsnumstock": 库存}}，超时返回None
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._event.clear()
+        pending, self._pending = self._pending, {}
+        return pending
+
+
+class StockPushHub:
+    pass
+
+    def __init__(self, app: FastAPI = None):
+        self.get_redis: typing.Callable = lambda: None
+        self.channel = "booking:stock"
+        self.flush_interval = 0.2
+        self.heartbeat_interval = 15
+        # 当前刷新周期内待推送的号源库存 {号源编号: (医生编号, 库存)}
+        self._pending: typing.Dict[str, typing.Tuple[str, int]] = {}
+        self._subscribers: typing.Dict[str, typing.Set[StockSubscription]] = (
+            defaultdict(set)
+        )
+        self._tasks: typing.List[asyncio.Task] = []
+        # 统计信息
+        self.stats = {"published": 0, "coalesced": 0, "frames": 0, "dispatched": 0}
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None)
+
+    def init_app(self, app: FastAPI, pushconf, get_redis: typing.Callable = None):
+        """
+        :param app: 为None时需要自己调用 start/stop，如超时订单消费者进程
+        :param pushconf: 配置信息
+        :param get_redis: 可选，返回 aioredis.Redis 的函数，返回None时只在当前进程内推送
+        :return:
+        """
+        self.app = app
+        self.get_redis = get_redis or (lambda: None)
+        self.channel = pushconf.STOCK_PUSH_CHANNEL
+        self.flush_interval = pushconf.STOCK_PUSH_FLUSH_INTERVAL
+        self.heartbeat_interval = pushconf.STOCK_PUSH_HEARTBEAT_INTERVAL
+        if app is None:
+            return
+
+        @app.on_event("startup")
+        async def startup_event():
+            await self.start()
+
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            await self.stop()
+
+    @property
+    def started(self):
+        return bool(self._tasks)
+
+    async def start(self, subscribe=True):
+        """
+        :param subscribe: 是否订阅其他进程的推送，只发布的进程（如消费者）不需要订阅
+        """
+        self._tasks = [asyncio.create_task(self._flush_loop())]
+        if subscribe and self.get_redis() is not None:
+            self._tasks.append(asyncio.create_task(self._listen_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # 最后一个周期的变化
+        await self._flush()
+
+    def publish(self, dno, nsindex, nsnumstock):
+        """记录号源的最新库存，不会等待推送，没有启动时直接忽略"""
+        if not self.started or nsnumstock is None:
+            return
+        if nsindex in self._pending:
+            self.stats["coalesced"] += 1
+        self._pending[nsindex] = (dno, nsnumstock)
+        self.stats["published"] += 1
+
+    def subscribe(self, dnos: typing.Iterable[str]) -> StockSubscription:
+        subscription = StockSubscription(dnos)
+        for dno in subscription.dnos:
+            self._subscribers[dno].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: StockSubscription):
+        for dno in subscription.dnos:
+            subscribers = self._subscribers.get(dno)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(dno, None)
+
+    def _dispatch(self, items):
+        for nsindex, dno, nsnumstock in items:
+            for subscription in self._subscribers.get(dno, ()):
+                subscription.put(dno, nsindex, nsnumstock)
+                self.stats["dispatched"] += 1
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._flush()
+            except Exception:
+                logger.exception("号源库存推送异常")
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        items = [(nsindex, dno, stock) for nsindex, (dno, stock) in pending.items()]
+        self.stats["frames"] += 1
+        redis = self.get_redis()
+        if redis is None:
+            self._dispatch(items)
+            return
+        # 当前进程也通过订阅收到，不在这里直接分发
+        await redis.publish(self.channel, orjson.dumps(items))
+
+    async def _listen_loop(self):
+        while True:
+            pubsub = self.get_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message is None or message["type"] != "message":
+                        continue
+                    self._dispatch(orjson.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("号源库存订阅异常，稍后重新订阅")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+
+stock_push_hub = StockPushHub()
@@ -0,0 +1,238 @@
+"""
+微信模板消息的异步投递队列
+
+支付回调等业务只负责把模板消息放入队列后立即返回，由后台的发送协程：
+1：按批从队列取出消息并发发送
+2：令牌桶限制每秒的发送数量，避免触发微信的接口频率限制
+3：发送失败按指数退避重试，超过重试次数的进入死信
+4：启用redis时，队列满或服务关闭时未发送的消息溢出到redis，队列空闲或下次启动时重新加载；
+   服务关闭时先等待正在发送的批次完成，发送中、等待重试和队列中的消息都会溢出保存
+"""
+import asyncio
+import json
+import logging
+import time
+import typing
+
+from fastapi import FastAPI
+
+from exts.wechatpy.exceptions import APILimitedException
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """简单的令牌桶限速，rate 为每秒产生的令牌数"""
+
+    def __init__(self, rate: float, capacity: int = None):
+        self.rate = rate
+        self.capacity = capacity or max(int(rate), 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TemplateMessageQueue:
+    pass
+
+    def __init__(self, app: FastAPI = None):
+        self.queue: asyncio.Queue = None
+        self._workers: typing.List[asyncio.Task] = []
+        # 正在发送的批次 {批次任务: 还没有发送完成的消息}
+        self._inflight: typing.Dict[asyncio.Future, typing.List[dict]] = {}
+        # 等待重试的消息 {id(消息): (定时器, 消息)}
+        self._retries: typing.Dict[int, typing.Tuple[asyncio.TimerHandle, dict]] = {}
+        self.stop_timeout = 10.0
+        self._has_spilled = True
+        # 统计信息
+        self.stats = {"enqueued": 0, "sent": 0, "retried": 0, "dead": 0, "spilled": 0}
+        # 如果有APPC传入则直接的进行初始化的操作即可
+        if app is not None:
+            self.init_app(app, None, None)
+
+    def init_app(
+        self,
+        app: FastAPI,
+        queueconf,
+        get_client: typing.Callable,
+        get_redis: typing.Callable = None,
+    ):
+        """
+        :param app:
+        :param queueconf: 配置信息
+        :param get_client: 返回 AsyncWeChatClient 的函数
+        :param get_redis: 可选，返回 aioredis.Redis 的函数，返回None时不做溢出持久化
+        :return:
+        """
+        self.app = app
+        self.get_client = get_client
+        self.get_redis = get_redis or (lambda: None)
+        self.maxsize = queueconf.WX_TEMPLATE_QUEUE_MAXSIZE
+        self.batch_size = queueconf.WX_TEMPLATE_BATCH_SIZE
+        self.concurrency = queueconf.WX_TEMPLATE_WORKERS
+        self.max_retries = queueconf.WX_TEMPLATE_MAX_RETRIES
+        self.rate = queueconf.WX_TEMPLATE_RATE
+        self.spill_key = queueconf.WX_TEMPLATE_SPILL_KEY
+        self.dead_letter_key = queueconf.WX_TEMPLATE_DEAD_LETTER_KEY
+        self.stop_timeout = queueconf.WX_TEMPLATE_STOP_TIMEOUT
+
+        @app.on_event("startup")
+        async def startup_event():
+            await self.start()
+
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            await self.stop()
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.bucket = TokenBucket(self.rate)
+        await self._reload_spilled()
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    async def stop(self):
+        # 发送协程取消后不再取新的消息，正在发送的批次在后台继续执行
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        pending = []
+        # 等待正在发送的批次完成，超时的批次中没有发送完成的消息溢出保存
+        if self._inflight:
+            await asyncio.wait(list(self._inflight), timeout=self.stop_timeout)
+            for sending, remaining in list(self._inflight.items()):
+                if not sending.done():
+                    sending.cancel()
+                    await asyncio.gather(sending, return_exceptions=True)
+                pending.extend(remaining)
+            self._inflight.clear()
+        # 等待重试的消息
+        for handle, job in self._retries.values():
+            handle.cancel()
+            pending.append(job)
+        self._retries.clear()
+        # 未发送的消息溢出保存，下次启动再发送
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        if pending:
+            await self._spill(*pending)
+
+    def put_template(self, to_user_openid, template_id, data, url=None):
+        """
+        放入一条模板消息，不会等待发送结果
+        :return: True 放入内存队列，False 队列满已转存
+        """
+        job = {
+            "to_user_openid": to_user_openid,
+            "template_id": template_id,
+            "url": url,
+            "data": data,
+            "attempts": 0,
+        }
+        self.stats["enqueued"] += 1
+        try:
+            self.queue.put_nowait(job)
+            return True
+        except asyncio.QueueFull:
+            asyncio.ensure_future(self._spill(job))
+            return False
+
+    async def _worker(self):
+        while True:
+            # 按批取出消息，至少等待一条
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # 批次单独运行，服务关闭取消发送协程时不会中断正在发送的消息
+            sending = asyncio.ensure_future(self._send_batch(batch))
+            self._inflight[sending] = list(batch)
+            await asyncio.shield(sending)
+            self._inflight.pop(sending, None)
+            for _ in batch:
+                self.queue.task_done()
+            if self._has_spilled and self.queue.empty():
+                await self._reload_spilled()
+
+    async def _send_batch(self, batch):
+        remaining = self._inflight.get(asyncio.current_task(), [])
+
+        async def send_one(job):
+            await self._send(job)
+            # 发送成功、进入重试或死信之后就不再属于这个批次
+            remaining.remove(job)
+
+        await asyncio.gather(*(send_one(job) for job in batch), return_exceptions=True)
+
+    async def _send(self, job):
+        await self.bucket.acquire()
+        try:
+            await self.get_client().message.send_template(
+                to_user_openid=job["to_user_openid"],
+                template_id=job["template_id"],
+                url=job["url"],
+                data=job["data"],
+            )
+            self.stats["sent"] += 1
+        except Exception as ex:
+            job["attempts"] += 1
+            if job["attempts"] > self.max_retries:
+                self.stats["dead"] += 1
+                logger.warning("模板消息发送失败进入死信: %s %s", ex, job)
+                await self._dead_letter(job)
+                return
+            self.stats["retried"] += 1
+            # 指数退避，触发频率限制时多等一些
+            delay = 2 ** job["attempts"]
+            if isinstance(ex, APILimitedException):
+                delay *= 5
+            handle = asyncio.get_running_loop().call_later(delay, self._requeue, job)
+            self._retries[id(job)] = (handle, job)
+
+    def _requeue(self, job):
+        self._retries.pop(id(job), None)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            asyncio.ensure_future(self._spill(job))
+
+    async def _spill(self, *jobs):
+        redis = self.get_redis()
+        self.stats["spilled"] += len(jobs)
+        if redis is None:
+            logger.warning("模板消息队列已满且未启用redis，丢弃消息: %s", jobs)
+            return
+        await redis.rpush(self.spill_key, *[json.dumps(job) for job in jobs])
+        self._has_spilled = True
+
+    async def _dead_letter(self, job):
+        redis = self.get_redis()
+        if redis is not None:
+            await redis.rpush(self.dead_letter_key, json.dumps(job))
+
+    async def _reload_spilled(self):
+        redis = self.get_redis()
+        if redis is None:
+            self._has_spilled = False
+            return
+        while not self.queue.full():
+            value = await redis.lpop(self.spill_key)
+            if value is None:
+                self._has_spilled = False
+                break
+            self.queue.put_nowait(json.loads(value))
+
+
+template_message_queue = TemplateMessageQueue()
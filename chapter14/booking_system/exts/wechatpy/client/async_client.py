@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import time
+import asyncio
+import logging
+
+import httpx
+
+from exts.wechatpy.constants import WeChatErrorCode
+from exts.wechatpy.utils import json
+from exts.wechatpy.session.asyncmemorystorage import AsyncMemoryStorage
+from exts.wechatpy.exceptions import WeChatClientException, APILimitedException
+from exts.wechatpy.client import WeChatClient
+
+logger = logging.getLogger(__name__)
+
+# 需要刷新 access_token 后重试的错误码
+ACCESS_TOKEN_ERRCODES = (
+    WeChatErrorCode.INVALID_CREDENTIAL.value,
+    WeChatErrorCode.INVALID_ACCESS_TOKEN.value,
+    WeChatErrorCode.EXPIRED_ACCESS_TOKEN.value,
+)
+
+
+class AsyncWeChatClient(WeChatClient):
+    """
+    基于 httpx.AsyncClient 的异步微信 API 操作类
+
+    和 WeChatClient 暴露相同的 message、template、user 等接口对象，接口方法返回协程，
+    需要 await 调用，例如::
+
+        await client.message.send_template(...)
+
+    access_token 的获取：
+
+    * 进程内缓存，未临近过期时不访问存储也不访问微信服务器
+    * 同一时间只有一个协程去刷新，其他协程等待同一个刷新结果（single-flight）
+    * 距离过期不足 refresh_ahead 秒时，先返回当前 token，并在后台提前刷新
+    * session 为 AsyncSessionStorage，使用 AsyncRedisStorage 时多个 worker 共享 token
+
+    :param session: 可选，AsyncSessionStorage 对象，默认使用进程内的 AsyncMemoryStorage
+    :param timeout: 可选，单次请求超时时间，单位秒，默认 10 秒
+    :param refresh_ahead: 可选，提前刷新 access_token 的秒数，默认 300 秒
+    """
+
+    def __init__(
+        self,
+        appid,
+        secret,
+        access_token=None,
+        session=None,
+        timeout=10,
+        auto_retry=True,
+        refresh_ahead=300,
+        max_connections=100,
+        max_keepalive_connections=20,
+    ):
+        super(AsyncWeChatClient, self).__init__(
+            appid, secret, timeout=timeout, auto_retry=auto_retry
+        )
+        self.session = session or AsyncMemoryStorage()
+        self.refresh_ahead = refresh_ahead
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        # 进程内的 access_token 缓存
+        self._access_token = access_token
+        self._refresh_task = None
+        # 连接池需要绑定到运行中的事件循环，延迟到第一次请求时再创建
+        self._http = None
+
+    def init_app(self, app):
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            await self.aclose()
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                ),
+                timeout=self.timeout,
+            )
+        return self._http
+
+    async def aclose(self):
+        """关闭连接池"""
+        if self._http is not None:
+            await self._http.aclose()
+        self._http = None
+
+    @property
+    def access_token_expires_at_key(self):
+        return "{0}_access_token_expires_at".format(self.appid)
+
+    @property
+    def access_token(self):
+        """进程内缓存的 access_token，需要确保有效时请使用 await get_access_token()"""
+        return self._access_token
+
+    async def get_access_token(self):
+        """获取可用的 access_token"""
+        timestamp = time.time()
+        if self._access_token:
+            if not self.expires_at:
+                # 外部提供的 access_token，直接使用
+                return self._access_token
+            if self.expires_at - timestamp > self.refresh_ahead:
+                return self._access_token
+
+        # 进程内缓存临近过期，先看看其他 worker 是否已经刷新过
+        access_token = await self.session.get(self.access_token_key)
+        expires_at = await self.session.get(self.access_token_expires_at_key)
+        if access_token and expires_at and expires_at - timestamp > 60:
+            self._access_token = access_token
+            self.expires_at = expires_at
+            if expires_at - timestamp <= self.refresh_ahead:
+                # 临近过期但还可用，后台提前刷新，当前请求不用等待
+                self._start_refresh()
+            return access_token
+
+        await self.refresh_access_token()
+        return self._access_token
+
+    def _start_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self.fetch_access_token())
+            self._refresh_task.add_done_callback(self._on_refresh_done)
+        return self._refresh_task
+
+    @staticmethod
+    def _on_refresh_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Refresh access token failed: %s", task.exception())
+
+    async def refresh_access_token(self, stale_access_token=None):
+        """
+        刷新 access_token，并发调用时只会有一个协程真正请求微信服务器
+
+        :param stale_access_token: 可选，调用方认为已失效的 token，如果当前 token 已经变化则不再刷新
+        """
+        if stale_access_token and stale_access_token != self._access_token:
+            return
+        # shield 避免等待方被取消时连带取消正在进行的刷新
+        await asyncio.shield(self._start_refresh())
+
+    async def _fetch_access_token(self, url, params):
+        """The real fetch access token"""
+        logger.info("Fetching access token")
+        res = await self.http.get(url=url, params=params)
+        try:
+            res.raise_for_status()
+        except httpx.HTTPStatusError as reqe:
+            raise WeChatClientException(
+                errcode=None,
+                errmsg=None,
+                client=self,
+                request=reqe.request,
+                response=reqe.response,
+            )
+        result = res.json()
+        if "errcode" in result and result["errcode"] != 0:
+            raise WeChatClientException(
+                result["errcode"],
+                result["errmsg"],
+                client=self,
+                request=res.request,
+                response=res,
+            )
+
+        expires_in = 7200
+        if "expires_in" in result:
+            expires_in = result["expires_in"]
+        self._access_token = result["access_token"]
+        self.expires_at = int(time.time()) + expires_in
+        await self.session.set(self.access_token_key, self._access_token, expires_in)
+        await self.session.set(
+            self.access_token_expires_at_key, self.expires_at, expires_in
+        )
+        return result
+
+    async def _request(self, method, url_or_endpoint, **kwargs):
+        if not url_or_endpoint.startswith(("http://", "https://")):
+            api_base_url = kwargs.pop("api_base_url", self.API_BASE_URL)
+            url = "{base}{endpoint}".format(base=api_base_url, endpoint=url_or_endpoint)
+        else:
+            url = url_or_endpoint
+
+        if "params" not in kwargs:
+            kwargs["params"] = {}
+        if (
+            isinstance(kwargs["params"], dict)
+            and "access_token" not in kwargs["params"]
+        ):
+            kwargs["params"]["access_token"] = await self.get_access_token()
+        if isinstance(kwargs.get("data", ""), dict):
+            body = json.dumps(kwargs["data"], ensure_ascii=False)
+            body = body.encode("utf-8")
+            kwargs["data"] = body
+
+        kwargs["timeout"] = kwargs.get("timeout", self.timeout)
+        result_processor = kwargs.pop("result_processor", None)
+        res = await self.http.request(
+            method=method,
+            url=url,
+            params=kwargs["params"],
+            content=kwargs.get("data"),
+            timeout=kwargs["timeout"],
+        )
+        try:
+            res.raise_for_status()
+        except httpx.HTTPStatusError as reqe:
+            raise WeChatClientException(
+                errcode=None,
+                errmsg=None,
+                client=self,
+                request=reqe.request,
+                response=reqe.response,
+            )
+
+        return await self._handle_result(res, method, url, result_processor, **kwargs)
+
+    async def _handle_result(
+        self, res, method=None, url=None, result_processor=None, **kwargs
+    ):
+        result = self._decode_result(res)
+        if not isinstance(result, dict):
+            return result
+
+        if "base_resp" in result:
+            # Different response in device APIs. Fuck tencent!
+            result.update(result.pop("base_resp"))
+        if "errcode" in result:
+            result["errcode"] = int(result["errcode"])
+
+        if "errcode" in result and result["errcode"] != 0:
+            errcode = result["errcode"]
+            errmsg = result.get("errmsg", errcode)
+            auto_retry = kwargs.pop("auto_retry", self.auto_retry)
+            if auto_retry and errcode in ACCESS_TOKEN_ERRCODES:
+                logger.info("Access token expired, fetch a new one and retry request")
+                await self.refresh_access_token(
+                    stale_access_token=kwargs["params"].get("access_token")
+                )
+                kwargs["params"]["access_token"] = self._access_token
+                # 只重试一次，避免 token 持续无效时无限递归
+                kwargs["auto_retry"] = False
+                return await self._request(
+                    method=method,
+                    url_or_endpoint=url,
+                    result_processor=result_processor,
+                    **kwargs
+                )
+            elif errcode == WeChatErrorCode.OUT_OF_API_FREQ_LIMIT.value:
+                # api freq out of limit
+                raise APILimitedException(
+                    errcode, errmsg, client=self, request=res.request, response=res
+                )
+            else:
+                raise WeChatClientException(
+                    errcode, errmsg, client=self, request=res.request, response=res
+                )
+
+        return result if not result_processor else result_processor(result)
@@ -4,8 +4,6 @@ import inspect
 import logging
 
 import requests
-import xmltodict
-from xml.parsers.expat import ExpatError
 from optionaldict import optionaldict
 
 from exts.wechatpy.utils import random_string
@@ -16,6 +14,7 @@ from exts.wechatpy.pay.utils import (
     _check_signature,
     dict_to_xml,
 )
+from exts.wechatpy.pay.xmlcodec import FlatXMLError, decode_flat_xml, convert_int_fields
 from exts.wechatpy.pay.base import BaseWeChatPayAPI
 from exts.wechatpy.pay import api
 
@@ -110,9 +109,10 @@ class WeChatPay(object):
         headers = {"Content-Type": "text/xml"}
         api_url = "{base}sandboxnew/pay/getsignkey".format(base=self.API_BASE_URL)
         response = self._http.post(api_url, data=payload, headers=headers)
-        return xmltodict.parse(response.text)["xml"].get("sandbox_signkey")
+        return decode_flat_xml(response.content).get("sandbox_signkey")
 
-    def _request(self, method, url_or_endpoint, **kwargs):
+    def _prepare_request(self, url_or_endpoint, kwargs):
+        """拼接请求地址，并对 dict 类型的 data 补全公共参数、签名后转为 XML 报文"""
         if not url_or_endpoint.startswith(("http://", "https://")):
             api_base_url = kwargs.pop("api_base_url", self.API_BASE_URL)
             if self.sandbox:
@@ -142,6 +142,11 @@ class WeChatPay(object):
             body = body.encode("utf-8")
             kwargs["data"] = body
 
+        return url
+
+    def _request(self, method, url_or_endpoint, **kwargs):
+        url = self._prepare_request(url_or_endpoint, kwargs)
+
         # 商户证书
         if self.mch_cert and self.mch_key:
             kwargs["cert"] = (self.mch_cert, self.mch_key)
@@ -163,14 +168,14 @@ class WeChatPay(object):
 
     def _handle_result(self, res):
         res.encoding = "utf-8"
-        xml = res.text
-        logger.debug("Response from WeChat API \n %s", xml)
+        logger.debug("Response from WeChat API \n %s", res.content)
         try:
-            data = xmltodict.parse(xml)["xml"]
-        except (xmltodict.ParsingInterrupted, ExpatError):
+            # 直接解析原始的字节内容，不需要先解码为字符串
+            data = decode_flat_xml(res.content)
+        except FlatXMLError:
             # 解析 XML 失败
             logger.debug("WeChat payment result xml parsing error", exc_info=True)
-            return xml
+            return res.text
 
         return_code = data["return_code"]
         return_msg = data.get("return_msg")
@@ -203,37 +208,21 @@ class WeChatPay(object):
         )
 
     def parse_payment_result(self, xml):
-        """解析微信支付结果通知"""
+        """
+        解析微信支付结果通知，只解析一次，签名校验和业务字段使用同一个解析结果
+        """
         try:
-            data = xmltodict.parse(xml)
-        except (xmltodict.ParsingInterrupted, ExpatError):
+            data = decode_flat_xml(xml)
+        except FlatXMLError:
             raise InvalidSignatureException()
 
-        if not data or "xml" not in data:
+        if not data:
             raise InvalidSignatureException()
 
-        data = data["xml"]
-        sign = data.pop("sign", None)
-        if "#text" in data.keys():
-            pass
-            del data["#text"]
-        real_sign = calculate_signature(
-            data, self.api_key if not self.sandbox else self.sandbox_api_key
-        )
-        if sign != real_sign:
+        if not self.check_signature(data):
             raise InvalidSignatureException()
 
-        for key in (
-            "total_fee",
-            "settlement_total_fee",
-            "cash_fee",
-            "coupon_fee",
-            "coupon_count",
-        ):
-            if key in data:
-                data[key] = int(data[key])
-        data["sign"] = sign
-        return data
+        return convert_int_fields(data)
 
     @property
     def sandbox_api_key(self):
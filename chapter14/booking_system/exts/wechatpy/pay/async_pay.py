@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import asyncio
+import logging
+
+import httpx
+
+from exts.wechatpy.utils import random_string
+from exts.wechatpy.exceptions import WeChatPayException
+from exts.wechatpy.pay.utils import calculate_signature, dict_to_xml
+from exts.wechatpy.pay.xmlcodec import decode_flat_xml
+from exts.wechatpy.pay import WeChatPay
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWeChatPay(WeChatPay):
+    """
+    基于 httpx.AsyncClient 的异步微信支付接口
+
+    和 WeChatPay 暴露相同的 order、refund、jsapi 等接口对象，只是需要发起网络请求的
+    方法返回的是协程，需要 await 调用，例如::
+
+        result = await wx_pay.order.create(...)
+
+    不需要网络请求的签名方法（如 order.get_appapi_params_xiugai、jsapi.get_jsapi_params）
+    还是同步调用。
+
+    :param timeout: 可选，单次请求超时时间，单位秒，默认 10 秒
+    :param max_connections: 可选，连接池最大连接数
+    :param max_keepalive_connections: 可选，连接池保持长连接的数量
+    :param max_concurrency: 可选，同时在途的请求数上限，超出的请求排队等待
+    """
+
+    def __init__(
+        self,
+        appid,
+        api_key,
+        mch_id,
+        sub_mch_id=None,
+        mch_cert=None,
+        mch_key=None,
+        timeout=10,
+        sandbox=False,
+        sub_appid=None,
+        max_connections=100,
+        max_keepalive_connections=20,
+        max_concurrency=50,
+    ):
+        super(AsyncWeChatPay, self).__init__(
+            appid,
+            api_key,
+            mch_id,
+            sub_mch_id=sub_mch_id,
+            mch_cert=mch_cert,
+            mch_key=mch_key,
+            timeout=timeout,
+            sandbox=sandbox,
+            sub_appid=sub_appid,
+        )
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.max_concurrency = max_concurrency
+        # 连接池和并发信号量需要绑定到运行中的事件循环，所以延迟到第一次请求时再创建
+        self._http = None
+        self._semaphore = None
+
+    def init_app(self, app):
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            await self.aclose()
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            cert = None
+            # 商户证书，httpx 的证书只能在创建客户端时指定
+            if self.mch_cert and self.mch_key:
+                cert = (self.mch_cert, self.mch_key)
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                ),
+                timeout=self.timeout,
+                cert=cert,
+            )
+        return self._http
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def aclose(self):
+        """关闭连接池"""
+        if self._http is not None:
+            await self._http.aclose()
+        self._http = None
+
+    async def _fetch_sandbox_api_key_async(self):
+        nonce_str = random_string(32)
+        sign = calculate_signature(
+            {"mch_id": self.mch_id, "nonce_str": nonce_str}, self.api_key
+        )
+        payload = dict_to_xml(
+            {
+                "mch_id": self.mch_id,
+                "nonce_str": nonce_str,
+            },
+            sign=sign,
+        )
+        headers = {"Content-Type": "text/xml"}
+        api_url = "{base}sandboxnew/pay/getsignkey".format(base=self.API_BASE_URL)
+        response = await self.http.post(api_url, content=payload, headers=headers)
+        return decode_flat_xml(response.content).get("sandbox_signkey")
+
+    async def _request(self, method, url_or_endpoint, **kwargs):
+        if self.sandbox and self._sandbox_api_key is None:
+            self._sandbox_api_key = await self._fetch_sandbox_api_key_async()
+
+        url = self._prepare_request(url_or_endpoint, kwargs)
+        timeout = kwargs.pop("timeout", self.timeout)
+        logger.debug("Request to WeChat API: %s %s\n%s", method, url, kwargs)
+        try:
+            async with self.semaphore:
+                res = await self.http.request(
+                    method=method,
+                    url=url,
+                    content=kwargs.get("data"),
+                    params=kwargs.get("params"),
+                    headers=kwargs.get("headers"),
+                    timeout=timeout,
+                )
+            res.raise_for_status()
+        except httpx.HTTPStatusError as reqe:
+            raise WeChatPayException(
+                return_code=None,
+                client=self,
+                request=reqe.request,
+                response=reqe.response,
+            )
+        except httpx.TimeoutException as reqe:
+            raise WeChatPayException(
+                return_code=None,
+                errmsg="请求微信支付接口超时",
+                client=self,
+                request=reqe.request,
+            )
+
+        return self._handle_result(res)
+
+    async def get(self, url, **kwargs):
+        return await self._request(method="get", url_or_endpoint=url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._request(method="post", url_or_endpoint=url, **kwargs)
@@ -2,14 +2,13 @@
 from __future__ import absolute_import, unicode_literals
 
 import base64
-import copy
 import hashlib
 import hmac
 import socket
 import logging
-import six
 
 from exts.wechatpy.utils import to_binary, to_text
+from exts.wechatpy.pay.xmlcodec import encode_flat_xml
 
 logger = logging.getLogger(__name__)
 
@@ -20,16 +19,15 @@ def format_url(params, api_key=None):
     #     del params['#text']
     #     print( params['#text'])
 
-    data = [
-        to_binary("{0}={1}".format(k, params[k])) for k in sorted(params) if params[k]
-    ]
+    # 先拼接成一个字符串再编码，不需要逐个字段编码
+    data = [f"{k}={params[k]}" for k in sorted(params) if params[k]]
     # 微信支付回调的验证签名的修改！！！！zyxyuanxiao  del data[0]
     # 微信支付回调的验证签名的修改！！！！zyxyuanxiao  del data[0]
     # 微信支付回调的验证签名的修改！！！！zyxyuanxiao  del data[0]
     # del data[0]
     if api_key:
-        data.append(to_binary("key={0}".format(api_key)))
-    return b"&".join(data)
+        data.append(f"key={api_key}")
+    return to_binary("&".join(data))
 
 
 def calculate_signature(params, api_key):
@@ -49,24 +47,15 @@ def calculate_signature_hmac(params, api_key):
 
 
 def _check_signature(params, api_key):
-    _params = copy.deepcopy(params)
-    sign = _params.pop("sign", "")
-    return sign == calculate_signature(_params, api_key)
+    # 只复制一层，不修改传入的参数
+    sign = params.get("sign", "")
+    return sign == calculate_signature(
+        {k: v for k, v in params.items() if k != "sign"}, api_key
+    )
 
 
 def dict_to_xml(d, sign):
-    xml = ["<xml>\n"]
-    for k in sorted(d):
-        # use sorted to avoid test error on Py3k
-        v = d[k]
-        if isinstance(v, six.integer_types) or (
-            isinstance(v, six.string_types) and v.isdigit()
-        ):
-            xml.append("<{0}>{1}</{0}>\n".format(to_text(k), to_text(v)))
-        else:
-            xml.append("<{0}><![CDATA[{1}]]></{0}>\n".format(to_text(k), to_text(v)))
-    xml.append("<sign><![CDATA[{0}]]></sign>\n</xml>".format(to_text(sign)))
-    return "".join(xml)
+    return encode_flat_xml(d, to_text(sign))
 
 
 def get_external_ip():
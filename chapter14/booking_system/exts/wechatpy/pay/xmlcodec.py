@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付报文的XML编解码
+
+微信支付的请求、响应和回调通知都是只有一层的 <xml> 文档::
+
+    <xml>
+        <return_code><![CDATA[SUCCESS]]></return_code>
+        <total_fee>1</total_fee>
+    </xml>
+
+这里针对这种结构直接使用 expat 解析成普通的 dict，不生成 xmltodict 的中间 OrderedDict，
+编码时直接拼接字符串，不做逐个字段的类型转换。
+"""
+from __future__ import absolute_import, unicode_literals
+
+import typing
+from xml.parsers import expat
+
+# 回调通知中需要转换为整数的字段
+INT_FIELDS = (
+    "total_fee",
+    "settlement_total_fee",
+    "cash_fee",
+    "coupon_fee",
+    "coupon_count",
+)
+
+
+class FlatXMLError(ValueError):
+    """不是只有一层的 <xml> 文档"""
+
+
+def encode_flat_xml(data: typing.Mapping, sign=None) -> str:
+    """
+    按key排序编码为 <xml> 文档，整数不加 CDATA，其他值都放在 CDATA 中
+    :param data: 需要编码的参数，值为None的参数不编码
+    :param sign: 可选，签名，放在最后
+    :return:
+    """
+    xml = ["<xml>\n"]
+    append = xml.append
+    for k in sorted(data):
+        v = data[k]
+        if v is None:
+            continue
+        if isinstance(v, int) and not isinstance(v, bool):
+            append(f"<{k}>{v}</{k}>\n")
+        else:
+            # CDATA 中不能出现 ]]>，需要拆分到两个 CDATA 中
+            append(f"<{k}><![CDATA[{str(v).replace(']]>', ']]]]><![CDATA[>')}]]></{k}>\n")
+    if sign is not None:
+        append(f"<sign><![CDATA[{sign}]]></sign>\n")
+    append("</xml>")
+    return "".join(xml)
+
+
+def decode_flat_xml(xml: typing.Union[bytes, str]) -> typing.Dict[str, typing.Any]:
+    """
+    解析只有一层的 <xml> 文档为 dict，空的字段值为None（和 xmltodict 保持一致）
+    :raise FlatXMLError: 报文格式错误、根节点不是xml、存在嵌套节点或者包含DTD
+    :return:
+    """
+    data = {}
+    text = []
+    state = {"depth": 0, "key": None}
+
+    def start_element(name, attrs):
+        depth = state["depth"] = state["depth"] + 1
+        if depth == 1:
+            if name != "xml":
+                raise FlatXMLError("根节点不是xml")
+        elif depth == 2:
+            state["key"] = name
+            text.clear()
+        else:
+            raise FlatXMLError("不支持嵌套的节点：{}".format(name))
+
+    def end_element(name):
+        if state["depth"] == 2:
+            data[state["key"]] = "".join(text) or None
+        state["depth"] -= 1
+
+    def char_data(value):
+        # 根节点下的空白忽略
+        if state["depth"] == 2:
+            text.append(value)
+
+    def reject_doctype(*args):
+        # 外部的回调报文不允许带DTD，避免实体扩展攻击
+        raise FlatXMLError("不允许DTD")
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = char_data
+    parser.StartDoctypeDeclHandler = reject_doctype
+    parser.EntityDeclHandler = reject_doctype
+    try:
+        parser.Parse(xml, True)
+    except expat.ExpatError as ex:
+        raise FlatXMLError(str(ex)) from ex
+    return data
+
+
+def convert_int_fields(data: typing.Dict, fields=INT_FIELDS):
+    """把金额、数量相关的字段原地转换为整数"""
+    for key in fields:
+        value = data.get(key)
+        if value is not None:
+            data[key] = int(value)
+    return data
+
+
+if __name__ == "__main__":
+    # 和原来的 xmltodict + dict_to_xml 的处理方式对比：
+    # python -m exts.wechatpy.pay.xmlcodec
+    import copy
+    import timeit
+
+    import xmltodict
+
+    from exts.wechatpy.pay.utils import calculate_signature
+
+    api_key = "192006250b4c09247ec02edce69f6a2d"
+    params = {
+        "appid": "wx2421b1c4370ec43b",
+        "attach": "10001|2207081548588935269|10001-20220708-am-1",
+        "bank_type": "CFT",
+        "fee_type": "CNY",
+        "is_subscribe": "Y",
+        "mch_id": "10000100",
+        "nonce_str": "5d2b6c2a8db53831f7eda20af46e531c",
+        "openid": "oUpF8uMEb4qRXf22hE3X68TekukE",
+        "out_trade_no": "2207081548588935269",
+        "result_code": "SUCCESS",
+        "return_code": "SUCCESS",
+        "time_end": "20140903131540",
+        "total_fee": "1",
+        "cash_fee": "1",
+        "coupon_fee": "10",
+        "coupon_count": "1",
+        "coupon_type": "CASH",
+        "coupon_id": "10000",
+        "trade_type": "JSAPI",
+        "transaction_id": "1004400740201409030005092168",
+    }
+    notify_xml = encode_flat_xml(params, calculate_signature(params, api_key)).encode()
+
+    def old_dict_to_xml(d, sign):
+        xml = ["<xml>\n"]
+        for k in sorted(d):
+            v = d[k]
+            if isinstance(v, int) or (isinstance(v, str) and v.isdigit()):
+                xml.append("<{0}>{1}</{0}>\n".format(k, v))
+            else:
+                xml.append("<{0}><![CDATA[{1}]]></{0}>\n".format(k, v))
+        xml.append("<sign><![CDATA[{0}]]></sign>\n</xml>".format(sign))
+        return "".join(xml)
+
+    def old_notify():
+        # 原来的 parse_payment_result：xmltodict 解析 + pop 签名后校验
+        data = xmltodict.parse(notify_xml)["xml"]
+        sign = data.pop("sign", None)
+        assert sign == calculate_signature(data, api_key)
+        convert_int_fields(data)
+        data["sign"] = sign
+        return data
+
+    def new_notify():
+        data = decode_flat_xml(notify_xml)
+        assert data["sign"] == calculate_signature(
+            {k: v for k, v in data.items() if k != "sign"}, api_key
+        )
+        return convert_int_fields(data)
+
+    def old_check_signature(params):
+        _params = copy.deepcopy(params)
+        sign = _params.pop("sign", "")
+        return sign == calculate_signature(_params, api_key)
+
+    def new_check_signature(params):
+        return params["sign"] == calculate_signature(
+            {k: v for k, v in params.items() if k != "sign"}, api_key
+        )
+
+    assert old_notify() == new_notify()
+    notify_data = new_notify()
+    number = 20000
+    for name, stmt in (
+        ("encode old dict_to_xml", lambda: old_dict_to_xml(params, "SIGN")),
+        ("encode encode_flat_xml", lambda: encode_flat_xml(params, "SIGN")),
+        ("decode xmltodict", lambda: xmltodict.parse(notify_xml)["xml"]),
+        ("decode decode_flat_xml", lambda: decode_flat_xml(notify_xml)),
+        ("check_signature deepcopy", lambda: old_check_signature(notify_data)),
+        ("check_signature shallow", lambda: new_check_signature(notify_data)),
+        ("notify old", old_notify),
+        ("notify new", new_notify),
+    ):
+        cost = min(timeit.repeat(stmt, number=number, repeat=5)) / number
+        print(f"{name:<28}{cost * 1e6:>10.2f} us/op")
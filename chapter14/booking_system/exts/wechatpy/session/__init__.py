@@ -21,3 +21,16 @@ class SessionStorage(object):
 
     def __delitem__(self, key):
         self.delete(key)
+
+
+class AsyncSessionStorage(object):
+    """异步的会话存储，get/set/delete 均为协程，用于 AsyncWeChatClient"""
+
+    async def get(self, key, default=None):
+        raise NotImplementedError()
+
+    async def set(self, key, value, ttl=None):
+        raise NotImplementedError()
+
+    async def delete(self, key):
+        raise NotImplementedError()
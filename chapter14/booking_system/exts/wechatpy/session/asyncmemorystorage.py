@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import time
+
+from exts.wechatpy.session import AsyncSessionStorage
+
+
+class AsyncMemoryStorage(AsyncSessionStorage):
+
+    def __init__(self):
+        self._data = {}
+
+    async def get(self, key, default=None):
+        value, expires_at = self._data.get(key, (default, None))
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(key, None)
+            return default
+        return value
+
+    async def set(self, key, value, ttl=None):
+        if value is None:
+            return
+        self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    async def delete(self, key):
+        self._data.pop(key, None)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from exts.wechatpy.session import AsyncSessionStorage
+from exts.wechatpy.utils import to_text
+from exts.wechatpy.utils import json
+
+
+class AsyncRedisStorage(AsyncSessionStorage):
+    """基于 aioredis 的异步会话存储，多个 worker 进程共享同一份 access_token"""
+
+    def __init__(self, redis, prefix="wechatpy"):
+        for method_name in ("get", "set", "delete"):
+            assert hasattr(redis, method_name)
+        self.redis = redis
+        self.prefix = prefix
+
+    def key_name(self, key):
+        return "{0}:{1}".format(self.prefix, key)
+
+    async def get(self, key, default=None):
+        key = self.key_name(key)
+        value = await self.redis.get(key)
+        if value is None:
+            return default
+        return json.loads(to_text(value))
+
+    async def set(self, key, value, ttl=None):
+        if value is None:
+            return
+        key = self.key_name(key)
+        value = json.dumps(value)
+        await self.redis.set(key, value, ex=ttl)
+
+    async def delete(self, key):
+        key = self.key_name(key)
+        await self.redis.delete(key)
@@ -2,12 +2,20 @@ from contextvars import ContextVar
 from fastapi import Request
 import shortuuid
 from exts.requestvar.bing import bind_contextvar
-from starlette.types import ASGIApp, Receive, Scope, Send
-from user_agents import parse
-from urllib.parse import parse_qs
+from exts.logururoute.writer import (
+    log_writer,
+    BackgroundLogWriter,
+    parse_useragent,
+    redact,
+    decode_body,
+    decode_query,
+    DEFAULT_REDACT_FIELDS,
+)
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from datetime import datetime
 from loguru import logger
-from utils import json_helper
+import random
+import time
 import typing
 from time import perf_counter
 
@@ -62,6 +70,10 @@ def setup_ext_loguru(log_pro_path: str = None):
     )  # Automatically rotate too big file
 
 
+def _format_ts(timestamp):
+    return f"{datetime.fromtimestamp(timestamp):%Y-%m-%d %H:%M:%S%z}"
+
+
 async def async_trace_add_log_record(event_type="", msg={}, remarks=""):
     """
 
@@ -93,19 +105,18 @@ async def async_trace_add_log_record(event_type="", msg={}, remarks=""):
             log.pop("remarks")
         if not msg:
             log.pop("msg")
-        try:
-            log_msg = json_helper.dict_to_json_ensure_ascii(log)  # 返回文本
-            logger.info(log_msg)
-        except:
-            logger.info(
-                getattr(request.state, "traceid")
-                + "：索引："
-                + str(getattr(request.state, "trace_links_index"))
-                + ":日志信息写入异常"
-            )
+        # 交给后台线程序列化和写入
+        log_writer.submit(lambda: (log,))
 
 
 class LogerMiddleware:
+    """
+    纯ASGI的请求日志中间件
+
+    1：不预先读取请求体，而是在应用读取请求体的时候顺带复制一份（最多 max_body_size 字节）
+    2：按路由前缀采样，未采样的请求只在出现5xx错误时记录
+    3：请求过程中只采集原始数据，请求体解析、UA解析（带缓存）、脱敏和写入都交给后台线程
+    """
 
     def __init__(
         self,
@@ -116,221 +127,180 @@ class LogerMiddleware:
         is_record_headers=False,
         nesss_access_heads_keys=[],
         ignore_url: typing.List = ["/favicon.ico", "websocket"],
+        sample_rates: typing.Dict[str, float] = None,
+        default_sample_rate: float = 1.0,
+        redact_fields: typing.Iterable[str] = DEFAULT_REDACT_FIELDS,
+        max_body_size: int = 4096,
+        writer: BackgroundLogWriter = log_writer,
     ) -> None:
+        """
+        :param sample_rates: 路由前缀对应的采样率，如 {"/api/v1/doctor_list": 0.01}
+        :param default_sample_rate: 没有匹配到路由前缀时的采样率
+        :param redact_fields: 请求参数中需要脱敏的字段
+        :param max_body_size: 最多记录的请求体字节数
+        """
         self.app = app
         self.is_record_useragent = is_record_useragent
         self.is_record_headers = is_record_headers
-        self.nesss_access_heads_keys = nesss_access_heads_keys
+        self.nesss_access_heads_keys = [
+            key.lower().encode("latin-1") for key in nesss_access_heads_keys
+        ]
         self.ignore_url = ignore_url
+        # 长的前缀优先匹配
+        self.sample_rates = sorted(
+            (sample_rates or {}).items(), key=lambda item: len(item[0]), reverse=True
+        )
+        self.default_sample_rate = default_sample_rate
+        self.redact_fields = frozenset(field.lower() for field in redact_fields)
+        self.max_body_size = max_body_size
+        self.writer = writer
         setup_ext_loguru(log_pro_path)
 
-    def make_traceid(self, request) -> None:
-        """
-        生成追踪链路ID
-        :param request:
-        :return:
-        """
-        request.state.traceid = shortuuid.uuid()
-        # 追踪索引序号
-        request.state.trace_links_index = 0
-        # 追踪ID
-        request.state.traceid = shortuuid.uuid()
-        # 计算时间
-        request.state.start_time = perf_counter()
-
-    def make_token_request(self, request):
-        """
-        生成当前请求上下文对象request
-        :param request:
-        :return:
-        """
-        return request_var.set(request)
-
-    def reset_token_request(self, token_request):
-        """
-        重置当前请求上下文对象request
-        :param request:
-        :return:
-        """
-        request_var.reset(token_request)
-
-    async def get_request_body(self, request) -> typing.AnyStr:
-        body = None
-        try:
-            body_bytes = await request.body()
-            if body_bytes:
-                try:
-                    body = await request.json()
-                except:
-                    pass
-                    if body_bytes:
-                        try:
-                            body = body_bytes.decode("utf-8")
-                        except:
-                            body = body_bytes.decode("gb2312")
-        except:
-            pass
-        request.state.body = body
-        return body
-
-    def filter_request_url(self, request):
-        path_info = request.url.path
+    def filter_request_url(self, path_info):
         # 过滤不需要记录日志请求地址URL
         for item in self.ignore_url:
-            if path_info not in item:
-                return True
-        return False
+            if item in path_info:
+                return False
+        return True
 
-    async def make_request_log_msg(self, request) -> typing.Dict:
-        # 从当前请求中获取到具体的客户端信息
-        ip, method, url = request.client.host, request.method, request.url.path
-        # 解析请求提交的表单信息
-        try:
-            body_form = await request.form()
-        except:
-            body_form = None
-        # 在这里记录下当前提交的body的数据，用于下文的提取
-        body = await self.get_request_body(request)
-        # 从头部里面获取出对应的请求头信息，用户用户机型等信息获取
-        try:
-            user_agent = parse(request.headers["user-agent"])
-            # 提取UA信息
-            browser = user_agent.browser.version
-            if len(browser) >= 2:
-                browser_major, browser_minor = browser[0], browser[1]
-            else:
-                browser_major, browser_minor = 0, 0
-            # 用户当前系统OS信息提取
-            user_os = user_agent.os.version
-            if len(user_os) >= 2:
-                os_major, os_minor = user_os[0], user_os[1]
-            else:
-                os_major, os_minor = 0, 0
+    def is_sampled(self, path_info):
+        sample_rate = self.default_sample_rate
+        for prefix, rate in self.sample_rates:
+            if path_info.startswith(prefix):
+                sample_rate = rate
+                break
+        return sample_rate >= 1 or random.random() < sample_rate
+
+    def build_logs(
+        self,
+        traceid,
+        method,
+        path_info,
+        query_string,
+        client,
+        headers,
+        body_bytes,
+        status_code,
+        cost_time,
+        start_ts,
+        response_trace_index,
+    ):
+        """在后台线程中调用，生成请求和响应两条日志"""
+        header_dict = dict(headers)
+        content_type = header_dict.get(b"content-type", b"").decode("latin-1")
+        params = {
+            "query_params": redact(decode_query(query_string), self.redact_fields),
+            "body": redact(decode_body(body_bytes, content_type), self.redact_fields),
+        }
+        log_msg = {
+            "url": path_info,
+            # 记录请求方法
+            "method": method,
+            # 记录请求来源IP
+            "ip": client[0] if client else None,
+            # 记录请求提交的参数信息
+            "params": {k: v for k, v in params.items() if v},
+            "ts": _format_ts(start_ts),
+        }
+        if self.is_record_headers and self.nesss_access_heads_keys:
+            log_msg["headers"] = [
+                header_dict.get(key, b"").decode("latin-1")
+                for key in self.nesss_access_heads_keys
+            ]
+        if self.is_record_useragent and b"user-agent" in header_dict:
+            log_msg["useragent"] = parse_useragent(
+                header_dict[b"user-agent"].decode("latin-1")
+            )
+        yield {
+            "traceid": traceid,
+            "trace_index": 0,
+            "event_type": "request",
+            "msg": log_msg,
+        }
+        yield {
+            "traceid": traceid,
+            "trace_index": response_trace_index,
+            "event_type": "response",
+            "msg": {
+                "status_code": status_code,
+                "cost_time": f"{cost_time:.4f}",
+                "ts": _format_ts(start_ts + cost_time),
+            },
+        }
+
+    async def lifespan(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """跟随应用的启动和关闭启停后台写日志的线程"""
 
-            log_msg = {
-                "headers": (
-                    None
-                    if not self.is_record_headers
-                    else (
-                        [
-                            request.headers.get(i, "")
-                            for i in self.nesss_access_heads_keys
-                        ]
-                        if self.nesss_access_heads_keys
-                        else None
-                    )
-                ),
-                # 记录请求URL信息
-                "useragent": (
-                    None
-                    if not self.is_record_useragent
-                    else {
-                        "os": "{} {}".format(
-                            user_agent.os.family, user_agent.os.version_string
-                        ),
-                        "browser": "{} {}".format(
-                            user_agent.browser.family, user_agent.browser.version_string
-                        ),
-                        "device": {
-                            "family": user_agent.device.family,
-                            "brand": user_agent.device.brand,
-                            "model": user_agent.device.model,
-                        },
-                    }
-                ),
-                "url": url,
-                # 记录请求方法
-                "method": method,
-                # 记录请求来源IP
-                "ip": ip,
-                # 'path': gziprequest.path,
-                # 记录请求提交的参数信息
-                "params": {
-                    "query_params": parse_qs(str(request.query_params)),
-                    "from": body_form,
-                    "body": body,
-                },
-                "ts": f"{datetime.now():%Y-%m-%d %H:%M:%S%z}",
-            }
-            # 对于没有的数据清除
-            if not log_msg["headers"]:
-                log_msg.pop("headers")
-            if not log_msg["params"]["query_params"]:
-                log_msg["params"].pop("query_params")
-            if not log_msg["params"]["from"]:
-                log_msg["params"].pop("from")
-            if not log_msg["params"]["body"]:
-                log_msg["params"].pop("body")
-        except:
-            log_msg = {
-                "headers": (
-                    None
-                    if not self.is_record_headers
-                    else (
-                        [
-                            request.headers.get(i, "")
-                            for i in self.nesss_access_heads_keys
-                        ]
-                        if self.nesss_access_heads_keys
-                        else None
-                    )
-                ),
-                "url": url,
-                "method": method,
-                "ip": ip,
-                "params": {
-                    "query_params": parse_qs(str(request.query_params)),
-                    "from": body_form,
-                    "body": body,
-                },
-                "ts": f"{datetime.now():%Y-%m-%d %H:%M:%S%z}",
-            }
+        async def receive_wrapper() -> Message:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.writer.start()
+            return message
 
-        print("log_msg", log_msg)
-        # 对于没有的数据清除
-        if "headers" in log_msg and not log_msg["headers"]:
-            log_msg.pop("headers")
-        if log_msg["params"]:
-            if (
-                "query_params" in log_msg["params"]
-                and not log_msg["params"]["query_params"]
-            ):
-                log_msg["params"].pop("query_params")
-            print(log_msg["params"])
-            if "from" in log_msg["params"] and not log_msg["params"]["from"]:
-                log_msg["params"].pop("from")
-            if "body" in log_msg["params"] and not log_msg["params"]["body"]:
-                log_msg["params"].pop("body")
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "lifespan.shutdown.complete":
+                # 应用的shutdown事件都执行完之后，再把队列里面剩余的日志写完
+                self.writer.stop()
+            await send(message)
 
-        return log_msg
+        await self.app(scope, receive_wrapper, send_wrapper)
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
-        if scope["type"] != "http":  # pragma: no cover
+        if scope["type"] == "lifespan":
+            await self.lifespan(scope, receive, send)
+            return
+        if scope["type"] != "http" or not self.filter_request_url(scope["path"]):
             await self.app(scope, receive, send)
             return
 
-        # 读取一次
-        receive_ = await receive()
+        start_ts, start_time = time.time(), perf_counter()
+        traceid = shortuuid.uuid()
+        # request.state 就是 scope["state"]，链路ID和索引供业务里面记录日志使用
+        state = scope.setdefault("state", {})
+        state["traceid"] = traceid
+        state["trace_links_index"] = 0
+        sampled = self.is_sampled(scope["path"])
+        body_chunks = []
+        body_size = 0
+        status_code = 500
 
-        # 并定义一个新协程函数的方式返回一个协程
-        async def receive():
-            return receive_
+        async def receive_tee() -> Message:
+            nonlocal body_size
+            message = await receive()
+            # 应用读取请求体的时候顺带复制一份，不改变原来的消息
+            if sampled and message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                if chunk and body_size < self.max_body_size:
+                    chunk = chunk[: self.max_body_size - body_size]
+                    body_chunks.append(chunk)
+                    body_size += len(chunk)
+            return message
 
-        # 创建需要解析的参数
-        request = Request(scope, receive)
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
 
-        # 过滤需要记录的请求URL
-        if self.filter_request_url(request):
-            # 生成链路ID
-            self.make_traceid(request)
-            # 设置当当前上下文管理对象中
-            token_request = self.make_token_request(request)
-            # 生成日志记录
-            log_msg = await self.make_request_log_msg(request)
-            # 开始写日志信息到文件中
-            await async_trace_add_log_record(event_type="request", msg=log_msg)
-            try:
-                response = await self.app(scope, receive, send)
-                return response
-            finally:
-                self.reset_token_request(token_request)
+        # 设置当当前上下文管理对象中
+        token_request = request_var.set(Request(scope, receive_tee))
+        try:
+            await self.app(scope, receive_tee, send_wrapper)
+        finally:
+            request_var.reset(token_request)
+            if sampled or status_code >= 500:
+                self.writer.submit(
+                    self.build_logs,
+                    traceid,
+                    scope["method"],
+                    scope["path"],
+                    scope.get("query_string"),
+                    scope.get("client"),
+                    scope["headers"],
+                    b"".join(body_chunks),
+                    status_code,
+                    perf_counter() - start_time,
+                    start_ts,
+                    # 排在业务里面记录的日志之后
+                    state.get("trace_links_index", 0) + 1,
+                )
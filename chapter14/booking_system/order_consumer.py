@@ -8,101 +8,141 @@
    创建时间 :          2021/10/19
 -------------------------------------------------
    修改描述-2021/10/19:
+   修改描述: 改为基于aio_pika的异步消费者，超时订单按批合并处理：
+            1：一批消息只执行一次订单状态更新（orderid = ANY(...) AND statue = 1）
+            2：同一批里按号源合并后一次回补库存
+            3：数据库事务提交后一次性批量确认消息（multiple=True）
 -------------------------------------------------
 """
-import pika
-import time
+import asyncio
+from collections import Counter
+from typing import List
+
+import aio_pika
+import aioredis
+from aio_pika.abc import AbstractIncomingMessage
+
 from utils import json_helper
-from db.sync_database import sync_context_get_db
-from db.models import DoctorSubscribeinfo
-from sqlalchemy.sql import and_, asc, desc, or_
+from config.config import get_settings
+from db.async_database import async_context_get_db
+from apis.payorders.repository import PayOrderServeries
+from apis.doctor.repository import DoctorServeries
+from exts.stock_push import stock_push_hub
 
-# 创建用户登入的凭证，使用rabbitmq用户密码登录
-credentials = pika.PlainCredentials("guest", "guest")
-# 创建连接http://47.99.189.42:30100/
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(
-        host="localhost", port=5672, virtual_host="yuyueguahao", credentials=credentials
-    )
-)
-# 通过连接创建信道
-channel = connection.channel()
-# 通过信道创建我们的队列 其中名称是task_queue，并且这个队列的消息是需要持久化的！PS：持久化存储存到磁盘会占空间，
-# 队列不能由持久化变为普通队列，反过来也是！否则会报错！所以队列类型创建的开始必须确定的！
 order_dead_letter_exchange_name = "xz-dead-letter-exchange"
 order_dead_letter_exchange_type = "fanout"
 order_dead_letter_queue_name = "xz-dead-letter-queue"
 order_dead_letter_routing_key = "xz-dead-letter-queue"
 
-# 相对比只要交换机名称即可接收到消息的广播模式（fanout），direct模式在其基础上，多加了一层密码限制（routingKey）
-channel.exchange_declare(
-    exchange=order_dead_letter_exchange_name,
-    durable=True,
-    exchange_type=order_dead_letter_exchange_type,
-)
-channel.queue_declare(queue=order_dead_letter_queue_name, durable=True)
-channel.queue_bind(
-    exchange=order_dead_letter_exchange_name,
-    queue=order_dead_letter_queue_name,
-    routing_key=order_dead_letter_routing_key,
-)
-
-print(" [*] 死信队列里面的死信消息的消费. To exit press CTRL+C")
 
+class OrderTimeoutConsumer:
+    """死信队列里面超时订单消息的批量消费"""
 
-# 初始化数据库的链接处理
-def callback(ch, method, properties, body):
-    print(" [x] Received %r" % body.decode())
-    # 预扣库存回退
-    mesgg = json_helper.json_to_dict(body.decode())
-    print("死信消息的内容", mesgg)
+    def __init__(self, batch_size=200, flush_interval=0.5):
+        # 每批最多处理的消息数
+        self.batch_size = batch_size
+        # 消息不足一批时，最长等待多久就处理
+        self.flush_interval = flush_interval
+        self._buffer: List[AbstractIncomingMessage] = []
+        self._lock = asyncio.Lock()
 
-    # 获取当前的订单支付状态信息，如果当前处于没支付的状态的话，则需要回滚我们的库存
-    with sync_context_get_db() as session:
-        _result = (
-            session.query(DoctorSubscribeinfo)
-            .filter(
-                and_(
-                    DoctorSubscribeinfo.dno == mesgg.get("dno"),
-                    DoctorSubscribeinfo.visit_uopenid == mesgg.get("visit_uopenid"),
-                    DoctorSubscribeinfo.orderid == mesgg.get("orderid"),
-                )
-            )
-            .one_or_none()
-        )
+    async def on_message(self, message: AbstractIncomingMessage):
+        self._buffer.append(message)
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
 
-        if _result:
+    async def run_flush_timer(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
 
-            #  # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单 4：超时未支付订单 5：申请退款状态 6：已退款状态）
-            if _result.statue == 2:
-                pass
-            elif _result.statue == 1:
-                pass
-                # 更新订单状态
-                print("更新状态！！！！！！！！！！！！！")
-                session.query(DoctorSubscribeinfo).filter(
-                    and_(
-                        DoctorSubscribeinfo.dno == mesgg.get("dno"),
-                        DoctorSubscribeinfo.orderid == mesgg.get("orderid"),
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            orderids = []
+            for message in batch:
+                try:
+                    mesgg = json_helper.json_to_dict(message.body.decode())
+                    orderids.append(mesgg.get("orderid"))
+                except ValueError:
+                    print("死信消息内容格式错误", message.body)
+            try:
+                async with async_context_get_db() as session:
+                    # 订单状态（1:订单就绪，还没支付 2：已支付成功 3：取消订单 4：超时未支付订单 5：申请退款状态 6：已退款状态）
+                    expired_orders = await PayOrderServeries.expire_unpay_orders(
+                        session, orderids=[item for item in orderids if item]
                     )
-                ).update({DoctorSubscribeinfo.statue: 4}, synchronize_session=False)
-            elif _result.statue == 3:
-                pass
-            elif _result.statue == 5:
-                pass
-            elif _result.statue == 6:
-                pass
-            else:
-                pass
-        # 回复确认消息已被消费
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+                    # 超时未支付，回补预扣的号源库存
+                    restocked = await DoctorServeries.bulk_restock_nsnumstock(
+                        session,
+                        nsindex_counts=Counter(item.nsindex for item in expired_orders),
+                    )
+            except Exception as ex:
+                print("超时订单处理失败，消息重新入队", ex)
+                # 消息是按投递顺序缓存的，最后一条的delivery_tag可以一次性确认之前的所有消息
+                await batch[-1].nack(multiple=True, requeue=True)
+                return
+            # 事务提交后再推送回补后的库存
+            for item in restocked:
+                stock_push_hub.publish(item.dno, item.nsindex, item.nsnumstock)
+            print(f"处理超时订单消息{len(batch)}条，其中超时未支付{len(expired_orders)}条")
+            # 回复确认消息已被消费
+            await batch[-1].ack(multiple=True)
+
+
+async def main():
+    settings = get_settings()
+    # 创建连接
+    connection = await aio_pika.connect_robust(
+        host=settings.RABBIT_HOST,
+        port=settings.RABBIT_PORT,
+        virtualhost=settings.VIRTUAL_HOST,
+        login=settings.RABBIT_USERNAME,
+        password=settings.RABBIT_PASSWORD,
+    )
+    # 通过连接创建信道
+    channel = await connection.channel()
+    # 设置预取消息数量，需要不小于每批处理的消息数
+    await channel.set_qos(prefetch_count=settings.ORDER_CONSUMER_PREFETCH)
+
+    # 相对比只要交换机名称即可接收到消息的广播模式（fanout），direct模式在其基础上，多加了一层密码限制（routingKey）
+    exchange = await channel.declare_exchange(
+        name=order_dead_letter_exchange_name,
+        type=order_dead_letter_exchange_type,
+        durable=True,
+    )
+    queue = await channel.declare_queue(name=order_dead_letter_queue_name, durable=True)
+    await queue.bind(exchange=exchange, routing_key=order_dead_letter_routing_key)
+
+    consumer = OrderTimeoutConsumer(
+        batch_size=settings.ORDER_CONSUMER_BATCH_SIZE,
+        flush_interval=settings.ORDER_CONSUMER_FLUSH_INTERVAL,
+    )
+    # 回补的库存通过redis推送给所有的web进程，没有配置redis时不推送
+    redis = (
+        aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+        if settings.REDIS_URL
+        else None
+    )
+    if redis is not None:
+        stock_push_hub.init_app(app=None, pushconf=settings, get_redis=lambda: redis)
+        await stock_push_hub.start(subscribe=False)
+    flush_timer = asyncio.create_task(consumer.run_flush_timer())
+    # 开始进行订阅消费
+    await queue.consume(consumer.on_message)
+    print(" [*] 死信队列里面的死信消息的消费. To exit press CTRL+C")
+    try:
+        await asyncio.Future()
+    finally:
+        flush_timer.cancel()
+        await consumer.flush()
+        await connection.close()
+        if redis is not None:
+            await stock_push_hub.stop()
+            await redis.close()
 
 
-# 设置预取消息数量
-channel.basic_qos(prefetch_count=1)
-# await channel.set_qos(prefetch_count=1)
-# 开始进行订阅消费
-ack = channel.basic_consume(queue="xz-dead-letter-queue", on_message_callback=callback)
-print("s", ack)
-# 消费者会阻塞在这里，一直等待消息，队列中有消息了，就会执行消息的回调函数
-channel.start_consuming()
+if __name__ == "__main__":
+    asyncio.run(main())
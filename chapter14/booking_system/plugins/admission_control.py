@@ -0,0 +1,277 @@
+"""
+放号时的准入控制和虚拟排队
+
+放号的时候所有用户同时提交预约订单，会占满数据库连接池，导致所有接口都超时。
+这里对指定的路由（按路由前缀）做准入控制，没有配置的路由（如医院信息、医生列表）不受影响：
+1：每个路由前缀有各自的并发许可数，超过的请求进入先进先出的等待队列
+2：排队的请求最多在服务端等待 hold_seconds 秒，还没轮到时返回排队凭证（ticket）、
+   当前排队位置和预计等待时间，客户端带上凭证重试时保留原来的排队位置；
+   轮到已离开的凭证时为它预留许可 ready_ttl 秒，过期未使用则让给下一个
+3：根据请求的平均处理时间估算等待时间，超过 max_estimated_wait 秒或者队列已满时直接拒绝
+排队是每个进程各自的，和每个进程各自的数据库连接池对应。
+"""
+import asyncio
+import secrets
+import time
+import typing
+from collections import OrderedDict
+
+from fastapi import FastAPI
+from pydantic import BaseSettings
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from exts.responses.json_response import LimiterResException
+from plugins.base import PluginBase
+
+
+class AdmissionTicket:
+    __slots__ = ("token", "seq", "future", "expires_at")
+
+    def __init__(self, token, seq, expires_at):
+        self.token = token
+        self.seq = seq
+        # 客户端正在服务端等待时不为None
+        self.future: typing.Optional[asyncio.Future] = None
+        self.expires_at = expires_at
+
+
+class AdmissionGate:
+    """单个路由前缀的并发许可和先进先出的等待队列"""
+
+    def __init__(
+        self,
+        name,
+        max_concurrency,
+        max_waiting=2000,
+        max_estimated_wait=30.0,
+        hold_seconds=2.0,
+        ticket_ttl=60.0,
+        ready_ttl=5.0,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.max_estimated_wait = max_estimated_wait
+        self.hold_seconds = hold_seconds
+        self.ticket_ttl = ticket_ttl
+        self.ready_ttl = ready_ttl
+        self.active = 0
+        self._queue: "OrderedDict[str, AdmissionTicket]" = OrderedDict()
+        # 已经轮到但客户端还没回来的凭证
+        self._ready: typing.Dict[str, AdmissionTicket] = {}
+        self._seq = 0
+        # 最近一个获得许可的排队序号，用来计算排队位置
+        self._served_seq = 0
+        # 请求平均处理时间（指数加权平均）
+        self.avg_service_time = 0.2
+        # 统计信息
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "expired": 0}
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        return max(ticket.seq - self._served_seq, 1)
+
+    def estimated_wait(self, position: int) -> float:
+        return position * self.avg_service_time / self.max_concurrency
+
+    def _new_ticket(self) -> AdmissionTicket:
+        self._seq += 1
+        ticket = AdmissionTicket(
+            secrets.token_urlsafe(16), self._seq, time.monotonic() + self.ticket_ttl
+        )
+        self._queue[ticket.token] = ticket
+        self.stats["queued"] += 1
+        return ticket
+
+    def _expire(self):
+        now = time.monotonic()
+        for token in [t for t, item in self._ready.items() if item.expires_at < now]:
+            # 预留的许可过期未使用，让给下一个
+            self._ready.pop(token)
+            self.active -= 1
+            self.stats["expired"] += 1
+        while self._queue:
+            ticket = next(iter(self._queue.values()))
+            if ticket.future is not None or ticket.expires_at >= now:
+                break
+            self._queue.popitem(last=False)
+            self.stats["expired"] += 1
+
+    def _grant(self):
+        """按先后顺序把空闲的许可分配给排队的请求"""
+        self._expire()
+        while self.active < self.max_concurrency and self._queue:
+            _, ticket = self._queue.popitem(last=False)
+            if ticket.future is None and ticket.expires_at < time.monotonic():
+                self.stats["expired"] += 1
+                continue
+            self.active += 1
+            self._served_seq = ticket.seq
+            if ticket.future is not None:
+                if not ticket.future.done():
+                    ticket.future.set_result(True)
+                else:
+                    # 等待已经超时取消，把许可还回去
+                    self.active -= 1
+            else:
+                # 客户端不在等待，为它预留许可
+                ticket.expires_at = time.monotonic() + self.ready_ttl
+                self._ready[ticket.token] = ticket
+
+    async def acquire(
+        self, token: str = None
+    ) -> typing.Tuple[bool, typing.Optional[AdmissionTicket]]:
+        """
+        :param token: 之前返回的排队凭证
+        :return: (是否获得许可, 没有获得许可时的排队凭证，None表示直接拒绝)
+        """
+        # 过期的预留许可让给排队的请求
+        self._grant()
+        if token and token in self._ready:
+            # 已经轮到，直接使用预留的许可
+            self._ready.pop(token)
+            self.stats["admitted"] += 1
+            return True, None
+        ticket = self._queue.get(token) if token else None
+        if ticket is None:
+            if self.active < self.max_concurrency and not self._queue:
+                self.active += 1
+                self.stats["admitted"] += 1
+                return True, None
+            # 新的排队请求，预计等待时间过长或者排队人数过多时直接拒绝
+            position = self._seq + 1 - self._served_seq
+            if (
+                len(self._queue) >= self.max_waiting
+                or self.estimated_wait(position) > self.max_estimated_wait
+            ):
+                self.stats["rejected"] += 1
+                return False, None
+            ticket = self._new_ticket()
+        elif ticket.future is not None:
+            # 同一个凭证的请求正在等待中
+            return False, ticket
+
+        ticket.future = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.hold_seconds)
+        except asyncio.TimeoutError:
+            # 还没轮到，客户端稍后带上凭证重试，保留排队位置
+            if ticket.future.done():
+                self.stats["admitted"] += 1
+                return True, None
+            ticket.future.cancel()
+            ticket.future = None
+            ticket.expires_at = time.monotonic() + self.ticket_ttl
+            return False, ticket
+        except asyncio.CancelledError:
+            # 客户端断开
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.release()
+            else:
+                ticket.future.cancel()
+                self._queue.pop(ticket.token, None)
+            raise
+        self.stats["admitted"] += 1
+        return True, None
+
+    def release(self, service_time: float = None):
+        self.active -= 1
+        if service_time is not None:
+            self.avg_service_time = self.avg_service_time * 0.9 + service_time * 0.1
+        self._grant()
+
+
+class AdmissionControlMiddleware:
+    """纯ASGI的准入控制中间件，没有配置的路由直接放行"""
+
+    TICKET_HEADER = b"x-admission-ticket"
+
+    def __init__(self, app: ASGIApp, plugin: "AdmissionControlPlugin") -> None:
+        self.app = app
+        self.plugin = plugin
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        gate = self.plugin.match(scope) if scope["type"] == "http" else None
+        if gate is None:
+            await self.app(scope, receive, send)
+            return
+        token = None
+        for key, value in scope["headers"]:
+            if key == self.TICKET_HEADER:
+                token = value.decode("latin-1")
+                break
+        admitted, ticket = await gate.acquire(token)
+        if not admitted:
+            await self.reject_response(gate, ticket)(scope, receive, send)
+            return
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release(time.perf_counter() - start_time)
+
+    @staticmethod
+    def reject_response(gate: AdmissionGate, ticket: typing.Optional[AdmissionTicket]):
+        if ticket is None:
+            retry_after = max(int(gate.max_estimated_wait), 1)
+            return LimiterResException(
+                http_status_code=503,
+                api_code=503,
+                message="当前预约人数过多，请稍后再试！",
+                result={"estimated_wait": retry_after},
+                headers={"Retry-After": str(retry_after)},
+            )
+        position = gate.position(ticket)
+        estimated_wait = gate.estimated_wait(position)
+        return LimiterResException(
+            message="正在排队中，请稍候！",
+            result={
+                "ticket": ticket.token,
+                "position": position,
+                "estimated_wait": round(estimated_wait, 1),
+            },
+            headers={
+                "Retry-After": str(max(int(estimated_wait), 1)),
+                "X-Admission-Ticket": ticket.token,
+            },
+        )
+
+
+class AdmissionControlPlugin(PluginBase):
+    pass
+
+    def __init__(self, *args, **kwargs):
+        self.gates: typing.List[typing.Tuple[str, AdmissionGate]] = []
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app: FastAPI, config: BaseSettings = None, *args, **kwargs):
+        if config is None or not config.ADMISSION_ENABLED:
+            return self
+        # 长的前缀优先匹配
+        self.gates = [
+            (
+                prefix,
+                AdmissionGate(
+                    prefix,
+                    max_concurrency=limit,
+                    max_waiting=config.ADMISSION_MAX_WAITING,
+                    max_estimated_wait=config.ADMISSION_MAX_ESTIMATED_WAIT,
+                    hold_seconds=config.ADMISSION_HOLD_SECONDS,
+                    ticket_ttl=config.ADMISSION_TICKET_TTL,
+                    ready_ttl=config.ADMISSION_READY_TTL,
+                ),
+            )
+            for prefix, limit in sorted(
+                config.ADMISSION_ROUTE_LIMITS.items(),
+                key=lambda item: len(item[0]),
+                reverse=True,
+            )
+        ]
+        app.add_middleware(AdmissionControlMiddleware, plugin=self)
+        return self
+
+    def match(self, scope: Scope) -> typing.Optional[AdmissionGate]:
+        path = scope["path"]
+        for prefix, gate in self.gates:
+            if path.startswith(prefix):
+                return gate
+        return None
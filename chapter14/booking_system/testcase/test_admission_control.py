@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from plugins.admission_control import AdmissionGate
+
+
+async def wait_in_queue(gate, token=None):
+    """等待排队的请求进入等待状态"""
+    task = asyncio.ensure_future(gate.acquire(token))
+    await asyncio.sleep(0)
+    return task
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admission_fifo_order():
+    gate = AdmissionGate("reserve", max_concurrency=1, hold_seconds=1)
+    assert await gate.acquire() == (True, None)
+    admitted = []
+
+    async def request(name):
+        ok, _ = await gate.acquire()
+        assert ok
+        admitted.append(name)
+
+    tasks = []
+    for name in ("a", "b", "c"):
+        tasks.append(asyncio.ensure_future(request(name)))
+        await asyncio.sleep(0)
+    assert len(gate._queue) == 3
+    for _ in range(3):
+        gate.release(0.01)
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    assert admitted == ["a", "b", "c"]
+    gate.release()
+    assert gate.active == 0
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admission_reject_when_queue_full():
+    gate = AdmissionGate("reserve", max_concurrency=1, max_waiting=2, hold_seconds=0.01)
+    assert await gate.acquire() == (True, None)
+    for position in (1, 2):
+        ok, ticket = await gate.acquire()
+        assert not ok and ticket is not None
+        assert gate.position(ticket) == position
+    # 排队人数已满，直接拒绝，不返回排队凭证
+    assert await gate.acquire() == (False, None)
+    assert gate.stats["rejected"] == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admission_reject_when_estimated_wait_too_long():
+    gate = AdmissionGate(
+        "reserve", max_concurrency=1, max_estimated_wait=0.1, hold_seconds=0.01
+    )
+    gate.avg_service_time = 0.2
+    assert await gate.acquire() == (True, None)
+    # 排在第1位预计也要等待0.2秒
+    assert await gate.acquire() == (False, None)
+    assert gate.stats["rejected"] == 1
+    assert not gate._queue
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admission_ticket_keeps_position_and_uses_ready_permit():
+    gate = AdmissionGate("reserve", max_concurrency=1, hold_seconds=0.01, ready_ttl=1)
+    assert await gate.acquire() == (True, None)
+    ok, ticket = await gate.acquire()
+    assert not ok
+    # 轮到已离开的凭证时为它预留许可，其他请求不能使用
+    gate.release(0.01)
+    assert ticket.token in gate._ready and gate.active == 1
+    ok, other = await gate.acquire()
+    assert not ok and other is not None
+    # 带上凭证回来时直接使用预留的许可
+    assert await gate.acquire(ticket.token) == (True, None)
+    assert gate.active == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admission_abandoned_ready_ticket_reclaimed():
+    gate = AdmissionGate(
+        "reserve", max_concurrency=1, hold_seconds=0.01, ready_ttl=0.05
+    )
+    assert await gate.acquire() == (True, None)
+    ok, ticket = await gate.acquire()
+    assert not ok
+    gate.release(0.01)
+    assert ticket.token in gate._ready
+    # 预留的许可过期未使用，让给下一个请求
+    await asyncio.sleep(0.06)
+    assert await gate.acquire() == (True, None)
+    assert gate.active == 1
+    assert gate.stats["expired"] == 1
+    # 过期的凭证不能再使用预留的许可，需要重新排队
+    ok, new_ticket = await gate.acquire(ticket.token)
+    assert not ok and new_ticket.token != ticket.token
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admission_cancelled_while_waiting_leaves_queue():
+    gate = AdmissionGate("reserve", max_concurrency=1, hold_seconds=1)
+    assert await gate.acquire() == (True, None)
+    task = await wait_in_queue(gate)
+    assert len(gate._queue) == 1
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert not gate._queue
+    gate.release()
+    assert gate.active == 0
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admission_cancelled_after_grant_releases_permit():
+    gate = AdmissionGate("reserve", max_concurrency=1, hold_seconds=1)
+    assert await gate.acquire() == (True, None)
+    task = await wait_in_queue(gate)
+    # 请求被取消后还没来得及恢复执行，许可就分配给了它
+    task.cancel()
+    gate.release()
+    assert gate.active == 1 and not gate._queue
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert gate.active == 0
+    assert await gate.acquire() == (True, None)
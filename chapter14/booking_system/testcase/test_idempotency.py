@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from exts.idempotency import IdempotencyGuard
+
+NAMESPACE = "pay_notify"
+
+
+class FakeRedis:
+    """多个worker共享的已处理集合，记录访问次数"""
+
+    def __init__(self):
+        self.data = {}
+        self.calls = 0
+
+    async def mget(self, *keys):
+        self.calls += 1
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def set(self, key, value, ex=None):
+        self.redis.data[key] = value
+
+    async def execute(self):
+        self.redis.calls += 1
+
+
+async def handle_notify(guard, db_calls, transaction_id, out_trade_no):
+    """和支付回调相同的幂等处理流程，db_calls 记录访问数据库的次数"""
+    if await guard.is_done(NAMESPACE, transaction_id, out_trade_no):
+        return "done"
+    if not guard.try_begin(NAMESPACE, transaction_id):
+        return "processing"
+    try:
+        db_calls.append(transaction_id)
+        await asyncio.sleep(0.01)
+        await guard.mark_done(NAMESPACE, transaction_id, out_trade_no)
+    finally:
+        guard.end(NAMESPACE, transaction_id)
+    return "handled"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_concurrent_duplicate_notify_handled_once():
+    guard = IdempotencyGuard()
+    db_calls = []
+    results = await asyncio.gather(
+        *(handle_notify(guard, db_calls, "T001", "O001") for _ in range(20))
+    )
+    assert results.count("handled") == 1
+    assert set(results) == {"handled", "processing"}
+    assert db_calls == ["T001"]
+    assert guard.stats["inflight_hits"] == 19
+    # 处理完成后释放处理中的标记
+    assert not guard._inflight
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_sequential_retry_is_local_noop():
+    redis = FakeRedis()
+    guard = IdempotencyGuard()
+    guard.get_redis = lambda: redis
+    db_calls = []
+    assert await handle_notify(guard, db_calls, "T002", "O002") == "handled"
+    redis_calls = redis.calls
+    for _ in range(5):
+        assert await handle_notify(guard, db_calls, "T002", "O002") == "done"
+    # 重试只查询进程内的已处理集合，不访问数据库和redis
+    assert db_calls == ["T002"]
+    assert redis.calls == redis_calls
+    assert guard.stats["local_hits"] == 5
+    # 只带订单号的通知也能识别
+    assert await guard.is_done(NAMESPACE, None, "O002")
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_duplicate_notify_on_other_worker_uses_redis():
+    redis = FakeRedis()
+    worker_a, worker_b = IdempotencyGuard(), IdempotencyGuard()
+    worker_a.get_redis = worker_b.get_redis = lambda: redis
+    db_calls = []
+    assert await handle_notify(worker_a, db_calls, "T003", "O003") == "handled"
+    assert await handle_notify(worker_b, db_calls, "T003", "O003") == "done"
+    assert worker_b.stats["redis_hits"] == 1
+    # 之后的重试在 worker_b 的进程内命中
+    assert await handle_notify(worker_b, db_calls, "T003", "O003") == "done"
+    assert worker_b.stats["local_hits"] == 1
+    assert db_calls == ["T003"]
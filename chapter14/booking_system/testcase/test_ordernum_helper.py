@@ -0,0 +1,50 @@
+import pytest
+
+from utils import ordernum_helper
+from utils.ordernum_helper import SnowflakeOrderNum
+
+
+def test_snowflake_order_num_unique_and_increasing():
+    generator = SnowflakeOrderNum(worker_id=1)
+    items = [generator.next_order_num() for _ in range(20000)]
+    assert {len(item) for item in items} == {19}
+    assert all(item.isdigit() for item in items)
+    # 固定19位，字符串顺序和数值顺序一致
+    assert items == sorted(set(items))
+
+
+def test_snowflake_order_num_sequence_overflow(monkeypatch):
+    # 时间停在同一毫秒，序号用完后借用下一毫秒
+    monkeypatch.setattr(ordernum_helper.time, "time", lambda: 1700000000.0)
+    generator = SnowflakeOrderNum(worker_id=3)
+    count = SnowflakeOrderNum.MAX_SEQUENCE + 1 + 10
+    ids = [generator.next_id() for _ in range(count)]
+    assert ids == sorted(set(ids))
+    timestamps = {
+        item >> (SnowflakeOrderNum.WORKER_ID_BITS + SnowflakeOrderNum.SEQUENCE_BITS)
+        for item in ids
+    }
+    assert len(timestamps) == 2
+
+
+@pytest.mark.parametrize("worker_id", [-1, 1024, 1025])
+def test_snowflake_worker_id_out_of_range(worker_id):
+    with pytest.raises(ValueError):
+        SnowflakeOrderNum(worker_id=worker_id)
+    with pytest.raises(ValueError):
+        SnowflakeOrderNum(worker_id=0).set_worker_id(worker_id)
+
+
+def test_snowflake_set_worker_id_keeps_increasing(monkeypatch):
+    monkeypatch.delenv("ORDER_WORKER_ID", raising=False)
+    generator = SnowflakeOrderNum()
+    assert generator.worker_source == "pid"
+    before = [generator.next_id() for _ in range(100)]
+    generator.set_worker_id(7)
+    assert (generator.worker_id, generator.worker_source) == (7, "lease")
+    after = [generator.next_id() for _ in range(100)]
+    assert before + after == sorted(set(before + after))
+    assert {
+        (item >> SnowflakeOrderNum.SEQUENCE_BITS) & SnowflakeOrderNum.MAX_WORKER_ID
+        for item in after
+    } == {7}
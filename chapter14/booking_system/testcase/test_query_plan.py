@@ -0,0 +1,136 @@
+import json
+
+import pytest
+from sqlalchemy import text
+
+from db.async_database import async_engine
+from apis.doctor.repository import DoctorServeries
+
+
+class CaptureSession:
+    """只记录仓储层生成的查询语句，不真正执行"""
+
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+        raise _Captured()
+
+
+class _Captured(Exception):
+    pass
+
+
+async def capture_statements(func, **kwargs):
+    session = CaptureSession()
+    try:
+        await func(session, **kwargs)
+    except _Captured:
+        pass
+    return session.statements
+
+
+def iter_plan_nodes(plan):
+    yield plan
+    for item in plan.get("Plans", []):
+        yield from iter_plan_nodes(item)
+
+
+async def explain(statement):
+    compiled = statement.compile(dialect=async_engine.dialect)
+    params = tuple(compiled.params[key] for key in compiled.positiontup)
+    async with async_engine.connect() as conn:
+        # 关闭顺序扫描，能走索引的情况下计划里面就不应该再出现顺序扫描
+        await conn.execute(text("SET enable_seqscan = off"))
+        result = await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", params)
+        plan = result.scalar()
+    await async_engine.dispose()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return list(iter_plan_nodes(plan[0]["Plan"]))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_doctor_nsindex_scheduling_record_single_query():
+    statements = await capture_statements(
+        DoctorServeries.get_doctor_nsindex_scheduling_record,
+        dno="10001",
+        nsindex="10001-20220101-am-1",
+        visit_uopenid="openid",
+    )
+    # 医生信息、号源排班、未支付订单判断在同一条语句里面
+    assert len(statements) == 1
+    nodes = await explain(statements[0])
+    seq_scans = {
+        node["Relation Name"]
+        for node in nodes
+        if node["Node Type"] == "Seq Scan"
+    }
+    assert "doctorinfo" not in seq_scans
+    assert "doctor_scheduling" not in seq_scans
+    # 未支付订单判断走 ix_doctor_subscribeinfo_unpay_uopenid 部分索引
+    assert "doctor_subscribeinfo" not in seq_scans
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_doctor_scheduling_info_single_query():
+    statements = await capture_statements(
+        DoctorServeries.get_doctor_scheduling_info,
+        dno="10001",
+        start_time="2022-01-01",
+    )
+    assert len(statements) == 1
+    nodes = await explain(statements[0])
+    assert "doctorinfo" not in {
+        node["Relation Name"]
+        for node in nodes
+        if node["Node Type"] == "Seq Scan"
+    }
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_user_order_list_keyset_page():
+    from apis.userorders.repository import Serveries, encode_order_cursor
+    import datetime
+
+    statements = await capture_statements(
+        Serveries.get_order_info_page_by_visit_uopenid,
+        visit_uopenid="openid",
+        statue=2,
+        cursor=encode_order_cursor(datetime.datetime(2022, 1, 1), 100),
+    )
+    assert len(statements) == 1
+    nodes = await explain(statements[0])
+    # 翻页走 ix_doctor_subscribeinfo_uopenid_statue_ctime_id，不需要额外排序
+    assert "doctor_subscribeinfo" not in {
+        node["Relation Name"]
+        for node in nodes
+        if node["Node Type"] == "Seq Scan"
+    }
+    assert "Sort" not in {node["Node Type"] for node in nodes}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_scheduling_calendar_single_grouped_query():
+    import datetime
+
+    statements = await capture_statements(
+        DoctorServeries.get_scheduling_calendar_aggregate,
+        days=[datetime.date(2022, 1, 1) + datetime.timedelta(days=i) for i in range(14)],
+    )
+    # 14天所有医生的汇总在同一条分组查询里面
+    assert len(statements) == 1
+    nodes = await explain(statements[0])
+    # 按日期筛选走 ix_doctor_scheduling_enable_dnotime
+    assert "doctor_scheduling" not in {
+        node["Relation Name"]
+        for node in nodes
+        if node["Node Type"] == "Seq Scan"
+    }
+    # 只有一次分组汇总
+    assert [node["Node Type"] for node in nodes].count("Aggregate") == 1
@@ -31,8 +31,13 @@ Author = zyx
 @File: ordernum_helper.py
 @文件功能描述:
 """
+import os
+import threading
 import time
 import random
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def order_num_1(package_id=12345, user_num=56789):
@@ -76,3 +81,152 @@ def order_num_srt(user_num="56789"):
         + str(random.randint(1000, 9999))
     )
     return result
+
+
+class SnowflakeOrderNum:
+    """
+    雪花算法的订单号生成器，生成的订单号为19位的数字字符串（和原来的订单号长度一致，
+    满足微信支付 out_trade_no 不超过32位的要求）
+
+    41位毫秒时间戳 + 10位进程编号 + 12位毫秒内序号：
+    1：同一个进程内单调递增，每毫秒最多4096个，超过时借用下一毫秒，不需要等待
+    2：不同的进程通过进程编号区分，优先读取环境变量 ORDER_WORKER_ID（0~1023，超出范围时报错），
+       没有配置时由 exts.order_worker 通过redis为每个进程租用一个编号（set_worker_id）；
+       都没有时临时使用 PID 的低10位，只适合单进程部署，多个进程/容器可能重复
+    3：系统时钟回拨时继续使用上次的时间戳递增，不会生成重复的订单号
+    4：fork 之后的子进程会重新获取进程编号，父进程租用的编号不会被子进程继承
+    """
+
+    # 起始时间 2022-01-01 00:00:00 UTC，毫秒
+    EPOCH = 1640995200000
+    WORKER_ID_BITS = 10
+    SEQUENCE_BITS = 12
+    MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+    MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+    # 时钟回拨超过这个毫秒数时记录告警
+    CLOCK_BACKWARD_WARN_MS = 10
+
+    def __init__(self, worker_id: int = None):
+        self._lock = threading.Lock()
+        self._fixed_worker_id = worker_id
+        # 通过 set_worker_id 租用的编号，只属于当前进程
+        self._leased_worker_id = None
+        self._init_worker()
+
+    @classmethod
+    def check_worker_id(cls, worker_id) -> int:
+        worker_id = int(worker_id)
+        if not 0 <= worker_id <= cls.MAX_WORKER_ID:
+            raise ValueError(f"订单号的进程编号需要在0~{cls.MAX_WORKER_ID}之间：{worker_id}")
+        return worker_id
+
+    @property
+    def has_explicit_worker_id(self) -> bool:
+        """是否指定了进程编号（构造参数或环境变量 ORDER_WORKER_ID）"""
+        return self._fixed_worker_id is not None or bool(
+            os.environ.get("ORDER_WORKER_ID")
+        )
+
+    def _init_worker(self):
+        if getattr(self, "_pid", None) not in (None, os.getpid()):
+            # fork 之后父进程租用的编号不能继续使用
+            self._leased_worker_id = None
+        self._pid = os.getpid()
+        # 进程编号的来源：config 指定的，lease 租用的，pid 临时使用PID
+        self.worker_source = "config"
+        worker_id = self._fixed_worker_id
+        if worker_id is None:
+            worker_id = os.environ.get("ORDER_WORKER_ID") or None
+        if worker_id is None and self._leased_worker_id is not None:
+            self.worker_source = "lease"
+            worker_id = self._leased_worker_id
+        if worker_id is None:
+            # 没有指定也没有租用时临时使用PID的低10位
+            self.worker_source = "pid"
+            self.worker_id = self._pid & self.MAX_WORKER_ID
+        else:
+            self.worker_id = self.check_worker_id(worker_id)
+        self._worker_bits = self.worker_id << self.SEQUENCE_BITS
+        self._last_timestamp = -1
+        self._sequence = 0
+
+    def set_worker_id(self, worker_id: int):
+        """使用租用的进程编号，之后生成的订单号继续保持递增"""
+        worker_id = self.check_worker_id(worker_id)
+        with self._lock:
+            last_timestamp = self._last_timestamp
+            self._leased_worker_id = worker_id
+            self._init_worker()
+            # 进程编号变小时同一毫秒内的订单号会变小，从下一毫秒开始使用新的进程编号
+            self._last_timestamp = last_timestamp
+            self._sequence = self.MAX_SEQUENCE
+
+    def next_id(self) -> int:
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._init_worker()
+            timestamp = int(time.time() * 1000) - self.EPOCH
+            last_timestamp = self._last_timestamp
+            if timestamp <= last_timestamp:
+                if last_timestamp - timestamp > self.CLOCK_BACKWARD_WARN_MS:
+                    logger.warning(
+                        "系统时钟回拨了%sms，继续使用上次的时间戳生成订单号",
+                        last_timestamp - timestamp,
+                    )
+                timestamp = last_timestamp
+                self._sequence = (self._sequence + 1) & self.MAX_SEQUENCE
+                # 当前毫秒的序号用完了，借用下一毫秒
+                if self._sequence == 0:
+                    timestamp += 1
+            else:
+                self._sequence = 0
+            self._last_timestamp = timestamp
+            return (
+                (timestamp << (self.WORKER_ID_BITS + self.SEQUENCE_BITS))
+                | self._worker_bits
+                | self._sequence
+            )
+
+    def next_order_num(self) -> str:
+        # 固定19位，前面补0
+        return f"{self.next_id():019d}"
+
+
+snowflake_order_num = SnowflakeOrderNum()
+
+
+def order_num_snowflake():
+    # 全局唯一的19位订单号
+    return snowflake_order_num.next_order_num()
+
+
+if __name__ == "__main__":
+    # 重复率和吞吐量测试：python -m utils.ordernum_helper
+    import multiprocessing
+
+    def burst(func, count):
+        start = time.perf_counter()
+        items = [func() for _ in range(count)]
+        cost = time.perf_counter() - start
+        return items, cost
+
+    def child_ids(count):
+        # 子进程中生成，验证多进程之间不重复
+        return [order_num_snowflake() for _ in range(count)]
+
+    count = 200000
+    for name, func in (
+        ("order_num_3", lambda: order_num_3(user_num="13800000000")),
+        ("order_num_snowflake", order_num_snowflake),
+    ):
+        items, cost = burst(func, count)
+        print(
+            f"{name:<22}{count / cost:>12.0f} ops/s  "
+            f"重复 {count - len(set(items))} 个  长度 {set(map(len, items))}"
+        )
+
+    processes = 8
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        results = pool.map(child_ids, [count // processes] * processes)
+    items = [item for result in results for item in result]
+    print(f"{processes}个进程共生成 {len(items)} 个，重复 {len(items) - len(set(items))} 个")
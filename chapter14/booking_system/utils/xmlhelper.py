@@ -31,28 +31,16 @@ Author = zyx
 @File: xmlhelper.py
 @文件功能描述:
 """
-import requests
-import xmltodict
-from xml.parsers.expat import ExpatError
+from exts.wechatpy.pay.xmlcodec import FlatXMLError, decode_flat_xml, convert_int_fields
 
 
 def parse_xml_data(xml):
     """解析微信支付结果通知"""
     try:
-        data = xmltodict.parse(xml)
-    except (xmltodict.ParsingInterrupted, ExpatError):
+        data = decode_flat_xml(xml)
+    except FlatXMLError:
         raise Exception()
 
-    if not data or "xml" not in data:
+    if not data:
         raise Exception()
-    data = data["xml"]
-    for key in (
-        "total_fee",
-        "settlement_total_fee",
-        "cash_fee",
-        "coupon_fee",
-        "coupon_count",
-    ):
-        if key in data:
-            data[key] = int(data[key])
-    return data
+    return convert_int_fields(data)